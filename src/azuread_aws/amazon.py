@@ -1,16 +1,37 @@
 import os
-import boto3
 import logging
 import time
 import datetime
 import random
+import functools
+import threading
+import concurrent.futures
 
-from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Attr
+from azuread_aws import console
+from azuread_aws import metrics
+from azuread_aws import tracing
 
 
 log = logging.getLogger('amazon')
 
+DEFAULT_ROLE_NAME = 'OrganizationAccountAccessRole'
+# Assumed role credentials are refreshed this many seconds before they expire
+CREDENTIALS_REFRESH_MARGIN = int(os.getenv('AWS_CREDENTIALS_REFRESH_MARGIN', '300'))
+
+_session = None
+_lock = threading.Lock()
+# (account id, role name) -> Credentials of assume_role response
+_credentials = {}
+_credentials_locks = {}
+# (service name, account id, role name) -> (access key id, boto3 client)
+_clients = {}
+_clients_locks = {}
+# services with a client or resource built, their models are cached by the session
+_services_loaded = set()
+_services_locks = {}
+# boto3 resources are not thread safe and are cached per thread
+_local = threading.local()
+
 
 def list_accounts(client):
     ''' Returns map of account names to account ids.'''
@@ -34,19 +55,26 @@ def list_accounts_by_name(client):
     return accounts
 
 
+@functools.lru_cache(maxsize=None)
+def describe_organization():
+    ''' Returns organization description, looked up once per process'''
+    return client('organizations').describe_organization()['Organization']
+
+
 def get_master_account():
     ''' Returns master account id'''
-    return boto3.client('organizations').describe_organization()['Organization']['MasterAccountId']
+    return describe_organization()['MasterAccountId']
 
 
+@functools.lru_cache(maxsize=None)
 def get_current_account():
     ''' Returns currently logged into account id'''
-    return boto3.client('sts').get_caller_identity()['Account']
+    return client('sts').get_caller_identity()['Account']
 
 
 def get_organization_id():
     ''' Returns current organization id.'''
-    return boto3.client('organizations').describe_organization()['Organization']['Id']
+    return describe_organization()['Id']
 
 
 def cloudformation_template(filename):
@@ -242,7 +270,7 @@ def deploy_stack(client, stack_name, template, parameters, capabilities):
             log.info('Waiting for stack update to complete.')
             client.get_waiter('stack_update_complete').wait(StackName=stack_name)
 
-        except ClientError as ce:
+        except client.exceptions.ClientError as ce:
             if ce.response['Error']['Code'] != 'ValidationError':
                 raise
             if 'No updates are to be performed' not in ce.response['Error']['Message']:
@@ -271,37 +299,155 @@ def deploy_stack(client, stack_name, template, parameters, capabilities):
     log.info(f'Stack {stack_name} was created or updated successfully')
 
 
+def session():
+    ''' Returns shared boto3 session of the process credentials.
+        STS calls are sent to the regional endpoint instead of the global one.
+        Calls of its clients and resources are recorded in metrics and trace when enabled.
+    '''
+    global _session
+    with _lock:
+        if _session is None:
+            os.environ.setdefault('AWS_STS_REGIONAL_ENDPOINTS', 'regional')
+            # boto3 takes a third of a second to import and is loaded on first use only
+            import boto3
+            _session = tracing.instrument(metrics.instrument(boto3.session.Session()))
+        return _session
+
+
 def assume_account_role(account, role_name):
     '''Assume role in the target account'''
-    return boto3.client('sts').assume_role(
+    return client('sts').assume_role(
         RoleArn=f'arn:aws:iam::{account}:role/{role_name}',
         RoleSessionName=f'aad-aws-{random.randint(1, 10000)}'
     )
 
 
+def _fresh(credentials):
+    margin = datetime.timedelta(seconds=CREDENTIALS_REFRESH_MARGIN)
+    return credentials is not None and \
+        credentials['Expiration'] - margin > datetime.datetime.now(datetime.timezone.utc)
+
+
+def credentials(account_id, role_name=DEFAULT_ROLE_NAME):
+    ''' Returns credentials of the assumed role in the target account.
+        Credentials are cached until shortly before expiration, concurrent callers
+        for the same account and role wait for a single assume_role call.
+    '''
+    key = (account_id, role_name)
+    with _lock:
+        cached = _credentials.get(key)
+        key_lock = _credentials_locks.setdefault(key, threading.Lock())
+    if _fresh(cached):
+        return cached
+
+    with key_lock:
+        cached = _credentials.get(key)
+        if _fresh(cached):
+            return cached
+        log.debug(f'Assuming role {role_name} in account {account_id}')
+        assumed = assume_account_role(account_id, role_name)['Credentials']
+        with _lock:
+            _credentials[key] = assumed
+        return assumed
+
+
+def _session_args(account_id, role_name):
+    if account_id is None:
+        return None, {}
+    creds = credentials(account_id, role_name)
+    return creds['AccessKeyId'], {
+        'aws_access_key_id': creds['AccessKeyId'],
+        'aws_secret_access_key': creds['SecretAccessKey'],
+        'aws_session_token': creds['SessionToken'],
+    }
+
+
+def _build(factory, client_name, kwargs):
+    ''' Returns factory(client_name, **kwargs) of the shared session. botocore creates components of
+        the session on first use without locking and concurrent first clients of a service would all
+        load its model, so the first client or resource of every service is built exclusively.
+        Later ones reuse the loaded model and are built in parallel.
+    '''
+    if client_name in _services_loaded:
+        return factory(client_name, **kwargs)
+    with _lock:
+        if not _services_loaded:
+            built = factory(client_name, **kwargs)
+            _services_loaded.add(client_name)
+            return built
+        service_lock = _services_locks.setdefault(client_name, threading.Lock())
+    with service_lock:
+        if client_name not in _services_loaded:
+            built = factory(client_name, **kwargs)
+            _services_loaded.add(client_name)
+            return built
+    return factory(client_name, **kwargs)
+
+
 def client(client_name,
            account_id=None,
-           role_name='OrganizationAccountAccessRole'):
-    '''Returns a boto3.client for given account id'''
-    if account_id is None:
-        return boto3.client(client_name)
-    # assume role in the target account
-    assumed_role = assume_account_role(account_id, role_name)
-    return boto3.client(client_name,
-                        aws_access_key_id=assumed_role['Credentials']['AccessKeyId'],
-                        aws_secret_access_key=assumed_role['Credentials']['SecretAccessKey'],
-                        aws_session_token=assumed_role['Credentials']['SessionToken'])
+           role_name=DEFAULT_ROLE_NAME):
+    ''' Returns a boto3.client for given account id, reused while assumed role credentials are valid.
+        Concurrent callers for the same client wait for a single one to be built.
+    '''
+    access_key, kwargs = _session_args(account_id, role_name)
+    key = (client_name, account_id, role_name)
+    sess = session()
+    with _lock:
+        cached = _clients.get(key)
+        key_lock = _clients_locks.setdefault(key, threading.Lock())
+    if cached is not None and cached[0] == access_key:
+        return cached[1]
+
+    with key_lock:
+        cached = _clients.get(key)
+        if cached is not None and cached[0] == access_key:
+            return cached[1]
+        new_client = _build(sess.client, client_name, kwargs)
+        with _lock:
+            _clients[key] = (access_key, new_client)
+        return new_client
 
 
 def resource(client_name,
              account_id=None,
-             role_name='OrganizationAccountAccessRole'):
-    '''Returns a boto3.resource for given account id'''
-    if account_id is None:
-        return boto3.resource(client_name)
-    # assume role in the target account
-    assumed_role = assume_account_role(account_id, role_name)
-    return boto3.resource(client_name,
-                          aws_access_key_id=assumed_role['Credentials']['AccessKeyId'],
-                          aws_secret_access_key=assumed_role['Credentials']['SecretAccessKey'],
-                          aws_session_token=assumed_role['Credentials']['SessionToken'])
+             role_name=DEFAULT_ROLE_NAME):
+    '''Returns a boto3.resource for given account id, reused within the calling thread'''
+    access_key, kwargs = _session_args(account_id, role_name)
+    key = (client_name, account_id, role_name)
+    resources = getattr(_local, 'resources', None)
+    if resources is None:
+        resources = _local.resources = {}
+    cached = resources.get(key)
+    if cached is not None and cached[0] == access_key:
+        return cached[1]
+    new_resource = _build(session().resource, client_name, kwargs)
+    resources[key] = (access_key, new_resource)
+    return new_resource
+
+
+def prewarm(account_ids, role_name=DEFAULT_ROLE_NAME, max_workers=16):
+    ''' Assume role in all given accounts in parallel to fill credentials cache.
+        Returns map of account id to exception for accounts where role could not be assumed.
+    '''
+    def assume(account_id):
+        with tracing.span('assume_role', 'work', account=account_id, role=role_name):
+            return credentials(account_id, role_name)
+
+    failures = {}
+    with tracing.span('prewarm', role=role_name), \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        assume = console.bind(tracing.bind(assume))
+        futures = {executor.submit(assume, account_id): account_id for account_id in account_ids}
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception() is not None:
+                failures[futures[future]] = future.exception()
+    log.debug(f'Assumed {role_name} in {len(futures) - len(failures)} of {len(futures)} accounts')
+    return failures
+
+
+def prewarm_organization(role_name=DEFAULT_ROLE_NAME, max_workers=16):
+    ''' Assume role in every account of the organization, except the master account.'''
+    master_id = get_master_account()
+    accounts = [no for no in list_accounts(client('organizations')).values() if no != master_id]
+    return prewarm(accounts, role_name, max_workers)
@@ -0,0 +1,378 @@
+''' asyncio Graph API client for directory-wide scans from a single thread.
+    HTTP/1.1 keep-alive connections are implemented on asyncio streams. Requests in flight are bounded
+    by a semaphore and by the per host AIMD limiter shared with azuread_aws.http, so both clients
+    back off together when Graph throttles. Bearer tokens come from the same cache as azure.auth.
+
+    async def scan(emails):
+        async with aio.AsyncGraphClient(concurrency=50) as client:
+            return await asyncio.gather(*[client.find_user_by_email(e) for e in emails])
+
+    users = aio.run(scan(emails))
+
+Blocking graph_api functions are unchanged and remain the API for sequential callers.
+'''
+import ssl
+import time
+import asyncio
+import logging
+import urllib.parse
+from http.client import HTTPMessage, RemoteDisconnected
+
+from azuread_aws import http
+from azuread_aws import console
+from azuread_aws import metrics
+from azuread_aws import tracing
+from azuread_aws.azure import auth
+from azuread_aws.azure import AzureError
+from azuread_aws.azure import graph_api
+from azuread_aws.azure.constants import APP_ID, SERVICE_ID, GRAPH_URL
+
+log = logging.getLogger('azure.aio')
+
+DEFAULT_CONCURRENCY = 50
+# seconds between checks for a free slot of the host limiter taken by other threads
+LIMITER_POLL = 0.01
+
+
+def run(coro):
+    '''Run coroutine to completion in a new event loop'''
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class Response:
+    '''Response with the same properties as azuread_aws.http responses'''
+
+    def __init__(self, status, reason, headers, data):
+        self.status = self.status_code = self.code = status
+        self.reason = reason
+        self.headers = headers
+        self.data = data
+        if data and http.compressed(headers):
+            decompressor = http.Decompressor()
+            self.data = decompressor.decompress(data) + decompressor.flush()
+        self.text = None
+        self.json = None
+        self.ok = 200 <= status < 400
+        self.received = len(data)
+        http.decode_body(self)
+
+
+class _Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.released_at = None
+
+    def close(self):
+        self.writer.close()
+
+
+async def _read_response(reader, method):
+    ''' Returns tuple of (status, reason, headers, data, will_close) read from the stream'''
+    status_line = await reader.readline()
+    if not status_line:
+        raise RemoteDisconnected('Remote end closed connection without response')
+    parts = status_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+    version, status = parts[0], int(parts[1])
+    reason = parts[2] if len(parts) > 2 else ''
+
+    headers = HTTPMessage()
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip()] = value.strip()
+
+    will_close = version == 'HTTP/1.0' or (headers.get('Connection') or '').lower() == 'close'
+    if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+        return status, reason, headers, b'', will_close
+
+    if (headers.get('Transfer-Encoding') or '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0].strip(), 16)
+            if size == 0:
+                # skip trailers
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        return status, reason, headers, b''.join(chunks), will_close
+
+    if headers.get('Content-Length') is not None:
+        return status, reason, headers, await reader.readexactly(int(headers['Content-Length'])), will_close
+
+    return status, reason, headers, await reader.read(), True
+
+
+class AsyncGraphClient:
+    ''' Graph API client for asyncio. At most concurrency requests are in flight at once,
+        connections are kept alive per host similar to azuread_aws.http pool.
+    '''
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, resource='https://graph.microsoft.com',
+                 maxsize=None, idle_timeout=http.POOL_IDLE_TIMEOUT, timeout=http.TIMEOUT):
+        self.concurrency = concurrency
+        self.resource = resource
+        self.maxsize = maxsize or concurrency
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.counters = {'requests': 0, 'created': 0, 'reused': 0, 'reconnected': 0, 'retries': 0,
+                         'throttled': 0, 'limiter_wait': 0.0, 'bytes_wire': 0, 'bytes_decoded': 0}
+        self._idle = {}
+        self._semaphore = None
+        self._released = None
+        self._ssl = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        '''Close all idle connections'''
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for con in connections:
+                con.close()
+
+    async def token(self):
+        ''' Returns cached bearer token, refreshed in executor since azure.auth is blocking'''
+        token = auth.cached_bearer_token(self.resource)
+        if token:
+            return token
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, console.bind(tracing.bind(auth.get_bearer_token)), self.resource)
+
+    async def _acquire(self, scheme, netloc):
+        now = time.monotonic()
+        idle = self._idle.get((scheme, netloc))
+        while idle:
+            con = idle.pop()
+            if now - con.released_at < self.idle_timeout:
+                self.counters['reused'] += 1
+                return con, True
+            con.close()
+
+        url_o = urllib.parse.urlsplit(f'{scheme}://{netloc}')
+        if scheme == 'https':
+            if self._ssl is None:
+                self._ssl = ssl.create_default_context()
+            connecting = asyncio.open_connection(url_o.hostname, url_o.port or 443, ssl=self._ssl)
+        else:
+            connecting = asyncio.open_connection(url_o.hostname, url_o.port or 80)
+        # same timeout as connections of azuread_aws.http
+        reader, writer = await asyncio.wait_for(connecting, self.timeout)
+        self.counters['created'] += 1
+        return _Connection(reader, writer), False
+
+    def _release(self, scheme, netloc, con):
+        idle = self._idle.setdefault((scheme, netloc), [])
+        if len(idle) < self.maxsize:
+            con.released_at = time.monotonic()
+            idle.append(con)
+        else:
+            con.close()
+
+    async def _send(self, scheme, netloc, method, target, body, headers):
+        request = [f'{method} {target} HTTP/1.1', f'Host: {netloc}']
+        request.extend(f'{name}: {value}' for name, value in headers.items())
+        payload = ('\r\n'.join(request) + '\r\n\r\n').encode('latin-1') + body
+
+        while True:
+            con, reused = await self._acquire(scheme, netloc)
+            try:
+                con.writer.write(payload)
+                await con.writer.drain()
+                status, reason, resp_headers, data, will_close = await asyncio.wait_for(
+                    _read_response(con.reader, method), self.timeout)
+
+            except (RemoteDisconnected, ConnectionError, asyncio.IncompleteReadError) as ex:
+                con.close()
+                if not reused:
+                    raise
+                log.debug('Connection to %s was closed by server (%s), reconnecting', netloc, ex.__class__.__name__)
+                self.counters['reconnected'] += 1
+                continue
+
+            except BaseException:
+                con.close()
+                raise
+
+            if will_close:
+                con.close()
+            else:
+                self._release(scheme, netloc, con)
+            response = Response(status, reason, resp_headers, data)
+            self.counters['bytes_wire'] += len(data)
+            self.counters['bytes_decoded'] += len(response.data)
+            return response
+
+    async def _limit(self, limiter):
+        ''' Wait for a slot of the host limiter, returns seconds spent waiting'''
+        started = time.monotonic()
+        while True:
+            delay = limiter.try_acquire()
+            if delay is None:
+                return time.monotonic() - started
+            self._released.clear()
+            try:
+                # slots released by this client wake the waiters, ones of other threads are polled for
+                await asyncio.wait_for(self._released.wait(), delay or LIMITER_POLL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def call(self, method, url, data=None, params=None):
+        ''' Authenticated Graph API request, returns Response'''
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._released = asyncio.Event()
+        headers = {
+            "Authorization": "Bearer " + await self.token(),
+            "Content-Type": "application/json"
+        }
+        if http.COMPRESSION:
+            headers['Accept-Encoding'] = http.ACCEPT_ENCODING
+        body = b''
+        if data is not None:
+            body = http.encode_data(data, headers)
+        headers['Content-Length'] = len(body)
+
+        url_o = urllib.parse.urlparse(url)
+        if url_o.scheme not in ('https', 'http'):
+            raise AzureError('unsupported scheme (' + url_o.scheme + ')')
+        query = url_o.query
+        if params:
+            query = '&'.join(q for q in (query, urllib.parse.urlencode(params)) if q)
+        target = url_o.path + ('?' + query if query else '')
+        with http._counters_lock:
+            limiter = http.limiters[url_o.netloc]
+
+        attempt = 0
+        while True:
+            response = error = None
+            async with self._semaphore:
+                self.counters['limiter_wait'] += await self._limit(limiter)
+                self.counters['requests'] += 1
+                log.debug('%s %s', method, url)
+                started = time.monotonic()
+                try:
+                    response = await self._send(url_o.scheme, url_o.netloc, method, target, body, headers)
+                except (asyncio.TimeoutError, ) + http.RETRY_ERRORS as ex:
+                    error = ex
+                finally:
+                    limiter.release(throttled=response is not None and response.status in http.THROTTLE_STATUS)
+                    self._released.set()
+            if metrics.enabled:
+                metrics.record_http(method, url_o.netloc, target, response, error, time.monotonic() - started, body, attempt > 0)
+            if tracing.enabled:
+                http.trace(method, url_o.netloc, target, response, error, started, attempt, 'aio')
+
+            if attempt >= http.RETRIES or not http.retryable(method, response):
+                if error is not None:
+                    raise error
+                return response
+
+            # same retry policy as blocking http.call
+            delay = http.retry_after(response)
+            if delay is not None:
+                self.counters['throttled'] += 1
+                limiter.pause(delay)
+            else:
+                delay = http.backoff(attempt)
+            self.counters['retries'] += 1
+            log.debug('Retrying %s %s in %.2fs', method, url, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def get_json(self, url, params=None, name='get_json'):
+        response = await self.call('GET', url, params=params)
+        if response.ok:
+            return response.json
+        raise AzureError(f'{name} failed with {response.code} - {response.text}')
+
+    async def iter_values(self, url, params=None, page_size=None, name='iter_values', select=None):
+        ''' Async generator of collection items following @odata.nextLink.
+            select - Properties of the items to return, same as in graph_api functions.
+        '''
+        page = await self.get_json(url, graph_api.query(select, page_size, params), name)
+        while True:
+            for value in page['value']:
+                yield value
+            next_link = page.get('@odata.nextLink')
+            if not next_link:
+                return
+            page = await self.get_json(next_link, name=name)
+
+    async def collect(self, url, params=None, page_size=None, name='collect', select=None):
+        return [value async for value in self.iter_values(url, params, page_size, name, select)]
+
+    async def get_application(self, select=None):
+        return await self.get_json(f'{GRAPH_URL}/applications/{APP_ID}/', graph_api.query(select), name='get_application')
+
+    async def get_user(self, user_id, select=None):
+        return await self.get_json(f'{GRAPH_URL}/users/{user_id}', graph_api.query(select), name='get_user')
+
+    async def find_user_by_email(self, user_email, select=None):
+        # special graphql way of escaping single quotes
+        user_email = user_email.replace("'", "''")
+        params = graph_api.query(select, params={'$filter': f"mail eq '{user_email}'"})
+        response = await self.get_json(f'{GRAPH_URL}/users', params, name='find_user_by_email')
+        return response['value']
+
+    def iter_users(self, params=None, page_size=999, select=None):
+        return self.iter_values(f'{GRAPH_URL}/users', params, page_size, name='iter_users', select=select)
+
+    async def get_group(self, group_id, select=None):
+        return await self.get_json(f'{GRAPH_URL}/groups/{group_id}', graph_api.query(select), name='get_group')
+
+    async def find_group_by_name(self, name, select=None):
+        params = graph_api.query(select, params={'$filter': f"displayName eq '{name}'"})
+        response = await self.get_json(f'{GRAPH_URL}/groups', params, name='find_group_by_name')
+        return response['value']
+
+    def iter_groups(self, params=None, page_size=999, select=None):
+        return self.iter_values(f'{GRAPH_URL}/groups', params, page_size, name='iter_groups', select=select)
+
+    def iter_group_members(self, group_id, page_size=None, select=None):
+        return self.iter_values(f'{GRAPH_URL}/groups/{group_id}/members', page_size=page_size, name='group_members',
+                                select=select)
+
+    async def group_members(self, group_id, select=None):
+        return await self.collect(f'{GRAPH_URL}/groups/{group_id}/members', name='group_members', select=select)
+
+    async def get_user_app_roles(self, user_id, select=None):
+        return await self.collect(f'{GRAPH_URL}/users/{user_id}/appRoleAssignments', page_size=999,
+                                  name='get_user_app_roles', select=select)
+
+    async def get_group_app_roles(self, group_id, select=None):
+        return await self.collect(f'{GRAPH_URL}/groups/{group_id}/appRoleAssignments', page_size=999,
+                                  name='get_group_app_roles', select=select)
+
+    def iter_assigned_app_roles(self, page_size=None, select=None):
+        return self.iter_values(f'{GRAPH_URL}/servicePrincipals/{SERVICE_ID}/appRoleAssignments',
+                                page_size=page_size, name='iter_assigned_app_roles', select=select)
+
+    async def assign_user_to_app_role(self, user_id, app_role_id):
+        data = {
+            'principalId': user_id,
+            'resourceId': SERVICE_ID,
+            'appRoleId': app_role_id
+        }
+        response = await self.call('POST', f'{GRAPH_URL}/users/{user_id}/appRoleAssignments', data=data)
+        if response.ok:
+            return response.json
+        raise AzureError(f'assign_user_to_app_role failed with {response.code} - {response.text}')
+
+    async def remove_user_from_app_role(self, user_id, assignment_id):
+        response = await self.call('DELETE', f'{GRAPH_URL}/users/{user_id}/appRoleAssignments/{assignment_id}')
+        if response.ok:
+            return response
+        raise AzureError(f'remove_user_from_app_role failed with {response.code} - {response.text}')
@@ -0,0 +1,219 @@
+''' Snapshot of app role assignments of the AWS service principal (appRoleAssignedTo),
+    kept in the directory mirror database next to users and groups.
+
+    Graph has no delta query for appRoleAssignedTo. A full refresh pages through the collection
+    with a compact $select of the stored properties and applies the difference by assignment id.
+    Assignments are never updated in place, only created and deleted, so unchanged rows are not rewritten.
+    Next refreshes re-read only assignments of users and groups updated or removed by the delta syncs
+    of the mirror since the previous refresh. Assignments made to principals the delta does not report
+    are picked up by a full refresh, done when the last one is older than AZURE_ASSIGNMENTS_FULL_AGE
+    seconds (default 86400), when users or groups were downloaded again or too many of them changed.
+    App roles of the application are stored with the snapshot to query assignments by AWS account.
+'''
+import os
+import time
+import logging
+
+from azuread_aws import fanout
+from azuread_aws.azure import graph_api
+from azuread_aws.azure import directory
+from azuread_aws.azure.catalog import AppRoleCatalog, APPLICATION_FIELDS
+from azuread_aws.azure.constants import SERVICE_ID
+
+log = logging.getLogger('azure.assignments')
+
+COLLECTION = 'appRoleAssignedTo'
+FULL_REFRESH_AGE = int(os.getenv('AZURE_ASSIGNMENTS_FULL_AGE', '86400'))
+# above this number of changed principals paging through the collection is cheaper
+MAX_CHANGED_PRINCIPALS = 1000
+# collections of the mirror whose objects can be assigned, principals of other types are refreshed by full refresh
+PRINCIPALS = ('users', 'groups')
+# (Graph property, column) of stored assignments
+FIELDS = (
+    ('id', 'id'),
+    ('appRoleId', 'app_role_id'),
+    ('principalId', 'principal_id'),
+    ('principalType', 'principal_type'),
+    ('principalDisplayName', 'principal_name'),
+    ('createdDateTime', 'created'),
+)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS assignments (
+    id TEXT PRIMARY KEY,
+    app_role_id TEXT NOT NULL,
+    principal_id TEXT NOT NULL,
+    principal_type TEXT,
+    principal_name TEXT,
+    created TEXT
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS assignments_principal_id ON assignments (principal_id);
+CREATE INDEX IF NOT EXISTS assignments_app_role_id ON assignments (app_role_id);
+CREATE TABLE IF NOT EXISTS app_roles (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    aws_role_name TEXT,
+    account_id TEXT,
+    role_arn TEXT
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS app_roles_account_id ON app_roles (account_id);
+CREATE INDEX IF NOT EXISTS app_roles_name ON app_roles (name);
+'''
+
+# paths of databases with the schema created
+_prepared = set()
+
+
+def connect(path=None):
+    db = directory.connect(path)
+    # connections are per thread, ids of closed ones are reused by new connections
+    key = os.path.abspath(path or directory.DB_PATH)
+    if key not in _prepared:
+        db.executescript(SCHEMA)
+        _prepared.add(key)
+    return db
+
+
+def store_catalog(db, catalog):
+    '''Replace stored app roles with the ones of the catalog'''
+    db.execute('DELETE FROM app_roles')
+    db.executemany('INSERT INTO app_roles (id, name, aws_role_name, account_id, role_arn) VALUES (?, ?, ?, ?, ?)',
+                   ((info.id, info.name, info.aws_role_name, info.account_id, info.role_arn) for info in catalog))
+
+
+def _changed_principals(db):
+    ''' Returns dict of principal id to the mirror collection of users and groups changed since
+        the last refresh, or None if the whole collection has to be read
+    '''
+    state = directory.sync_state(db, COLLECTION)
+    full = directory.sync_state(db, f'{COLLECTION}:full')
+    if state is None or full is None or time.time() - full[1] > FULL_REFRESH_AGE:
+        return None
+    principals = {}
+    for collection in PRINCIPALS:
+        # changes are not recorded by the first or a full sync of the mirror
+        if directory.sync_state(db, collection) is None or directory.full_synced_at(db, collection) >= state[1]:
+            return None
+        principals.update((object_id, collection) for object_id in directory.changes(db, collection, state[1]))
+        if len(principals) > MAX_CHANGED_PRINCIPALS:
+            return None
+    return principals
+
+
+def _insert_statement():
+    columns = ', '.join(column for _, column in FIELDS)
+    return f'INSERT OR REPLACE INTO assignments ({columns}) VALUES ({", ".join("?" * len(FIELDS))})'
+
+
+def _refresh_all(db, auth_token, known):
+    ''' Page through the collection, only assignments missing in known ids are inserted.
+        Returns tuple of (added, removed) assignments.
+    '''
+    insert = _insert_statement()
+    if not known:
+        db.execute('DELETE FROM assignments')
+    added = 0
+    assignments = graph_api.iter_app_role_assigned_to(auth_token, prefetch=True, select=[prop for prop, _ in FIELDS])
+    for assignment in assignments:
+        if assignment['id'] in known:
+            known.discard(assignment['id'])
+            continue
+        db.execute(insert, [assignment.get(prop) for prop, _ in FIELDS])
+        added += 1
+    # ids left are no longer returned by Graph
+    db.executemany('DELETE FROM assignments WHERE id = ?', ((assignment_id,) for assignment_id in known))
+    return added, len(known)
+
+
+def _refresh_principals(db, auth_token, principals):
+    ''' Replace stored assignments of the principals with their current ones,
+        assignments of principals removed from the mirror are deleted.
+        Returns tuple of (added, removed) assignments.
+    '''
+    select = [prop for prop, _ in FIELDS] + ['resourceId']
+    present = set()
+    for principal_id, collection in principals.items():
+        if db.execute(f'SELECT 1 FROM {collection} WHERE id = ?', (principal_id,)).fetchone():
+            present.add(principal_id)
+
+    def fetch(principal_id):
+        if principal_id not in present:
+            return []
+        iterate = graph_api.iter_user_app_roles if principals[principal_id] == 'users' else graph_api.iter_group_app_roles
+        # assignments of the principal to other applications are returned as well
+        return [a for a in iterate(auth_token, principal_id, select=select) if a.get('resourceId') == SERVICE_ID]
+
+    insert = _insert_statement()
+    added = removed = 0
+    for result in fanout.run(fetch, principals):
+        if not result.ok:
+            raise result.error
+        stored = set(assignment_id for assignment_id, in db.execute('SELECT id FROM assignments WHERE principal_id = ?',
+                                                                    (result.key,)))
+        current = set(assignment['id'] for assignment in result.value)
+        # display name of the principal may have changed, so its current assignments are all written
+        db.executemany(insert, ([assignment.get(prop) for prop, _ in FIELDS] for assignment in result.value))
+        db.executemany('DELETE FROM assignments WHERE id = ?', ((assignment_id,) for assignment_id in stored - current))
+        added += len(current - stored)
+        removed += len(stored - current)
+    return added, removed
+
+
+def refresh(auth_token, full=False, path=None):
+    ''' Bring the snapshot up to date with Graph, returns tuple of (added, removed) assignments'''
+    db = connect(path)
+    catalog = AppRoleCatalog.from_application(graph_api.get_application(auth_token, select=APPLICATION_FIELDS))
+    started = time.time()
+    principals = None if full else _changed_principals(db)
+    known = set()
+    if principals is None and not full and directory.sync_state(db, COLLECTION):
+        known = set(assignment_id for assignment_id, in db.execute('SELECT id FROM assignments'))
+
+    with db:
+        store_catalog(db, catalog)
+        if principals is None:
+            log.debug('Reading all app role assignments')
+            added, removed = _refresh_all(db, auth_token, known)
+            db.execute('INSERT OR REPLACE INTO sync_state (collection, delta_link, synced_at) VALUES (?, NULL, ?)',
+                       (f'{COLLECTION}:full', started))
+        else:
+            log.debug('Reading app role assignments of %d changed principals', len(principals))
+            added, removed = _refresh_principals(db, auth_token, principals)
+        db.execute('INSERT OR REPLACE INTO sync_state (collection, delta_link, synced_at) VALUES (?, NULL, ?)',
+                   (COLLECTION, started))
+    return added, removed
+
+
+def refreshed_at(path=None):
+    '''Returns time of the last refresh or None if the snapshot was never refreshed'''
+    state = directory.sync_state(connect(path), COLLECTION)
+    return state[1] if state else None
+
+
+def query(principal_id=None, app_role_id=None, account_id=None, app_role_name=None, path=None):
+    ''' Yields stored assignments as Graph objects, with accountId and appRoleName of the app role.
+        Filters are combined, assignments of all principals and roles are returned without them.
+    '''
+    filters = (
+        ('a.principal_id', principal_id),
+        ('a.app_role_id', app_role_id),
+        ('r.account_id', account_id),
+        ('r.name', app_role_name),
+    )
+    conditions, args = [], []
+    for column, value in filters:
+        if value is not None:
+            conditions.append(f'{column} = ?')
+            args.append(value)
+    columns = ', '.join(f'a.{column}' for _, column in FIELDS)
+    sql = f'SELECT {columns}, r.account_id, r.name FROM assignments a LEFT JOIN app_roles r ON r.id = a.app_role_id'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    for row in connect(path).execute(sql, args):
+        assignment = {prop: value for (prop, _), value in zip(FIELDS, row)}
+        assignment['accountId'], assignment['appRoleName'] = row[-2], row[-1]
+        yield assignment
+
+
+def count(path=None):
+    return connect(path).execute('SELECT COUNT(*) FROM assignments').fetchone()[0]
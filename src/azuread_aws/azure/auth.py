@@ -1,6 +1,11 @@
+import os
+import time
 import logging
+import threading
+
 from azuread_aws import http
-from azuread_aws.azure.constants import TENANT_ID, CLIENT_ID, CLIENT_SECRET
+from azuread_aws import cache
+from azuread_aws.azure.constants import TENANT_ID, CLIENT_ID, CLIENT_SECRET, LOGIN_URL
 from azuread_aws.azure import AzureError
 
 # Resource
@@ -9,23 +14,111 @@ from azuread_aws.azure import AzureError
 
 log = logging.getLogger('azure.auth')
 
+# Tokens are refreshed this many seconds before they expire
+REFRESH_MARGIN = int(os.getenv('AZURE_TOKEN_REFRESH_MARGIN', '300'))
+TOKEN_CACHE_FILE = 'tokens.json'
 
-def get_bearer_token(resource):
+# (tenant, client, resource) -> (access token, expires at unix time)
+_tokens = {}
+_token_locks = {}
+_lock = threading.Lock()
+
+
+def _token_lock(key):
+    with _lock:
+        return _token_locks.setdefault(key, threading.Lock())
+
+
+def _disk_key(key):
+    return '|'.join(key)
+
+
+def _valid(entry):
+    return entry is not None and entry[1] - REFRESH_MARGIN > time.time()
+
+
+def _cached_token(key):
+    entry = _tokens.get(key)
+    if _valid(entry):
+        return entry[0]
+
+    stored = cache.load_json(TOKEN_CACHE_FILE, {}).get(_disk_key(key))
+    if stored:
+        entry = (stored['access_token'], stored['expires_on'])
+        if _valid(entry):
+            log.debug('Using bearer token for %s from disk cache', key[2])
+            _tokens[key] = entry
+            return entry[0]
+    return None
+
+
+def _store_token(key, access_token, expires_on):
+    _tokens[key] = (access_token, expires_on)
+    if cache.enabled():
+        tokens = cache.load_json(TOKEN_CACHE_FILE, {})
+        now = time.time()
+        tokens = {k: v for k, v in tokens.items() if v.get('expires_on', 0) > now}
+        tokens[_disk_key(key)] = {'access_token': access_token, 'expires_on': expires_on}
+        cache.save_json(TOKEN_CACHE_FILE, tokens)
+
+
+def clear_tokens():
+    '''Forget all cached tokens, both in memory and on disk'''
+    _tokens.clear()
+    cache.remove(TOKEN_CACHE_FILE)
+
+
+def request_bearer_token(resource):
+    '''Runs client credentials exchange, returns tuple of (access token, expires at unix time)'''
     if not TENANT_ID or not CLIENT_ID or not CLIENT_SECRET:
         raise AzureError('Missing authentication.')
 
-    url = "https://login.microsoftonline.com/{0}/oauth2/token".format(TENANT_ID)
+    url = "{0}/{1}/oauth2/token".format(LOGIN_URL, TENANT_ID)
     payload = {
         'grant_type': 'client_credentials',
         'client_id': CLIENT_ID,
         'client_secret': CLIENT_SECRET,
         'resource': resource
     }
+    requested_at = time.time()
     response = http.post(url, data=payload, headers={'Content-Type': 'application/x-www-form-urlencoded'})
     if response.ok:
         log.debug('Authentication response: %s', response.text)
         if 'access_token' not in response.json:
             raise AzureError(f'Unexpected response in get_bearer_token - {response}')
-        # return actual token
-        return response.json['access_token']
+        if 'expires_on' in response.json:
+            expires_on = int(response.json['expires_on'])
+        else:
+            expires_on = requested_at + int(response.json.get('expires_in', 0))
+        return response.json['access_token'], expires_on
     raise AzureError(f'get_bearer_token failed with {response.code} - {response.text}')
+
+
+def cached_bearer_token(resource):
+    '''Returns cached bearer token for the resource if it is still valid, None otherwise'''
+    if not TENANT_ID or not CLIENT_ID:
+        return None
+    return _cached_token((TENANT_ID, CLIENT_ID, resource))
+
+
+def get_bearer_token(resource):
+    ''' Returns bearer token for the resource, cached per (tenant, client, resource) until
+        shortly before it expires. Concurrent callers wait for a single token refresh.
+    '''
+    if not TENANT_ID or not CLIENT_ID or not CLIENT_SECRET:
+        raise AzureError('Missing authentication.')
+
+    key = (TENANT_ID, CLIENT_ID, resource)
+    token = _cached_token(key)
+    if token:
+        return token
+
+    with _token_lock(key):
+        # another thread might have refreshed it while we waited
+        token = _cached_token(key)
+        if token:
+            return token
+        access_token, expires_on = request_bearer_token(resource)
+        _store_token(key, access_token, expires_on)
+        log.debug('Acquired bearer token for %s valid for %d seconds', resource, expires_on - time.time())
+        return access_token
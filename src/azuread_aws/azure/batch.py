@@ -0,0 +1,232 @@
+''' Microsoft Graph JSON batching.
+    Queued requests are sent with POST /$batch in groups of up to 20 sub-requests.
+    Sub-requests throttled with 429 are retried individually after Retry-After delay,
+    a throttled batch as a whole is retried by azuread_aws.http like any other request,
+    requests chained with dependsOn are always sent within the same batch.
+
+    with batch.GraphBatch(token) as b:
+        pending = [graph_api.get_user(token, user_id, batch=b) for user_id in user_ids]
+    users = [p.result() for p in pending]
+'''
+import json
+import time
+import logging
+
+from azuread_aws import http
+from azuread_aws.azure import AzureError
+from azuread_aws.azure.constants import GRAPH_URL
+
+log = logging.getLogger('azure.batch')
+
+BATCH_URL = f'{GRAPH_URL}/$batch'
+MAX_BATCH_SIZE = 20
+MAX_RETRIES = 5
+# sub-responses which are retried: throttling always, server errors only for reads
+THROTTLED = 429
+RETRY_READ_STATUS = (500, 502, 503, 504)
+FAILED_DEPENDENCY = 424
+
+
+def retry_delay(response):
+    '''Seconds to wait before retrying the throttled response, Retry-After is seconds or HTTP date'''
+    delay = http.retry_after(response)
+    return 1 if delay is None else delay
+
+
+class BatchResponse:
+    '''Sub-response of a batch with the same properties as azuread_aws.http responses'''
+
+    def __init__(self, sub_response):
+        self.status = self.status_code = self.code = sub_response['status']
+        self.reason = ''
+        self.headers = sub_response.get('headers') or {}
+        body = sub_response.get('body')
+        self.json = body if isinstance(body, (dict, list)) else None
+        self.text = body if isinstance(body, str) else json.dumps(body) if body is not None else ''
+        self.data = self.text.encode('utf-8')
+        self.ok = 200 <= self.status < 400
+
+
+class BatchRequest:
+    '''Queued sub-request. Result is available once the batch was executed.'''
+
+    def __init__(self, batch, request_id, method, url, handler, body=None, depends_on=None):
+        self.batch = batch
+        self.id = request_id
+        self.method = method
+        self.url = url
+        self.handler = handler
+        self.body = body
+        self.depends_on = depends_on or []
+        self.attempts = 0
+        self.done = False
+        self._value = None
+        self._error = None
+
+    def payload(self, batch_ids):
+        request = {'id': self.id, 'method': self.method, 'url': self.url}
+        if self.body is not None:
+            request['body'] = self.body
+            request['headers'] = {'Content-Type': 'application/json'}
+        # dependencies completed in an earlier batch are dropped
+        depends_on = [r.id for r in self.depends_on if r.id in batch_ids]
+        if depends_on:
+            request['dependsOn'] = depends_on
+        return request
+
+    def resolve(self, response):
+        self.done = True
+        try:
+            self._value = self.handler(response)
+        except Exception as ex:
+            self._error = ex
+
+    def fail(self, error):
+        self.done = True
+        self._error = error
+
+    def result(self):
+        '''Returns value of the queued call or raises its error, executes the batch if needed'''
+        if not self.done:
+            self.batch.execute()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class GraphBatch:
+    ''' Queue of Graph API calls sent with JSON batching. Functions of graph_api accepting
+        batch argument return BatchRequest instead of the result when the batch is given.
+    '''
+
+    def __init__(self, auth_token, batch_size=MAX_BATCH_SIZE, max_retries=MAX_RETRIES):
+        if batch_size > MAX_BATCH_SIZE:
+            raise AzureError(f'Graph batches are limited to {MAX_BATCH_SIZE} requests')
+        self.auth_token = auth_token
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self._queue = []
+        self._next_id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.execute()
+
+    def add(self, method, url, handler, body=None, depends_on=None):
+        ''' Queue a request. url is absolute or relative to the Graph v1.0 endpoint,
+            depends_on is a list of BatchRequest which must succeed before this one is executed.
+        '''
+        if url.startswith(GRAPH_URL):
+            url = url[len(GRAPH_URL):]
+        self._next_id += 1
+        request = BatchRequest(self, str(self._next_id), method, url, handler, body, depends_on)
+        self._queue.append(request)
+        return request
+
+    def _chains(self, requests):
+        '''Group requests connected by dependsOn, keeping queue order'''
+        group_of = {}
+        groups = []
+        for request in requests:
+            group = None
+            for parent in request.depends_on:
+                parent_group = group_of.get(parent.id)
+                if parent_group is None or parent_group is group:
+                    continue
+                if group is None:
+                    group = parent_group
+                else:
+                    # request joins two chains, merge them
+                    group.extend(parent_group)
+                    for merged in parent_group:
+                        group_of[merged.id] = group
+                    groups.remove(parent_group)
+            if group is None:
+                group = []
+                groups.append(group)
+            group.append(request)
+            group_of[request.id] = group
+        return groups
+
+    def _batches(self, requests):
+        '''Pack dependency chains into batches of batch_size requests'''
+        batches = []
+        for chain in self._chains(requests):
+            if len(chain) > self.batch_size:
+                raise AzureError(f'Chain of {len(chain)} dependent requests does not fit into a batch')
+            for batch in batches:
+                if len(batch) + len(chain) <= self.batch_size:
+                    batch.extend(chain)
+                    break
+            else:
+                batches.append(list(chain))
+        return batches
+
+    def execute(self):
+        '''Send all queued requests, retrying throttled sub-requests'''
+        pending, self._queue = self._queue, []
+        while pending:
+            retry = []
+            delay = 0
+            for batch in self._batches(pending):
+                batch_retry, batch_delay = self._send(batch)
+                retry.extend(batch_retry)
+                delay = max(delay, batch_delay)
+            if retry:
+                log.debug('Retrying %d throttled batch requests in %.2f seconds', len(retry), delay)
+                time.sleep(delay)
+            pending = retry
+
+    def _send(self, batch):
+        ''' Send one batch, resolves completed requests.
+            Returns list of requests to be retried and delay before the retry.
+        '''
+        batch_ids = set(r.id for r in batch)
+        by_id = {r.id: r for r in batch}
+        headers = {
+            "Authorization": "Bearer " + self.auth_token,
+            "Content-Type": "application/json"
+        }
+        data = {'requests': [r.payload(batch_ids) for r in batch]}
+        for request in batch:
+            request.attempts += 1
+
+        # 429 of the whole batch is already retried by http.request
+        response = http.post(BATCH_URL, headers=headers, data=data)
+        if not response.ok:
+            error = AzureError(f'batch request failed with {response.code} - {response.text}')
+            for request in batch:
+                request.fail(error)
+            return [], 0
+
+        retry = set()
+        delay = 0
+        sub_responses = {sub['id']: BatchResponse(sub) for sub in response.json['responses']}
+        for request_id, sub_response in sub_responses.items():
+            request = by_id[request_id]
+            retryable = sub_response.status == THROTTLED or \
+                (request.method == 'GET' and sub_response.status in RETRY_READ_STATUS)
+            if retryable and request.attempts <= self.max_retries:
+                retry.add(request_id)
+                delay = max(delay, retry_delay(sub_response))
+
+        # requests which failed only because their dependency is retried are retried as well
+        for request_id, sub_response in sub_responses.items():
+            request = by_id[request_id]
+            if sub_response.status == FAILED_DEPENDENCY and self._depends_on_retry(request, retry):
+                retry.add(request_id)
+
+        for request in batch:
+            if request.id in retry:
+                continue
+            if request.id in sub_responses:
+                request.resolve(sub_responses[request.id])
+            else:
+                request.fail(AzureError(f'batch response is missing request {request.id} {request.method} {request.url}'))
+        return [r for r in batch if r.id in retry], delay
+
+    def _depends_on_retry(self, request, retry):
+        return any(parent.id in retry or self._depends_on_retry(parent, retry) for parent in request.depends_on)
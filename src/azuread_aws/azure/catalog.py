@@ -0,0 +1,123 @@
+''' Index of the AWS application app roles with constant time lookups.
+    AWS app roles keep "<aws role name>@<account id>" in description and
+    "<iam role arn>,<saml provider arn>" in value, both are parsed once when a role is indexed.
+'''
+import logging
+
+log = logging.getLogger('azure.catalog')
+
+# application properties needed to build the catalog and update app roles
+APPLICATION_FIELDS = ('id', 'appRoles')
+
+
+class AppRoleInfo:
+    '''App role with parsed AWS fields. Fields are None if the role does not follow AWS format.'''
+    __slots__ = ('app_role', 'id', 'name', 'aws_role_name', 'account_id', 'role_arn', 'provider_arn')
+
+    def __init__(self, app_role):
+        self.app_role = app_role
+        self.id = app_role['id']
+        self.name = app_role['displayName']
+        self.aws_role_name = self.account_id = self.role_arn = self.provider_arn = None
+        description = app_role.get('description') or ''
+        if '@' in description:
+            self.aws_role_name, self.account_id = description.split('@', 1)
+        value = app_role.get('value') or ''
+        if ',' in value:
+            self.role_arn, self.provider_arn = value.split(',', 1)
+
+    @property
+    def is_aws(self):
+        return self.account_id is not None
+
+
+class AppRoleCatalog:
+    ''' App roles of the application indexed by id, display name, (aws role name, account id)
+        and IAM role ARN. Built once per manifest, kept in sync with add and remove.
+    '''
+
+    def __init__(self, app_roles=()):
+        self.by_id = {}
+        self.by_name = {}
+        self.by_aws = {}
+        self.by_arn = {}
+        self.by_aws_name = {}
+        # all roles of a key of by_name, by_aws and by_arn in insertion order, the first one is indexed
+        self._same_key = {}
+        for app_role in app_roles:
+            self.add(app_role)
+
+    @classmethod
+    def from_application(cls, application):
+        return cls(application['appRoles'])
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        return iter(self.by_id.values())
+
+    def __contains__(self, app_role_id):
+        return app_role_id in self.by_id
+
+    def add(self, app_role):
+        ''' Index app role, returns its AppRoleInfo.
+            Of roles sharing a display name, AWS role or ARN the first added one is found,
+            the same as by a scan of the manifest.
+        '''
+        info = AppRoleInfo(app_role)
+        self.remove(info.id)
+        self.by_id[info.id] = info
+        self._index('by_name', info.name, info)
+        if info.is_aws:
+            self._index('by_aws', (info.aws_role_name, info.account_id), info)
+            self.by_aws_name.setdefault(info.aws_role_name, []).append(info)
+        if info.role_arn:
+            self._index('by_arn', info.role_arn, info)
+        return info
+
+    def remove(self, app_role_id):
+        '''Remove app role from indexes, returns its AppRoleInfo or None if not indexed'''
+        info = self.by_id.pop(app_role_id, None)
+        if info is None:
+            return None
+        self._unindex('by_name', info.name, info)
+        if info.is_aws:
+            self._unindex('by_aws', (info.aws_role_name, info.account_id), info)
+            same_name = self.by_aws_name[info.aws_role_name]
+            same_name.remove(info)
+            if not same_name:
+                del self.by_aws_name[info.aws_role_name]
+        if info.role_arn:
+            self._unindex('by_arn', info.role_arn, info)
+        return info
+
+    def _index(self, name, key, info):
+        self._same_key.setdefault((name, key), []).append(info)
+        getattr(self, name).setdefault(key, info)
+
+    def _unindex(self, name, key, info):
+        '''Drop info from the index, another role with the same key takes its place'''
+        index = getattr(self, name)
+        same_key = self._same_key[(name, key)]
+        same_key.remove(info)
+        if not same_key:
+            del self._same_key[(name, key)]
+            del index[key]
+        elif index[key] is info:
+            index[key] = same_key[0]
+
+    def get(self, app_role_id):
+        return self.by_id.get(app_role_id)
+
+    def find_by_name(self, display_name):
+        return self.by_name.get(display_name)
+
+    def find_by_aws(self, aws_role_name, account_id):
+        return self.by_aws.get((aws_role_name, account_id))
+
+    def find_by_arn(self, role_arn):
+        return self.by_arn.get(role_arn)
+
+    def find_by_aws_name(self, aws_role_name):
+        return list(self.by_aws_name.get(aws_role_name, ()))
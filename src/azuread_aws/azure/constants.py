@@ -10,3 +10,7 @@ CLIENT_SECRET = os.getenv("AZURE_APP_CLIENT_SECRET")
 APP_ID = os.getenv("AZURE_APP_ID")
 SERVICE_ID = os.getenv("AZURE_SERVICE_ID")
 DOMAIN = os.getenv("AZURE_DOMAIN")
+
+# Endpoints can be changed for national clouds or local test servers
+GRAPH_URL = os.getenv("AZURE_GRAPH_URL", "https://graph.microsoft.com/v1.0")
+LOGIN_URL = os.getenv("AZURE_LOGIN_URL", "https://login.microsoftonline.com")
@@ -0,0 +1,261 @@
+''' Local mirror of Azure AD users and groups in SQLite, populated with Graph delta queries.
+    Mirror is opt-in: set AAD_AWS_DIRECTORY_DB to the database file and run "aad-aws directory sync"
+    periodically. The first sync downloads all users and groups, next ones apply only changes
+    since the stored deltaLink.
+
+    graph_api lookups by id, mail, userPrincipalName and displayName selecting only mirrored properties
+    are answered from the mirror if the last sync is not older than AZURE_DIRECTORY_MAX_AGE seconds
+    (default 3600), and go to Graph otherwise.
+'''
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+
+from azuread_aws import http
+from azuread_aws.azure import AzureError
+from azuread_aws.azure.constants import GRAPH_URL
+
+log = logging.getLogger('azure.directory')
+
+DB_PATH = os.getenv('AAD_AWS_DIRECTORY_DB')
+MAX_AGE = int(os.getenv('AZURE_DIRECTORY_MAX_AGE', '3600'))
+
+# properties kept in the mirror
+USER_FIELDS = ('id', 'displayName', 'mail', 'userPrincipalName', 'givenName', 'surname', 'accountEnabled')
+GROUP_FIELDS = ('id', 'displayName', 'mail', 'description', 'mailEnabled', 'securityEnabled')
+COLLECTIONS = {
+    'users': USER_FIELDS,
+    'groups': GROUP_FIELDS,
+}
+# indexed property -> column of the collection table
+INDEXED = {
+    'users': {'mail': 'mail', 'userPrincipalName': 'user_principal_name', 'displayName': 'display_name'},
+    'groups': {'mail': 'mail', 'displayName': 'display_name'},
+}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sync_state (
+    collection TEXT PRIMARY KEY,
+    delta_link TEXT,
+    synced_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    mail TEXT COLLATE NOCASE,
+    user_principal_name TEXT COLLATE NOCASE,
+    display_name TEXT COLLATE NOCASE,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_mail ON users (mail);
+CREATE INDEX IF NOT EXISTS users_user_principal_name ON users (user_principal_name);
+CREATE INDEX IF NOT EXISTS users_display_name ON users (display_name);
+CREATE TABLE IF NOT EXISTS groups (
+    id TEXT PRIMARY KEY,
+    mail TEXT COLLATE NOCASE,
+    display_name TEXT COLLATE NOCASE,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS groups_mail ON groups (mail);
+CREATE INDEX IF NOT EXISTS groups_display_name ON groups (display_name);
+CREATE TABLE IF NOT EXISTS changes (
+    collection TEXT NOT NULL,
+    id TEXT NOT NULL,
+    changed_at REAL NOT NULL,
+    PRIMARY KEY (collection, id)
+) WITHOUT ROWID;
+'''
+
+_local = threading.local()
+
+
+class DeltaExpired(AzureError):
+    '''Stored deltaLink is no longer accepted by Graph, full sync is required'''
+
+
+def enabled(path=None):
+    path = path or DB_PATH
+    return bool(path) and os.path.exists(path)
+
+
+def connect(path=None):
+    ''' Returns SQLite connection of the current thread, creating the database if needed'''
+    path = path or DB_PATH
+    if not path:
+        raise Exception('Directory mirror is disabled, set AAD_AWS_DIRECTORY_DB to the database file')
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    db = connections.get(path)
+    if db is None:
+        # directory data is readable by the current user only, same as the cache files
+        os.close(os.open(path, os.O_CREAT | os.O_RDWR, 0o600))
+        db = sqlite3.connect(path, timeout=30)
+        # readers are not blocked while sync is writing
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript(SCHEMA)
+        connections[path] = db
+    return db
+
+
+def sync_state(db, collection):
+    ''' Returns tuple of (delta link, synced at) of the collection or None if never synced'''
+    return db.execute('SELECT delta_link, synced_at FROM sync_state WHERE collection = ?', (collection,)).fetchone()
+
+
+def _fields(select):
+    if not select:
+        return None
+    return tuple(select.split(',')) if isinstance(select, str) else tuple(select)
+
+
+def _project(data, fields):
+    return {field: data.get(field) for field in fields}
+
+
+def _reader(collection, select, max_age):
+    ''' Returns connection if the mirror can answer the query, None otherwise'''
+    if not enabled():
+        return None
+    fields = _fields(select)
+    # only some properties are mirrored, full objects are read from Graph
+    if not fields or not set(fields).issubset(COLLECTIONS[collection]):
+        return None
+    db = connect()
+    state = sync_state(db, collection)
+    max_age = MAX_AGE if max_age is None else max_age
+    if state is None or time.time() - state[1] > max_age:
+        log.debug('Directory mirror of %s is stale, using Graph', collection)
+        return None
+    return db
+
+
+def find(collection, prop, value, select=None, max_age=None):
+    ''' Returns mirrored objects with the indexed property equal to value ignoring case,
+        or None if the mirror is disabled, older than max_age seconds or does not keep the select properties.
+        Properties to return must be selected, the mirror does not keep full objects.
+    '''
+    db = _reader(collection, select, max_age)
+    if db is None:
+        return None
+    column = INDEXED[collection][prop]
+    rows = db.execute(f'SELECT data FROM {collection} WHERE {column} = ?', (value,))
+    return [_project(json.loads(data), _fields(select)) for data, in rows]
+
+
+def get(collection, object_id, select=None, max_age=None):
+    ''' Returns mirrored object by id, or None if not mirrored or the mirror can not be used as in find()'''
+    db = _reader(collection, select, max_age)
+    if db is None:
+        return None
+    row = db.execute(f'SELECT data FROM {collection} WHERE id = ?', (object_id,)).fetchone()
+    return _project(json.loads(row[0]), _fields(select)) if row else None
+
+
+def _delta_pages(auth_token, url, params=None):
+    headers = {
+        "Authorization": "Bearer " + auth_token,
+        "Content-Type": "application/json",
+        # updated objects are returned with changed properties only
+        "Prefer": "return=minimal"
+    }
+    while url:
+        response = http.get(url, headers=headers, params=params)
+        if response.status_code == 410:
+            raise DeltaExpired(f'delta sync expired with {response.code} - {response.text}')
+        if not response.ok:
+            raise AzureError(f'delta sync failed with {response.code} - {response.text}')
+        page = response.json
+        yield page
+        url = page.get('@odata.nextLink')
+        params = None
+
+
+def full_synced_at(db, collection):
+    ''' Returns time of the last full sync of the collection, 0 if not known'''
+    state = sync_state(db, f'{collection}:full')
+    return state[1] if state else 0
+
+
+def changes(db, collection, since):
+    ''' Returns ids of objects updated or removed by incremental syncs of the collection started since the time'''
+    return [object_id for object_id, in db.execute('SELECT id FROM changes WHERE collection = ? AND changed_at >= ?',
+                                                   (collection, since))]
+
+
+def _apply(db, collection, items, changed_at=None):
+    ''' Apply delta items to the collection table, returns tuple of (upserted, removed).
+        Ids of the items are recorded in changes with changed_at time if given.
+    '''
+    columns = INDEXED[collection]
+    names = ', '.join(['id', 'data'] + list(columns.values()))
+    insert = f'INSERT OR REPLACE INTO {collection} ({names}) VALUES ({", ".join("?" * (len(columns) + 2))})'
+    upserted = removed = 0
+    for item in items:
+        if changed_at is not None:
+            db.execute('INSERT OR REPLACE INTO changes (collection, id, changed_at) VALUES (?, ?, ?)',
+                       (collection, item['id'], changed_at))
+        if '@removed' in item:
+            db.execute(f'DELETE FROM {collection} WHERE id = ?', (item['id'],))
+            removed += 1
+            continue
+        # the same object may come more than once and updates carry changed properties only
+        row = db.execute(f'SELECT data FROM {collection} WHERE id = ?', (item['id'],)).fetchone()
+        data = json.loads(row[0]) if row else {}
+        data.update((k, v) for k, v in item.items() if '@' not in k and k in COLLECTIONS[collection])
+        db.execute(insert, [data['id'], json.dumps(data)] + [data.get(prop) for prop in columns])
+        upserted += 1
+    return upserted, removed
+
+
+def sync(auth_token, collection, full=False, path=None):
+    ''' Bring mirror of users or groups up to date. Changes since the last sync are applied
+        with the stored deltaLink, all objects are downloaded on the first or full sync.
+        Returns tuple of (upserted, removed) objects.
+    '''
+    db = connect(path)
+    state = None if full else sync_state(db, collection)
+    started = time.time()
+    if state and state[0]:
+        url, params = state[0], None
+        log.debug('Applying changes of %s since %s', collection, time.ctime(state[1]))
+    else:
+        url, params = f'{GRAPH_URL}/{collection}/delta', {'$select': ','.join(COLLECTIONS[collection])}
+        log.debug('Downloading all %s', collection)
+
+    upserted = removed = 0
+    delta_link = None
+    try:
+        with db:
+            if params is not None:
+                db.execute(f'DELETE FROM {collection}')
+                # every object is new to readers of changes, they have to start over as well
+                db.execute('DELETE FROM changes WHERE collection = ?', (collection,))
+                db.execute('INSERT OR REPLACE INTO sync_state (collection, delta_link, synced_at) VALUES (?, NULL, ?)',
+                           (f'{collection}:full', started))
+            for page in _delta_pages(auth_token, url, params):
+                counts = _apply(db, collection, page['value'], None if params is not None else started)
+                upserted += counts[0]
+                removed += counts[1]
+                delta_link = page.get('@odata.deltaLink', delta_link)
+            db.execute('INSERT OR REPLACE INTO sync_state (collection, delta_link, synced_at) VALUES (?, ?, ?)',
+                       (collection, delta_link, started))
+    except DeltaExpired:
+        if params is not None:
+            raise
+        log.warning('Stored deltaLink of %s has expired, downloading all %s', collection, collection)
+        return sync(auth_token, collection, full=True, path=path)
+    return upserted, removed
+
+
+def info(path=None):
+    ''' Returns dict of collection name to tuple of (objects count, synced at or None)'''
+    db = connect(path)
+    result = {}
+    for collection in COLLECTIONS:
+        count, = db.execute(f'SELECT COUNT(*) FROM {collection}').fetchone()
+        state = sync_state(db, collection)
+        result[collection] = (count, state[1] if state else None)
+    return result
@@ -1,14 +1,40 @@
 
+import json
 import uuid
 import logging
+import urllib.parse
+import concurrent.futures
 
 from azuread_aws import http
-from azuread_aws.azure.constants import APP_ID, SERVICE_ID
+from azuread_aws import console
+from azuread_aws import tracing
+from azuread_aws.azure.constants import APP_ID, SERVICE_ID, GRAPH_URL
 from azuread_aws.azure import AzureError
+from azuread_aws.azure import manifest
+from azuread_aws.azure import directory
 
 log = logging.getLogger('azure.api')
 
 
+def query(select=None, top=None, params=None):
+    ''' Returns query parameters with optional $select projection and $top page size added.
+        select is a comma separated string or a sequence of property names.
+    '''
+    params = dict(params or {})
+    if select:
+        params['$select'] = select if isinstance(select, str) else ','.join(select)
+    if top:
+        params['$top'] = top
+    return params
+
+
+def with_query(url, params):
+    '''Returns url with encoded query parameters appended'''
+    if not params:
+        return url
+    return url + '?' + urllib.parse.urlencode(params)
+
+
 def get_next_link(auth_token, next_url):
     url = next_url
     headers = {
@@ -21,20 +47,79 @@ def get_next_link(auth_token, next_url):
     raise AzureError(f'get_next_link failed with {response.code} - {response.text}')
 
 
-def get_application(auth_token):
-    url = "https://graph.microsoft.com/v1.0/applications/{0}/".format(APP_ID)
+def iter_pages(auth_token, url, params=None, page_size=None, prefetch=False, name='iter_pages', select=None):
+    ''' Lazily yields pages of a Graph collection following @odata.nextLink.
+        * params - Query parameters of the first page, next links already include them
+        * page_size - Value of $top hint, server may return smaller pages
+        * prefetch - Request the next page in background while the current one is consumed
+        * select - Properties of the items to return, all default properties if not set
+        Stopping iteration early does not fetch remaining pages.
+    '''
     headers = {
         "Authorization": "Bearer " + auth_token,
         "Content-Type": "application/json"
     }
+    params = query(select, page_size, params)
+
+    def fetch(page_url, page_params=None):
+        response = http.get(page_url, headers=headers, params=page_params)
+        if response.ok:
+            return response.json
+        raise AzureError(f'{name} failed with {response.code} - {response.text}')
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        page = fetch(url, params)
+        while True:
+            next_link = page.get('@odata.nextLink')
+            upcoming = executor.submit(console.bind(tracing.bind(fetch)), next_link) if executor and next_link else None
+            yield page
+            if not next_link:
+                return
+            page = upcoming.result() if upcoming else fetch(next_link)
+    finally:
+        if executor:
+            executor.shutdown(wait=False)
+
+
+def iter_values(auth_token, url, params=None, page_size=None, prefetch=False, name='iter_values', select=None):
+    '''Lazily yields items of a Graph collection, see iter_pages'''
+    for page in iter_pages(auth_token, url, params, page_size, prefetch, name, select):
+        yield from page['value']
+
+
+def get_application(auth_token, use_cache=True, select=None):
+    ''' Returns AWS application object, reusing cached manifest unless use_cache is False.
+        Only select properties are returned when specified, e.g. ('id', 'appRoles').
+        Callers get their own copy and may modify it.
+    '''
+    params = query(select)
+    url = with_query(GRAPH_URL + "/applications/{0}/".format(APP_ID), params)
+    cache_key = manifest.key(APP_ID, params.get('$select'))
+    headers = {
+        "Authorization": "Bearer " + auth_token,
+        "Content-Type": "application/json"
+    }
+    cached = manifest.load(cache_key) if use_cache else None
+    if cached:
+        if manifest.fresh(cached):
+            return json.loads(cached['text'])
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+
     response = http.get(url, headers=headers)
+    if response.status_code == 304 and cached:
+        log.debug('Cached application manifest is up to date')
+        manifest.revalidated(cache_key, cached)
+        return json.loads(cached['text'])
     if response.ok:
+        manifest.store(cache_key, response.text, response.headers.get('ETag'))
         return response.json
     raise AzureError(f'get_application failed with {response.code} - {response.text}')
 
 
 def patch_application(auth_token, data):
-    url = "https://graph.microsoft.com/v1.0/applications/{0}".format(APP_ID)
+    url = GRAPH_URL + "/applications/{0}".format(APP_ID)
     headers = {
         "Authorization": "Bearer " + auth_token,
         "Content-Type": "application/json"
@@ -43,12 +128,16 @@ def patch_application(auth_token, data):
     data.pop('spa', None)
     response = http.patch(url, headers=headers, data=data)
     if response.status_code == 204:
+        manifest.invalidate(APP_ID)
         return True
     raise AzureError(f'patch_application failed with {response.code} - {response.text} for request data {data}')
 
 
-def get_app_roles_assigned_to(auth_token, url=None):
-    url = url or "https://graph.microsoft.com/v1.0/servicePrincipals/{0}/appRoleAssignments".format(SERVICE_ID)
+def get_app_roles_assigned_to(auth_token, url=None, select=None, page_size=None):
+    ''' Returns a page of assignments, next pages are requested by url with the query already included'''
+    if not url:
+        url = GRAPH_URL + "/servicePrincipals/{0}/appRoleAssignments".format(SERVICE_ID)
+        url = with_query(url, query(select, page_size))
     headers = {
         "Authorization": "Bearer " + auth_token,
         "Content-Type": "application/json"
@@ -59,29 +148,43 @@ def get_app_roles_assigned_to(auth_token, url=None):
     raise AzureError(f'get_app_roles_assigned_to failed with {response.code} - {response.text}')
 
 
-def aggregate_assigned_app_roles(auth_token, url=None, values=[]):
-    r = get_app_roles_assigned_to(auth_token, url)
-    values = values + r['value']
-    if '@odata.nextLink' in r:
-        return aggregate_assigned_app_roles(auth_token, r['@odata.nextLink'], values)
-    else:
-        return values
+def iter_assigned_app_roles(auth_token, page_size=None, prefetch=False, select=None):
+    url = GRAPH_URL + "/servicePrincipals/{0}/appRoleAssignments".format(SERVICE_ID)
+    return iter_values(auth_token, url, page_size=page_size, prefetch=prefetch, name='iter_assigned_app_roles', select=select)
+
+
+def aggregate_assigned_app_roles(auth_token, select=None, page_size=None):
+    return list(iter_assigned_app_roles(auth_token, page_size, select=select))
+
+
+def iter_app_role_assigned_to(auth_token, page_size=999, prefetch=False, select=None):
+    '''Yields assignments of users and groups to app roles of the AWS service principal'''
+    url = GRAPH_URL + "/servicePrincipals/{0}/appRoleAssignedTo".format(SERVICE_ID)
+    return iter_values(auth_token, url, page_size=page_size, prefetch=prefetch, name='iter_app_role_assigned_to', select=select)
 
 
-def get_user(auth_token, user_id):
-    url = "https://graph.microsoft.com/v1.0/users/" + user_id
+def get_user(auth_token, user_id, batch=None, select=None):
+    url = with_query(GRAPH_URL + "/users/" + user_id, query(select))
+    mirrored = directory.get('users', user_id, select) if batch is None else None
+    if mirrored is not None:
+        return mirrored
+
+    def handle(response):
+        if response.ok:
+            return response.json
+        raise AzureError(f'get_user failed with {response.code} - {response.text}')
+
+    if batch is not None:
+        return batch.add('GET', url, handle)
     headers = {
         "Authorization": "Bearer " + auth_token,
         "Content-Type": "application/json"
     }
-    response = http.get(url, headers=headers)
-    if response.ok:
-        return response.json
-    raise AzureError(f'get_user failed with {response.code} - {response.text}')
+    return handle(http.get(url, headers=headers))
 
 
 def get_user_groups(auth_token, user_id):
-    url = f"https://graph.microsoft.com/v1.0/users/{user_id}/getMemberGroups"
+    url = f"{GRAPH_URL}/users/{user_id}/getMemberGroups"
     headers = {
         "Authorization": "Bearer " + auth_token,
         "Content-Type": "application/json"
@@ -92,36 +195,48 @@ def get_user_groups(auth_token, user_id):
     raise AzureError(f'get_user_groups failed with {response.code} - {response.text}')
 
 
-def find_user_by_email(auth_token, user_email):
-    url = "https://graph.microsoft.com/v1.0/users"
+def find_user_by_email(auth_token, user_email, batch=None, select=None):
+    mirrored = directory.find('users', 'mail', user_email, select) if batch is None else None
+    if mirrored is not None:
+        return mirrored
+    url = GRAPH_URL + "/users"
+    # special graphql way of escaping single quotes
+    user_email = user_email.replace("'", "''")
+    params = query(select, params={"$filter": f"mail eq '{user_email}'"})
+    log.debug(f'Looking up used by email with filter parameters: {params}')
+
+    def handle(response):
+        if response.ok:
+            return response.json['value']
+        raise AzureError(f'find_user_by_email failed with {response.code} - {response.text}')
+
+    if batch is not None:
+        return batch.add('GET', url + '?' + urllib.parse.urlencode(params), handle)
     headers = {
         "Authorization": "Bearer " + auth_token,
         "Content-Type": "application/json"
     }
-    # special graphql way of escaping single quotes
-    user_email = user_email.replace("'", "''")
-    params = {"$filter": f"mail eq '{user_email}'"}
-    response = http.get(url, headers=headers, params=params)
-    log.debug(f'Looking up used by email with filter parameters: {params}')
-    if response.ok:
-        return response.json['value']
-    raise AzureError(f'find_user_by_email failed with {response.code} - {response.text}')
+    return handle(http.get(url, headers=headers, params=params))
 
 
-def find_user_by_sso(auth_token, user_sso):
-    url = "https://graph.microsoft.com/v1.0/users"
+def find_user_by_sso(auth_token, user_sso, select=None):
+    mirrored = directory.find('users', 'userPrincipalName', user_sso, select)
+    if mirrored is not None:
+        return mirrored
+    url = GRAPH_URL + "/users"
     headers = {
         "Authorization": "Bearer " + auth_token,
         "Content-Type": "application/json"
     }
-    response = http.get(url, headers=headers, params={'$filter': 'userPrincipalName eq \'' + user_sso + '\''})
+    params = query(select, params={'$filter': 'userPrincipalName eq \'' + user_sso + '\''})
+    response = http.get(url, headers=headers, params=params)
     if response.ok:
         return response.json['value']
     raise AzureError(f'find_user_by_sso failed with {response.code} - {response.text}')
 
 
 def delete_group(auth_token, group_id):
-    url = f"https://graph.microsoft.com/v1.0/groups/{group_id}"
+    url = f"{GRAPH_URL}/groups/{group_id}"
     headers = {
         "Authorization": "Bearer " + auth_token,
         "Content-Type": "application/json"
@@ -135,7 +250,7 @@ def delete_group(auth_token, group_id):
 
 
 def create_group(auth_token, name, desc):
-    url = "https://graph.microsoft.com/v1.0/groups"
+    url = GRAPH_URL + "/groups"
     headers = {
         "Authorization": "Bearer " + auth_token,
         "Content-Type": "application/json"
@@ -153,169 +268,162 @@ def create_group(auth_token, name, desc):
     raise AzureError(f'create_group failed with {response.code} - {response.text}')
 
 
-def get_group(auth_token, group_id):
-    url = f"https://graph.microsoft.com/v1.0/groups/{group_id}"
+def get_group(auth_token, group_id, batch=None, select=None):
+    url = with_query(f"{GRAPH_URL}/groups/{group_id}", query(select))
+    mirrored = directory.get('groups', group_id, select) if batch is None else None
+    if mirrored is not None:
+        return mirrored
+
+    def handle(response):
+        if response.ok:
+            return response.json
+        raise AzureError(f'get_group failed with {response.code} - {response.text}')
+
+    if batch is not None:
+        return batch.add('GET', url, handle)
     headers = {
         "Authorization": "Bearer " + auth_token,
         "Content-Type": "application/json"
     }
-    response = http.get(url, headers=headers)
-    if response.ok:
-        return response.json
-    raise AzureError(f'get_group failed with {response.code} - {response.text}')
+    return handle(http.get(url, headers=headers))
 
 
-def find_group_by_name(auth_token, name):
-    url = "https://graph.microsoft.com/v1.0/groups"
+def find_group_by_name(auth_token, name, select=None):
+    mirrored = directory.find('groups', 'displayName', name, select)
+    if mirrored is not None:
+        return mirrored
+    url = GRAPH_URL + "/groups"
     headers = {
         "Authorization": "Bearer " + auth_token,
         "Content-Type": "application/json"
     }
-    response = http.get(url, headers=headers, params={'$filter': 'displayName eq \'' + name + '\''})
+    params = query(select, params={'$filter': 'displayName eq \'' + name + '\''})
+    response = http.get(url, headers=headers, params=params)
     if response.ok:
         return response.json['value']
     raise AzureError(f'find_group_by_name failed with {response.code} - {response.text}')
 
 
-def find_group_starts_with_name(auth_token, name):
-    all_data = []
-    data = find_group_starts_with_name_initial(auth_token, name)
-    all_data += data["value"]
-    while '@odata.nextLink' in data:
-        data = get_next_link(auth_token, data['@odata.nextLink'])
-        all_data += data["value"]
-    return all_data
+def iter_groups_starting_with_name(auth_token, name, page_size=None, prefetch=False, select=None):
+    url = GRAPH_URL + "/groups"
+    params = {'$filter': 'startsWith(displayName,\'' + name + '\')'}
+    return iter_values(auth_token, url, params, page_size, prefetch, name='find_group_starts_with_name', select=select)
 
 
-def find_group_starts_with_name_initial(auth_token, name):
-    url = "https://graph.microsoft.com/v1.0/groups"
-    headers = {
-        "Authorization": "Bearer " + auth_token,
-        "Content-Type": "application/json"
-    }
-    response = http.get(url, headers=headers, params={'$filter': 'startsWith(displayName,\'' + name + '\')'})
-    if response.ok:
-        return response.json
-    raise AzureError(f'find_group_starts_with_name_initial failed with {response.code} - {response.text}')
+def find_group_starts_with_name(auth_token, name, select=None, page_size=None):
+    return list(iter_groups_starting_with_name(auth_token, name, page_size, select=select))
 
 
-def group_members(auth_token, group_id):
-    all_data = []
-    data = group_members_initial(auth_token, group_id)
-    all_data += data["value"]
-    while '@odata.nextLink' in data:
-        data = get_next_link(auth_token, data['@odata.nextLink'])
-        all_data += data["value"]
-    return all_data
+def iter_group_members(auth_token, group_id, page_size=None, prefetch=False, select=None):
+    url = GRAPH_URL + "/groups/{}/members".format(group_id)
+    return iter_values(auth_token, url, page_size=page_size, prefetch=prefetch, name='group_members', select=select)
 
 
-def group_members_initial(auth_token, group_id):
-    url = "https://graph.microsoft.com/v1.0/groups/{}/members".format(group_id)
-    headers = {
-        "Authorization": "Bearer " + auth_token,
-        "Content-Type": "application/json"
-    }
-    response = http.get(url, headers=headers)
-    if response.ok:
-        return response.json
-    raise AzureError(f'group_members_initial failed with {response.code} - {response.text}')
+def group_members(auth_token, group_id, select=None, page_size=None):
+    return list(iter_group_members(auth_token, group_id, page_size, select=select))
 
 
-def group_add_member(auth_token, group_id, user_id):
-    url = "https://graph.microsoft.com/v1.0/groups/{}/members/$ref".format(group_id)
-    headers = {
-        "Authorization": "Bearer " + auth_token,
-        "Content-Type": "application/json"
-    }
+def group_add_member(auth_token, group_id, user_id, batch=None):
+    url = GRAPH_URL + "/groups/{}/members/$ref".format(group_id)
     data = {
-        '@odata.id': f'https://graph.microsoft.com/v1.0/users/{user_id}'
+        '@odata.id': f'{GRAPH_URL}/users/{user_id}'
     }
-    response = http.post(url, headers=headers, data=data)
-    if response.status_code == 204:
-        return True
-    raise AzureError(f'group_add_member failed with {response.code} - {response.text}')
 
+    def handle(response):
+        if response.status_code == 204:
+            return True
+        raise AzureError(f'group_add_member failed with {response.code} - {response.text}')
 
-def group_remove_member(auth_token, group_id, user_id):
-    url = "https://graph.microsoft.com/v1.0/groups/{}/members/{}/$ref".format(group_id, user_id)
+    if batch is not None:
+        return batch.add('POST', url, handle, body=data)
     headers = {
         "Authorization": "Bearer " + auth_token,
         "Content-Type": "application/json"
     }
-    response = http.delete(url, headers=headers)
-    if response.status_code == 204:
-        return True
-    raise AzureError(f'group_remove_member failed with {response.code} - {response.text}')
+    return handle(http.post(url, headers=headers, data=data))
+
+
+def group_remove_member(auth_token, group_id, user_id, batch=None):
+    url = GRAPH_URL + "/groups/{}/members/{}/$ref".format(group_id, user_id)
 
+    def handle(response):
+        if response.status_code == 204:
+            return True
+        raise AzureError(f'group_remove_member failed with {response.code} - {response.text}')
 
-def assign_user_to_app_role(auth_token, user_id, app_role_id):
-    url = "https://graph.microsoft.com/v1.0/users/{0}/appRoleAssignments".format(user_id)
+    if batch is not None:
+        return batch.add('DELETE', url, handle)
     headers = {
         "Authorization": "Bearer " + auth_token,
         "Content-Type": "application/json"
     }
+    return handle(http.delete(url, headers=headers))
+
+
+def assign_user_to_app_role(auth_token, user_id, app_role_id, batch=None):
+    url = GRAPH_URL + "/users/{0}/appRoleAssignments".format(user_id)
     data = {
         'principalId': user_id,
         'resourceId': SERVICE_ID,
         'appRoleId': app_role_id
     }
-    response = http.post(url, headers=headers, data=data)
-    if response.ok:
-        return response.json
-    raise AzureError(f'assign_user_to_app_role failed with {response.code} - {response.text}')
 
+    def handle(response):
+        if response.ok:
+            return response.json
+        raise AzureError(f'assign_user_to_app_role failed with {response.code} - {response.text}')
 
-def get_group_app_roles(auth_token, group_id):
-    url = "https://graph.microsoft.com/v1.0/groups/{0}/appRoleAssignments/?$top=999".format(group_id)
+    if batch is not None:
+        return batch.add('POST', url, handle, body=data)
     headers = {
         "Authorization": "Bearer " + auth_token,
         "Content-Type": "application/json"
     }
-    response = http.get(url, headers=headers)
-    if response.ok:
-        value = response.json['value']
-        while '@odata.nextLink' in response.json:
-            next_page = get_next_link(auth_token, response.json['@odata.nextLink'])
-            value.extend(next_page['value'])
-        return value
-    raise AzureError(f'get group app roles failed with {response.code} - {response.text}')
+    return handle(http.post(url, headers=headers, data=data))
 
 
-def get_user_app_roles(auth_token, user_id):
-    url = "https://graph.microsoft.com/v1.0/users/{0}/appRoleAssignments/?$top=999".format(user_id)
-    headers = {
-        "Authorization": "Bearer " + auth_token,
-        "Content-Type": "application/json"
-    }
-    response = http.get(url, headers=headers)
-    if response.ok:
-        value = response.json['value']
-        while '@odata.nextLink' in response.json:
-            next_page = get_next_link(auth_token, response.json['@odata.nextLink'])
-            value.extend(next_page['value'])
-        return value
-    raise AzureError(f'get_user_app_roles failed with {response.code} - {response.text}')
+def iter_group_app_roles(auth_token, group_id, page_size=999, prefetch=False, select=None):
+    url = GRAPH_URL + "/groups/{0}/appRoleAssignments".format(group_id)
+    return iter_values(auth_token, url, page_size=page_size, prefetch=prefetch, name='get_group_app_roles', select=select)
 
 
-def assign_group_to_app_role(auth_token, group_id, app_role_id):
-    url = "https://graph.microsoft.com/v1.0/groups/{0}/appRoleAssignments".format(group_id)
-    headers = {
-        "Authorization": "Bearer " + auth_token,
-        "Content-Type": "application/json"
-    }
+def get_group_app_roles(auth_token, group_id, select=None, page_size=999):
+    return list(iter_group_app_roles(auth_token, group_id, page_size, select=select))
+
+
+def iter_user_app_roles(auth_token, user_id, page_size=999, prefetch=False, select=None):
+    url = GRAPH_URL + "/users/{0}/appRoleAssignments".format(user_id)
+    return iter_values(auth_token, url, page_size=page_size, prefetch=prefetch, name='get_user_app_roles', select=select)
+
+
+def get_user_app_roles(auth_token, user_id, select=None, page_size=999):
+    return list(iter_user_app_roles(auth_token, user_id, page_size, select=select))
+
+
+def assign_group_to_app_role(auth_token, group_id, app_role_id, batch=None):
+    url = GRAPH_URL + "/groups/{0}/appRoleAssignments".format(group_id)
     data = {
         'principalId': group_id,
         'resourceId': SERVICE_ID,
         'appRoleId': app_role_id
     }
-    response = http.post(url, headers=headers, data=data)
-    if response.ok:
-        return response.json
-    raise AzureError(f'assign_group_to_app_role failed with {response.code} - {response.text}')
+
+    def handle(response):
+        if response.ok:
+            return response.json
+        raise AzureError(f'assign_group_to_app_role failed with {response.code} - {response.text}')
+
+    if batch is not None:
+        return batch.add('POST', url, handle, body=data)
+    headers = {
+        "Authorization": "Bearer " + auth_token,
+        "Content-Type": "application/json"
+    }
+    return handle(http.post(url, headers=headers, data=data))
 
 
 def lookup_assignment_object_id(auth_token, user_id, role_id):
-    url = "https://graph.microsoft.com/v1.0/users/{0}/appRoleAssignments".format(user_id)
+    url = GRAPH_URL + "/users/{0}/appRoleAssignments".format(user_id)
     headers = {
         "Authorization": "Bearer " + auth_token,
         "Content-Type": "application/json"
@@ -330,13 +438,18 @@ def lookup_assignment_object_id(auth_token, user_id, role_id):
     raise AzureError(f'lookup_assignment_object_id failed with {response.code} - {response.text}')
 
 
-def remove_user_from_app_role(auth_token, user_id, assignment_id):
-    url = "https://graph.microsoft.com/v1.0/users/{0}/appRoleAssignments/{1}".format(user_id, assignment_id)
+def remove_user_from_app_role(auth_token, user_id, assignment_id, batch=None):
+    url = GRAPH_URL + "/users/{0}/appRoleAssignments/{1}".format(user_id, assignment_id)
+
+    def handle(response):
+        if response.ok:
+            return response
+        raise AzureError(f'remove_user_from_app_role failed with {response.code} - {response.text}')
+
+    if batch is not None:
+        return batch.add('DELETE', url, handle)
     headers = {
         "Authorization": "Bearer " + auth_token,
         "Content-Type": "application/json"
     }
-    response = http.delete(url, headers=headers)
-    if response.ok:
-        return response
-    raise AzureError(f'remove_user_from_app_role failed with {response.code} - {response.text}')
+    return handle(http.delete(url, headers=headers))
@@ -0,0 +1,69 @@
+''' Cache of the AWS application manifest (Graph application object).
+    Manifest is kept in memory and, when AAD_AWS_CACHE_DIR is set, on disk between invocations.
+    Cached manifest is used without a request for AZURE_MANIFEST_TTL seconds. After that it is
+    revalidated with If-None-Match if Graph returned an ETag, or downloaded again otherwise.
+    Manifests requested with $select projection are cached separately per application and projection.
+'''
+import os
+import time
+import logging
+import threading
+
+from azuread_aws import cache
+
+log = logging.getLogger('azure.manifest')
+
+TTL = int(os.getenv('AZURE_MANIFEST_TTL', '300'))
+
+_entries = {}
+_lock = threading.Lock()
+
+
+def key(app_id, select=None):
+    '''Returns cache key of the application manifest with optional comma separated $select projection'''
+    if not select:
+        return app_id
+    return app_id + '.' + ','.join(sorted(select.split(',')))
+
+
+def _cache_name(key):
+    return f'manifest-{key}.json'
+
+
+def load(key):
+    ''' Returns cached entry with text, etag and fetched_at of the application, or None'''
+    with _lock:
+        entry = _entries.get(key)
+    if entry is None:
+        entry = cache.load_json(_cache_name(key))
+        if entry is not None:
+            log.debug('Loaded application %s manifest from disk cache', key)
+            with _lock:
+                _entries[key] = entry
+    return entry
+
+
+def fresh(entry):
+    return time.time() - entry['fetched_at'] < TTL
+
+
+def store(key, text, etag=None):
+    entry = {'text': text, 'etag': etag, 'fetched_at': time.time()}
+    with _lock:
+        _entries[key] = entry
+    cache.save_json(_cache_name(key), entry)
+    return entry
+
+
+def revalidated(key, entry):
+    '''Mark cached entry as confirmed up to date by the server'''
+    return store(key, entry['text'], entry['etag'])
+
+
+def invalidate(app_id):
+    '''Drop cached manifests of the application with all projections'''
+    with _lock:
+        for cached in [k for k in _entries if k == app_id or k.startswith(app_id + '.')]:
+            del _entries[cached]
+    # matches both manifest-{app_id}.json and manifest-{app_id}.{select}.json
+    cache.remove_prefixed(f'manifest-{app_id}.')
@@ -0,0 +1,74 @@
+''' Optional on-disk cache shared between CLI invocations.
+    Disabled unless AAD_AWS_CACHE_DIR environment variable points to a directory.
+    Cache files are written atomically and are readable by the current user only.
+'''
+import os
+import json
+import logging
+import tempfile
+
+log = logging.getLogger('cache')
+
+CACHE_DIR = os.getenv('AAD_AWS_CACHE_DIR')
+
+
+def enabled():
+    return bool(CACHE_DIR)
+
+
+def path(name):
+    '''Returns path of the named cache file'''
+    return os.path.join(CACHE_DIR, name)
+
+
+def load_json(name, default=None):
+    '''Read named cache file, returns default if missing, unreadable or cache is disabled'''
+    if not enabled():
+        return default
+    try:
+        with open(path(name), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as ex:
+        log.warning(f'Ignoring unreadable cache file {path(name)} - {ex}')
+        return default
+
+
+def save_json(name, data):
+    '''Atomically replace named cache file with 0600 permissions'''
+    if not enabled():
+        return
+    os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+    # mkstemp creates the file with 0600 permissions
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix=f'.{name}.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path(name))
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def remove(name):
+    '''Delete named cache file if exists'''
+    if not enabled():
+        return
+    try:
+        os.unlink(path(name))
+    except FileNotFoundError:
+        pass
+
+
+def remove_prefixed(prefix):
+    '''Delete all cache files with names starting with prefix'''
+    if not enabled():
+        return
+    try:
+        names = os.listdir(CACHE_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name.startswith(prefix):
+            remove(name)
@@ -0,0 +1,181 @@
+''' Reports of AWS access granted to AzureAD users through AWS App Role assignments,
+    either directly or with membership in an assigned group.
+'''
+import sys
+import csv
+import json
+import time
+import fnmatch
+import logging
+import collections
+
+from azuread_aws import fanout
+from azuread_aws.azure import auth
+from azuread_aws.azure import graph_api
+from azuread_aws.azure import directory
+from azuread_aws.azure import assignments
+from azuread_aws.azure.batch import GraphBatch, MAX_BATCH_SIZE
+from azuread_aws.azure.catalog import AppRoleCatalog, APPLICATION_FIELDS
+
+log = logging.getLogger('access')
+
+COLUMNS = ('user_id', 'user_name', 'user_email', 'account_id', 'aws_role_name', 'app_role_name', 'role_arn', 'via')
+ASSIGNMENT_FIELDS = ('id', 'appRoleId', 'principalId', 'principalType', 'principalDisplayName')
+MEMBER_FIELDS = ('id', 'displayName', 'mail', 'userPrincipalName')
+# directly assigned users read from Graph API which are remembered for their next assignments
+LOOKED_UP_SIZE = 10000
+
+
+def matches(patterns, *values):
+    '''True if there are no patterns or any of the values matches any of the glob patterns'''
+    return not patterns or any(fnmatch.fnmatch(value, p) for p in patterns for value in values if value)
+
+
+def iter_assignments(token, live=False):
+    ''' Yields assignments of the service principal from the directory mirror snapshot
+        if it is fresh enough, or from Graph API otherwise.
+    '''
+    if not live and directory.enabled():
+        refreshed_at = assignments.refreshed_at()
+        if refreshed_at and time.time() - refreshed_at < directory.MAX_AGE:
+            log.info('Reading app role assignments from directory mirror')
+            return assignments.query()
+    log.info('Reading app role assignments from Graph API')
+    return graph_api.iter_app_role_assigned_to(token, prefetch=True, select=ASSIGNMENT_FIELDS)
+
+
+def iter_access(token, catalog, options):
+    ''' Yields report rows. App roles and groups are joined with hash indexes, direct assignments
+        are streamed as they are read and members of assigned groups are streamed group by group.
+    '''
+    def selected(info):
+        return info.is_aws and matches(options.account, info.account_id) and matches(options.role, info.name, info.aws_role_name)
+
+    # app role id -> AppRoleInfo of AWS roles passing account and role filters
+    roles = {info.id: info for info in catalog if selected(info)}
+
+    def row(user, info, via):
+        email = user.get('mail') or user.get('userPrincipalName')
+        if not matches(options.user, user['id'], email, user.get('displayName')):
+            return None
+        return (user['id'], user.get('displayName'), email, info.account_id, info.aws_role_name, info.name, info.role_arn, via)
+
+    def lookup(unresolved):
+        ''' Yields rows of direct assignments of users missing in the directory mirror,
+            users are read from Graph API in batches.
+        '''
+        with GraphBatch(token) as batch:
+            pending = [(graph_api.get_user(token, user_id, batch=batch, select=MEMBER_FIELDS), user_id)
+                       for user_id in unresolved]
+        for request, user_id in pending:
+            user_name, infos = unresolved[user_id]
+            try:
+                user = request.result()
+            except Exception as ex:
+                raise Exception(f'Failed to read directly assigned user {user_name} ({user_id}) '
+                                f'- {ex.__class__.__name__}: {ex}')
+            looked_up[user_id] = user
+            if len(looked_up) > LOOKED_UP_SIZE:
+                looked_up.popitem(last=False)
+            for info in infos:
+                access = row(user, info, 'direct')
+                if access:
+                    yield access
+
+    # group id -> (group name, [AppRoleInfo])
+    groups = {}
+    # user id -> (user name, [AppRoleInfo]) of direct assignments not answered by the mirror
+    unresolved = {}
+    # user id -> user read from Graph API, least recently used first
+    looked_up = collections.OrderedDict()
+    for assignment in iter_assignments(token, options.live):
+        info = roles.get(assignment['appRoleId'])
+        if info is None:
+            continue
+        if assignment['principalType'] == 'Group':
+            group = groups.setdefault(assignment['principalId'], (assignment['principalDisplayName'], []))
+            group[1].append(info)
+            continue
+        if assignment['principalType'] == 'User':
+            user = looked_up.get(assignment['principalId'])
+            if user is not None:
+                looked_up.move_to_end(assignment['principalId'])
+            else:
+                user = directory.get('users', assignment['principalId'], MEMBER_FIELDS)
+            if user is None:
+                unresolved.setdefault(assignment['principalId'], (assignment['principalDisplayName'], []))[1].append(info)
+                if len(unresolved) >= MAX_BATCH_SIZE:
+                    yield from lookup(unresolved)
+                    unresolved = {}
+                continue
+        else:
+            # service principals have no email
+            user = {'id': assignment['principalId'], 'displayName': assignment['principalDisplayName']}
+        result = row(user, info, 'direct')
+        if result:
+            yield result
+    if unresolved:
+        yield from lookup(unresolved)
+
+    def members(group_id):
+        return [member for member in graph_api.iter_group_members(token, group_id, page_size=999, select=MEMBER_FIELDS)
+                if member.get('@odata.type', '#microsoft.graph.user') == '#microsoft.graph.user']
+
+    log.info('Reading members of %d assigned groups', len(groups))
+    for result in fanout.run(members, groups, options.concurrency):
+        group_name, infos = groups[result.key]
+        if not result.ok:
+            raise Exception(f'Failed to list members of group {group_name} ({result.key}) '
+                            f'- {result.error.__class__.__name__}: {result.error}')
+        for user in result.value:
+            for info in infos:
+                access = row(user, info, f'group:{group_name}')
+                if access:
+                    yield access
+
+
+def access_report(options):
+    '''Report AWS accounts and roles users can access as CSV or NDJSON.'''
+    token = auth.get_bearer_token('https://graph.microsoft.com')
+    catalog = AppRoleCatalog.from_application(graph_api.get_application(token, select=APPLICATION_FIELDS))
+    output = sys.stdout if options.output == '-' else open(options.output, 'w', newline='')
+    started = time.monotonic()
+    counts = collections.Counter()
+    try:
+        if options.format == 'ndjson':
+            for access in iter_access(token, catalog, options):
+                output.write(json.dumps(dict(zip(COLUMNS, access))) + '\n')
+                counts[access[3]] += 1
+        else:
+            writer = csv.writer(output)
+            writer.writerow(COLUMNS)
+            for access in iter_access(token, catalog, options):
+                writer.writerow(access)
+                counts[access[3]] += 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        else:
+            output.flush()
+    log.info('Reported %d grants in %d accounts in %.2fs', sum(counts.values()), len(counts), time.monotonic() - started)
+
+
+def arguments(parser):
+    subparsers = parser.add_subparsers(help=f'Subcommands for {__doc__}.')
+    subparsers.required = True
+    subparsers.dest = 'Access subcommand missing'
+
+    report_cmd = subparsers.add_parser('report', help=access_report.__doc__)
+    report_cmd.add_argument('-a', '--account', action='append',
+                            help='Only roles in AWS accounts with id matching the glob pattern. Can be repeated.')
+    report_cmd.add_argument('-r', '--role', action='append',
+                            help='Only app roles or AWS roles with name matching the glob pattern. Can be repeated.')
+    report_cmd.add_argument('-u', '--user', action='append',
+                            help='Only users with id, email or name matching the glob pattern. Can be repeated.')
+    report_cmd.add_argument('-f', '--format', choices=['csv', 'ndjson'], default='csv', help='Output format, CSV by default.')
+    report_cmd.add_argument('-o', '--output', default='-', help='File to write the report to, stdout by default.')
+    report_cmd.add_argument('-c', '--concurrency', type=int, default=fanout.DEFAULT_CONCURRENCY,
+                            help='Number of groups to read members of in parallel.')
+    report_cmd.add_argument('--live', action='store_true',
+                            help='Read assignments from Graph API even if the directory mirror is fresh.')
+    report_cmd.set_defaults(cmd=access_report)
@@ -1,14 +1,18 @@
 ''' List, Create and Delete Azure AD Application Roles for corresponding AWS IAM Roles in 
     organization accounts. Uses Graph API to modify Azure AD Application Manifest.
 '''
-import os
+import csv
+import time
 import uuid
+import fnmatch
 import logging
 
 from azuread_aws import amazon
-from azuread_aws import http
+from azuread_aws import fanout
+from azuread_aws.commands.idp import validate_master_account, select_accounts
 from azuread_aws.azure import auth
 from azuread_aws.azure import graph_api
+from azuread_aws.azure.catalog import AppRoleCatalog, APPLICATION_FIELDS
 
 log = logging.getLogger('app_role')
 
@@ -16,96 +20,219 @@ log = logging.getLogger('app_role')
 def list_app_roles(options):
     '''List Registered App Roles for AWS Application.'''
     token = auth.get_bearer_token('https://graph.microsoft.com')
-    application = graph_api.get_application(token)
-    log.info('Get application details with %d roles', len(application['appRoles']))
-    for app_role in application['appRoles']:
-        if app_role['displayName'] == 'msiam_access':
+    catalog = AppRoleCatalog.from_application(graph_api.get_application(token, select=APPLICATION_FIELDS))
+    log.info('Get application details with %d roles', len(catalog))
+    for info in catalog:
+        if info.name == 'msiam_access':
             continue
-        if '@' not in app_role['description']:
-            log.warning('Found app role %s without expected description format', app_role['displayName'])
+        if not info.is_aws:
+            log.warning('Found app role %s without expected description format', info.name)
             continue
-        aws_role_name, aws_account_id = app_role['description'].split('@')
-        log.info('Found id: %s, name: %s, aws role: %s, aws account: %s', app_role['id'], app_role['displayName'],
-                 aws_role_name, aws_account_id)
+        log.info('Found id: %s, name: %s, aws role: %s, aws account: %s', info.id, info.name,
+                 info.aws_role_name, info.account_id)
+
+
+def make_app_role(aws_role_name, account_id, app_role_name=None):
+    '''Returns new app role definition for the IAM role in /aad path of the account'''
+    iam_role_arn = f'arn:aws:iam::{account_id}:role/aad/{aws_role_name}'
+    saml_provider_arn = f'arn:aws:iam::{account_id}:saml-provider/AAD'
+    return {
+        'allowedMemberTypes': ['User'],
+        'description': f'{aws_role_name}@{account_id}',
+        'displayName': app_role_name or f'{aws_role_name}/{account_id}',
+        'id': str(uuid.uuid4()),
+        'isEnabled': True,
+        'origin': 'Application',
+        'value': f'{iam_role_arn},{saml_provider_arn}'
+    }
+
+
+def log_app_role_changes(additions, removals):
+    '''Log preflight diff of the manifest changes'''
+    log.info('Manifest changes: %d app roles to add, %d app roles to remove', len(additions), len(removals))
+    for app_role in additions:
+        log.info('+ %s (%s)', app_role['displayName'], app_role['description'])
+    for app_role in removals:
+        log.info('- %s (%s) [%s]', app_role['displayName'], app_role['description'], app_role['id'])
+
+
+def apply_app_role_changes(token, application, additions=(), removals=()):
+    ''' Add and remove any number of app roles with at most two manifest updates.
+        App roles must be disabled before they can be deleted, so all removed roles are disabled
+        with the first update and the second one commits both removals and additions.
+    '''
+    removed_ids = set(app_role['id'] for app_role in removals)
+    app_roles = application['appRoles']
+    if removed_ids:
+        for app_role in app_roles:
+            if app_role['id'] in removed_ids:
+                app_role['isEnabled'] = False
+        graph_api.patch_application(token, {'appRoles': app_roles})
+
+    app_roles = [app_role for app_role in app_roles if app_role['id'] not in removed_ids]
+    app_roles.extend(additions)
+    if removed_ids or additions:
+        graph_api.patch_application(token, {'appRoles': app_roles})
+    application['appRoles'] = app_roles
 
 
 def delete_app_role(options):
-    '''Delete existing app role from application manifest'''
+    '''Delete existing app role or roles matching a pattern from application manifest'''
+    if bool(options.role_name) == bool(options.match):
+        raise Exception('Either role name or --match pattern must be specified')
     token = auth.get_bearer_token('https://graph.microsoft.com')
-    application = graph_api.get_application(token)
-    app_role = find_app_role_by_name(options.role_name, application['appRoles'])
-    if not app_role:
-        raise Exception(f'AWS App role with name {options.role_name} was not found')
+    application = graph_api.get_application(token, use_cache=False, select=APPLICATION_FIELDS)
+    catalog = AppRoleCatalog.from_application(application)
+    if options.role_name:
+        info = catalog.find_by_name(options.role_name)
+        if not info:
+            raise Exception(f'AWS App role with name {options.role_name} was not found')
+        removals = [info.app_role]
+    else:
+        removals = [info.app_role for info in catalog
+                    if info.name != 'msiam_access' and any(fnmatch.fnmatchcase(info.name, p) for p in options.match)]
+        if not removals:
+            log.info('No app roles match %s', ', '.join(options.match))
+            return
+
+    log_app_role_changes([], removals)
+    if options.dry_run:
+        return
+    apply_app_role_changes(token, application, removals=removals)
+    for app_role in removals:
+        log.info('Deleted app role [%s] "%s"', app_role['id'], app_role['displayName'])
 
-    app_role['isEnabled'] = False
-    graph_api.patch_application(token, application)
 
-    application['appRoles'].remove(app_role)
-    graph_api.patch_application(token, application)
-    log.info('Deleted app role [%s] "%s"', app_role['id'], app_role['displayName'])
+def read_app_role_definitions(filename):
+    '''Yields tuples of (aws role name, account id, app role name or None) from CSV file'''
+    with open(filename, 'r', newline='') as f:
+        for line_no, row in enumerate(csv.reader(f), 1):
+            row = [cell.strip() for cell in row]
+            if not row or not row[0] or row[0].startswith('#'):
+                continue
+            if line_no == 1 and row[0] == 'aws_role_name':
+                continue
+            if len(row) < 2 or not row[1]:
+                raise Exception(f'{filename}:{line_no} expected aws_role_name,account_id[,app_role_name]')
+            yield row[0], row[1], row[2] if len(row) > 2 and row[2] else None
 
 
 def new_app_role(options):
-    '''Create new app role for corresponding iam role in some aws account.'''
+    '''Create new app role for corresponding iam role in some aws account, or roles listed in a file.'''
+    if options.from_file:
+        definitions = list(read_app_role_definitions(options.from_file))
+    elif options.aws_role_name and options.account_id:
+        definitions = [(options.aws_role_name, options.account_id, options.app_role_name)]
+    else:
+        raise Exception('Either --aws-role-name and --account-id or --from-file must be specified')
+
     token = auth.get_bearer_token('https://graph.microsoft.com')
-    application = graph_api.get_application(token)
-    iam_role_arn = f'arn:aws:iam::{options.account_id}:role/aad/{options.aws_role_name}'
-    if not options.app_role_name:
-        options.app_role_name = f'{options.aws_role_name}/{options.account_id}'
-    saml_provider_arn = f'arn:aws:iam::{options.account_id}:saml-provider/AAD'
-    app_role = {
-        'allowedMemberTypes': ['User'],
-        'description': f'{options.aws_role_name}@{options.account_id}',
-        'displayName': options.app_role_name,
-        'id': str(uuid.uuid4()),
-        'isEnabled': True,
-        'origin': 'Application',
-        'value': f'{iam_role_arn},{saml_provider_arn}'
-    }
-    application['appRoles'].append(app_role)
-    graph_api.patch_application(token, application)
-    log.info('Created new app role [%s] for aws role "%s" in account %s',
-             app_role['id'], options.aws_role_name, options.account_id)
-
-
-def find_app_role_by_name(app_role_name, app_roles):
-    log.debug('Looking for application role in %d roles', len(app_roles))
-    for app_role in app_roles:
-        if app_role['displayName'] == app_role_name:
-            return app_role
-    return None
-
-
-def find_app_roles_by_aws_name(aws_name, app_roles):
-    log.debug('Looking for application role in %d roles', len(app_roles))
-    found = []
-    for app_role in app_roles:
-        if '@' not in app_role['description']:
-            log.warning('Found app role "%s" without expected description format', app_role['displayName'])
+    application = graph_api.get_application(token, use_cache=False, select=APPLICATION_FIELDS)
+    catalog = AppRoleCatalog.from_application(application)
+    additions = []
+    for aws_role_name, account_id, app_role_name in definitions:
+        app_role = make_app_role(aws_role_name, account_id, app_role_name)
+        existing = catalog.find_by_aws(aws_role_name, account_id) or catalog.find_by_name(app_role['displayName'])
+        if existing:
+            log.info('App role "%s" for aws role "%s" in account %s already exists',
+                     existing.name, aws_role_name, account_id)
             continue
-        aws_role_name, _ = app_role['description'].split('@')
-        if aws_role_name == aws_name:
-            found.append(app_role)
-    return found
+        catalog.add(app_role)
+        additions.append(app_role)
+
+    if not additions:
+        return
+    log_app_role_changes(additions, [])
+    if options.dry_run:
+        return
+    apply_app_role_changes(token, application, additions=additions)
+    for app_role in additions:
+        log.info('Created new app role [%s] for aws role "%s"', app_role['id'], app_role['description'])
+
+
+def list_aad_roles(account_id):
+    '''Returns names of IAM roles with /aad/ path in the account, or in the current account if account_id is None'''
+    paginator = amazon.client('iam', account_id).get_paginator('list_roles')
+    return [role['RoleName']
+            for page in paginator.paginate(PathPrefix='/aad/')
+            for role in page['Roles'] if role['Path'] == '/aad/']
+
+
+def sync_app_roles(options):
+    '''Synchronize app roles with IAM roles in /aad path of the organization accounts.'''
+    master_id = validate_master_account()
+    orgs = amazon.client('organizations')
+    accounts = {no: name for name, no in amazon.list_accounts(orgs).items()}
+    accounts = select_accounts(accounts, options.include, options.exclude)
+    log.info(f'Discovering /aad IAM roles in {len(accounts)} accounts of the organization.')
+
+    def discover(account_id):
+        # roles of the master account are listed with own credentials
+        return list_aad_roles(None if account_id == master_id else account_id)
+
+    started = time.monotonic()
+    results = []
+    desired = set()
+    for result in fanout.run(discover, accounts, options.concurrency, options.timeout):
+        results.append(result)
+        if not result.ok:
+            log.warning(f'Failed to list IAM roles in {accounts[result.key]} ({result.key}) '
+                        f'- {result.error.__class__.__name__}: {result.error}')
+            continue
+        log.debug(f'Found {len(result.value)} IAM roles in {accounts[result.key]} ({result.key})')
+        desired.update((aws_role_name, result.key) for aws_role_name in result.value)
+    fanout.report(results, time.monotonic() - started, log)
+    scanned = set(r.key for r in results if r.ok)
+
+    token = auth.get_bearer_token('https://graph.microsoft.com')
+    application = graph_api.get_application(token, use_cache=False, select=APPLICATION_FIELDS)
+    catalog = AppRoleCatalog.from_application(application)
+
+    additions = []
+    for aws_role_name, account_id in sorted(desired):
+        if catalog.find_by_aws(aws_role_name, account_id):
+            continue
+        app_role = make_app_role(aws_role_name, account_id)
+        if catalog.find_by_name(app_role['displayName']):
+            log.warning('App role "%s" exists with different AWS role, skipping', app_role['displayName'])
+            continue
+        additions.append(app_role)
+
+    removals = []
+    if options.prune:
+        # only roles pointing to /aad/ path of successfully scanned accounts are removed
+        for info in catalog:
+            if info.account_id in scanned and (info.aws_role_name, info.account_id) not in desired \
+                    and info.role_arn == f'arn:aws:iam::{info.account_id}:role/aad/{info.aws_role_name}':
+                removals.append(info.app_role)
+
+    log_app_role_changes(additions, removals)
+    if not options.apply:
+        log.info('Dry run, use --apply to update the application manifest.')
+    elif additions or removals:
+        apply_app_role_changes(token, application, additions, removals)
+        log.info('Application manifest updated.')
+    if len(scanned) != len(accounts):
+        return 1
 
 
 def show_app_role_info(options):
     '''Information about app role.'''
     token = auth.get_bearer_token('https://graph.microsoft.com')
-    application = graph_api.get_application(token)
-    app_role = find_app_role_by_name(options.role_name, application['appRoles'])
-    if not app_role:
+    info = AppRoleCatalog.from_application(graph_api.get_application(token, select=APPLICATION_FIELDS)).find_by_name(options.role_name)
+    if not info:
         raise Exception(f'AWS App role with name {options.role_name} was not found')
+    if not info.is_aws:
+        raise Exception(f'App role {options.role_name} does not have expected description format')
 
-    aws_role_name, aws_account_id = app_role['description'].split('@')
-    iam_resource = amazon.resource('iam', aws_account_id)
+    iam_resource = amazon.resource('iam', info.account_id)
     role_arn = 'Not Found'
     for iam_role in iam_resource.roles.filter(PathPrefix='/aad'):
-        if iam_role.name == aws_role_name:
+        if iam_role.name == info.aws_role_name:
             role_arn = iam_role.arn
             break
-    log.info('AzureAD App Role ID: %s, Name: %s', app_role['id'], options.role_name)
-    log.info('AWS Account: %s, AWS Role Name: %s, AWS Role ARN: %s', aws_account_id, aws_role_name, role_arn)
+    log.info('AzureAD App Role ID: %s, Name: %s', info.id, options.role_name)
+    log.info('AWS Account: %s, AWS Role Name: %s, AWS Role ARN: %s', info.account_id, info.aws_role_name, role_arn)
 
 
 def arguments(parser):
@@ -121,11 +248,32 @@ def arguments(parser):
     info_cmd.set_defaults(cmd=show_app_role_info)
 
     rm_cmd = subparsers.add_parser('rm', help=delete_app_role.__doc__)
-    rm_cmd.add_argument('role_name')
+    rm_cmd.add_argument('role_name', nargs='?')
+    rm_cmd.add_argument('-m', '--match', action='append',
+                        help='Remove all app roles with name matching the glob pattern. Can be repeated.')
+    rm_cmd.add_argument('--dry-run', action='store_true', help='Only show app roles to be removed.')
     rm_cmd.set_defaults(cmd=delete_app_role)
 
     new_cmd = subparsers.add_parser('new', help=new_app_role.__doc__)
-    new_cmd.add_argument('-n', '--aws-role-name', required=True, help='Name of the AWS role to use.')
-    new_cmd.add_argument('-a', '--account-id', required=True, help='AWS Account ID the role exists in.')
+    new_cmd.add_argument('-n', '--aws-role-name', help='Name of the AWS role to use.')
+    new_cmd.add_argument('-a', '--account-id', help='AWS Account ID the role exists in.')
     new_cmd.add_argument('-d', '--app-role-name', help='Name of the new app role name. Defaults to "$aws-role-name/$account-id".')
+    new_cmd.add_argument('-f', '--from-file',
+                         help='CSV file with aws_role_name,account_id[,app_role_name] lines to create many app roles at once.')
+    new_cmd.add_argument('--dry-run', action='store_true', help='Only show app roles to be created.')
     new_cmd.set_defaults(cmd=new_app_role)
+
+    sync_cmd = subparsers.add_parser('sync', help=sync_app_roles.__doc__)
+    sync_cmd.add_argument('--apply', action='store_true',
+                          help='Update application manifest. Without it only changes are shown.')
+    sync_cmd.add_argument('--prune', action='store_true',
+                          help='Remove app roles of /aad IAM roles which no longer exist.')
+    sync_cmd.add_argument('-i', '--include', action='append',
+                          help='Only accounts with id or name matching the glob pattern. Can be repeated.')
+    sync_cmd.add_argument('-x', '--exclude', action='append',
+                          help='Skip accounts with id or name matching the glob pattern. Can be repeated.')
+    sync_cmd.add_argument('-c', '--concurrency', type=int, default=fanout.DEFAULT_CONCURRENCY,
+                          help='Number of accounts to scan in parallel.')
+    sync_cmd.add_argument('-t', '--timeout', type=float, default=120,
+                          help='Seconds to wait for a single account.')
+    sync_cmd.set_defaults(cmd=sync_app_roles)
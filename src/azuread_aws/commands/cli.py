@@ -8,55 +8,155 @@ import os
 import sys
 import argparse
 import logging
-import pkg_resources
+import importlib
+import collections
 
-from azuread_aws.commands import idp
-from azuread_aws.commands import app_role
-from azuread_aws.commands import user
+from azuread_aws import daemon
+from azuread_aws import metrics
+from azuread_aws import tracing
 
 log = logging.getLogger(__name__)
 
+# subcommand -> (module, help). Only the module of the selected subcommand is imported,
+# other subcommands are listed in the help with static text.
+COMMANDS = collections.OrderedDict([
+    ('idp', ('azuread_aws.commands.idp',
+             'Lookup and configure AWS SAML IDP for accounts of the AWS Organization.')),
+    ('role', ('azuread_aws.commands.app_role',
+              'List, Create and Delete Azure AD Application Roles for corresponding AWS IAM Roles.')),
+    ('user', ('azuread_aws.commands.user',
+              'List assigned and assign new Azure AD Application Roles, representing AWS IAM Roles.')),
+    ('directory', ('azuread_aws.commands.directory',
+                   'Local mirror of AzureAD users, groups and AWS app role assignments used by other commands.')),
+    ('access', ('azuread_aws.commands.access',
+                'Reports of AWS access granted to AzureAD users through AWS App Role assignments.')),
+    ('serve', ('azuread_aws.commands.serve',
+               'Resident daemon running subcommands for local clients over a Unix domain socket.')),
+])
 
-def init_subcommand(subparsers, cmd, name):
-    log.debug(f'Setting up subcommand {cmd.__name__}')
+
+def version():
+    ''' Returns version of the installed package without importing pkg_resources'''
+    try:
+        from importlib import metadata
+    except ImportError:
+        # Python < 3.8
+        return 'unknown'
+    try:
+        return metadata.version('aad-aws-sso')
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+class ArgumentParser(argparse.ArgumentParser):
+    ''' Resolves version in the description only when help is printed'''
+
+    def format_help(self):
+        if '{ver}' in (self.description or ''):
+            self.description = self.description.replace('{ver}', version())
+        return super().format_help()
+
+
+def selected_command(parser, argv):
+    ''' Returns the first positional argument, skipping global options and their values'''
+    with_value = {option for action in parser._actions if action.nargs != 0 for option in action.option_strings}
+    args = iter(argv)
+    for arg in args:
+        if arg == '--':
+            return next(args, None)
+        if arg.startswith('-'):
+            if arg in with_value:
+                next(args, None)
+            continue
+        return arg
+    return None
+
+
+def init_subcommand(subparsers, name, selected):
+    module_name, help = COMMANDS[name]
+    if name != selected:
+        subparsers.add_parser(name, help=help)
+        return
+    log.debug(f'Setting up subcommand {module_name}')
+    cmd = importlib.import_module(module_name)
     subp = subparsers.add_parser(name, help=cmd.__doc__)
     cmd.arguments(subp)
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description='AzureAD and AWS command line toolkit. Version: {ver}. {doc}'.format(
-            doc=__doc__,
-            ver=pkg_resources.get_distribution("aad-aws-sso").version
-        ))
+def parse(argv):
+    ''' Returns options of the command line arguments, importing module of the selected subcommand only'''
+    parser = ArgumentParser(
+        description='AzureAD and AWS command line toolkit. Version: {ver}. ' + __doc__,
+        # abbreviated global options would make the subcommand lookup ambiguous
+        allow_abbrev=False)
     parser.add_argument(
         '-s', '--silent', action='store_true',
         help='Enable no output (WARNING level logging)')
     parser.add_argument(
         '-d', '--debug', action='store_true',
         help='Enable debug output (DEBUG level logging)')
+    parser.add_argument(
+        '--metrics', action='store_true',
+        help='Collect per endpoint metrics of Graph and AWS requests and print JSON summary to stderr at exit')
+    parser.add_argument(
+        '--metrics-file', metavar='PATH',
+        help='Collect metrics as with --metrics and write JSON summary to the file')
+    parser.add_argument(
+        '--trace', metavar='FILE',
+        help='Record trace spans of the subcommand, units of work and API calls and write them to the file')
+    parser.add_argument(
+        '--trace-format', choices=tracing.FORMATS, default='chrome',
+        help='Format of the trace file: Chrome trace events (default) or OTLP JSON')
+    parser.add_argument(
+        '--profile', choices=('cpu', 'alloc'),
+        help='Profile CPU time or memory allocations of the subcommand and print top functions or allocation sites')
+    parser.add_argument(
+        '--profile-output', metavar='PREFIX',
+        help='Path prefix of profile files, aad-aws-<subcommand> by default')
 
     subparsers = parser.add_subparsers(help='Supported commands. '
                                             'Each subcommand has own arguments.')
     subparsers.required = True
     subparsers.dest = 'subcommand missing'
-    init_subcommand(subparsers, idp, 'idp')
-    init_subcommand(subparsers, app_role, 'role')
-    init_subcommand(subparsers, user, 'user')
-    options = parser.parse_args()
+    selected = selected_command(parser, argv)
+    for name in COMMANDS:
+        init_subcommand(subparsers, name, selected)
+    options = parser.parse_args(argv)
+    options.argv = argv
+    return options
+
 
+def log_level(options):
     lvl = getattr(logging, os.getenv('SILENT_LOG_LEVEL', 'WARNING'))
     if not options.silent:
         lvl = getattr(logging, os.getenv('LOG_LEVEL', 'INFO'))
     if options.debug:
         lvl = logging.DEBUG
+    return lvl
+
+
+def setup_logging(lvl):
     logging.basicConfig(
         level=lvl,
         format='%(asctime)s %(levelname)s\t%(message)s',
         datefmt='%Y-%m-%d %I:%M:%S')
 
+
+def execute(options, lvl):
+    ''' Run the subcommand of parsed options, returns exit code'''
+    if options.metrics or options.metrics_file:
+        metrics.enable()
+    if options.trace:
+        tracing.enable()
     try:
-        rc = options.cmd(options)
+        with tracing.span(options.cmd.__name__, 'command', argv=' '.join(options.argv)):
+            if options.profile:
+                # tracemalloc and cProfile are imported only when profiling
+                from azuread_aws import profiling
+                prefix = options.profile_output or f'aad-aws-{options.cmd.__name__}'
+                rc = profiling.run(options.profile, options.cmd, (options, ), prefix)
+            else:
+                rc = options.cmd(options)
         log.debug(f'Subcommand {options.cmd.__name__} returned {rc}')
         return rc if rc is not None else 0
 
@@ -66,6 +166,24 @@ def main():
             raise
         return 1
 
+    finally:
+        if metrics.enabled:
+            metrics.report(options.metrics_file or '-')
+        if tracing.enabled:
+            tracing.export(options.trace, options.trace_format)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # with AAD_AWS_DAEMON=1 subcommands are run by the resident daemon if it is running, see "aad-aws serve"
+    rc = daemon.forward(argv)
+    if rc is not None:
+        return rc
+    options = parse(argv)
+    lvl = log_level(options)
+    setup_logging(lvl)
+    return execute(options, lvl)
+
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,81 @@
+''' Local mirror of AzureAD users, groups and AWS app role assignments used by other commands.
+    Mirror is stored in SQLite database at AAD_AWS_DIRECTORY_DB path.
+'''
+import sys
+import json
+import time
+import logging
+
+from azuread_aws.azure import auth
+from azuread_aws.azure import directory
+from azuread_aws.azure import assignments
+
+log = logging.getLogger('directory')
+
+ASSIGNMENTS = 'assignments'
+COLLECTIONS = list(directory.COLLECTIONS) + [ASSIGNMENTS]
+
+
+def sync_directory(options):
+    '''Download changes of users, groups and app role assignments since the last sync into the local mirror.'''
+    token = auth.get_bearer_token('https://graph.microsoft.com')
+    for collection in options.collections or COLLECTIONS:
+        started = time.monotonic()
+        if collection == ASSIGNMENTS:
+            added, removed = assignments.refresh(token, full=options.full, path=options.db)
+            log.info('Synchronized %s in %.2fs: %d added, %d removed', collection, time.monotonic() - started, added, removed)
+            continue
+        upserted, removed = directory.sync(token, collection, full=options.full, path=options.db)
+        log.info('Synchronized %s in %.2fs: %d updated, %d removed', collection, time.monotonic() - started, upserted, removed)
+
+
+def show_directory_info(options):
+    '''Show number of mirrored objects and age of the local mirror.'''
+    if not directory.enabled(options.db):
+        raise Exception('Directory mirror does not exist, run "directory sync" first')
+    mirrored = directory.info(options.db)
+    mirrored[ASSIGNMENTS] = (assignments.count(options.db), assignments.refreshed_at(options.db))
+    for collection, (count, synced_at) in mirrored.items():
+        if synced_at is None:
+            log.info('%s: never synchronized', collection)
+            continue
+        log.info('%s: %d objects, synchronized %ds ago at %s', collection, count,
+                 time.time() - synced_at, time.ctime(synced_at))
+
+
+def list_assignments(options):
+    '''Print app role assignments from the local mirror as NDJSON.'''
+    if not directory.enabled(options.db) or assignments.refreshed_at(options.db) is None:
+        raise Exception('App role assignments are not mirrored, run "directory sync" first')
+    found = assignments.query(principal_id=options.principal, account_id=options.account,
+                              app_role_name=options.role, path=options.db)
+    for assignment in found:
+        sys.stdout.write(json.dumps(assignment) + '\n')
+    sys.stdout.flush()
+
+
+def arguments(parser):
+    subparsers = parser.add_subparsers(help=f'Subcommands for {__doc__}.')
+    subparsers.required = True
+    subparsers.dest = 'Directory subcommand missing'
+
+    sync_cmd = subparsers.add_parser('sync', help=sync_directory.__doc__)
+    sync_cmd.add_argument('-o', '--only', dest='collections', action='append', choices=COLLECTIONS,
+                          help='Synchronize only this collection, all by default. Can be repeated.')
+    sync_cmd.add_argument('--full', action='store_true', help='Download all objects instead of changes.')
+    sync_cmd.add_argument('--db', default=directory.DB_PATH,
+                          help='Path to the mirror database, AAD_AWS_DIRECTORY_DB by default.')
+    sync_cmd.set_defaults(cmd=sync_directory)
+
+    info_cmd = subparsers.add_parser('info', help=show_directory_info.__doc__)
+    info_cmd.add_argument('--db', default=directory.DB_PATH,
+                          help='Path to the mirror database, AAD_AWS_DIRECTORY_DB by default.')
+    info_cmd.set_defaults(cmd=show_directory_info)
+
+    assignments_cmd = subparsers.add_parser('assignments', help=list_assignments.__doc__)
+    assignments_cmd.add_argument('-p', '--principal', help='Only assignments of the user or group id.')
+    assignments_cmd.add_argument('-a', '--account', help='Only assignments to roles in the AWS account id.')
+    assignments_cmd.add_argument('-r', '--role', help='Only assignments to the app role name.')
+    assignments_cmd.add_argument('--db', default=directory.DB_PATH,
+                                 help='Path to the mirror database, AAD_AWS_DIRECTORY_DB by default.')
+    assignments_cmd.set_defaults(cmd=list_assignments)
@@ -1,21 +1,21 @@
 ''' Lookup and configure AWS SAML IDP for accounts of the AWS Organization.
     Requires valid AWS credentials in the master account of the organization.
 '''
-import os
-import pathlib
+import fnmatch
 import logging
-import threading
 import time
-import boto3
-import http.client
-import urllib.parse
+import collections
+import xml.etree.ElementTree
 
 from azuread_aws import amazon
+from azuread_aws import fanout
 from azuread_aws import http
 from azuread_aws.azure import constants
 
 log = logging.getLogger('idp')
 
+XMLDSIG_NS = 'http://www.w3.org/2000/09/xmldsig#'
+
 
 def validate_master_account():
     current_id = amazon.get_current_account()
@@ -27,60 +27,125 @@ def validate_master_account():
     return master_id
 
 
-def setup_saml_provider(resource, client, options, name='AAD'):
-    '''Setup AzureAD SAML Provider with federation metadata'''
-    for saml_provider in resource.saml_providers.all():
-        if name in saml_provider.arn:
-            if not options.recreate_saml_idp:
-                log.info(f'Found existing SAML IdP with ARN: {saml_provider.arn}')
-                return
-            # we found existing IdP and want to re-create it
-            saml_provider.delete()
-            break
-
-    metadata_url = f'https://login.microsoftonline.com/{constants.TENANT_ID}/federationmetadata/2007-06/federationmetadata.xml?appid={constants.CLIENT_ID}'
+def get_federation_metadata():
+    '''Download and validate AzureAD federation metadata document of the application'''
+    metadata_url = f'{constants.LOGIN_URL}/{constants.TENANT_ID}/federationmetadata/2007-06/federationmetadata.xml?appid={constants.CLIENT_ID}'
     log.info(f'Reading SAML metadata from {metadata_url}')
-    metadata = http.get(metadata_url).text
-    if not len(metadata):
+    response = http.get(metadata_url)
+    metadata = response.text
+    if not response.ok or not metadata:
         raise Exception(f'Failed to get metadata from {metadata_url}')
+    try:
+        root = xml.etree.ElementTree.fromstring(metadata)
+    except xml.etree.ElementTree.ParseError as ex:
+        raise Exception(f'Invalid metadata document from {metadata_url} - {ex}')
+    if not root.tag.endswith('EntityDescriptor') or root.find(f'.//{{{XMLDSIG_NS}}}X509Certificate') is None:
+        raise Exception(f'Metadata document from {metadata_url} has no signing certificate')
+    return metadata
+
+
+def setup_saml_provider(client, metadata, recreate=False, name='AAD'):
+    ''' Setup AzureAD SAML Provider with federation metadata.
+        Returns tuple of outcome (created, present or recreated) and provider ARN.
+    '''
+    outcome = 'created'
+    for saml_provider in client.list_saml_providers()['SAMLProviderList']:
+        if name in saml_provider['Arn']:
+            if not recreate:
+                log.debug(f'Found existing SAML IdP with ARN: {saml_provider["Arn"]}')
+                return 'present', saml_provider['Arn']
+            # we found existing IdP and want to re-create it
+            client.delete_saml_provider(SAMLProviderArn=saml_provider['Arn'])
+            outcome = 'recreated'
+            break
 
     created_arn = client.create_saml_provider(
         Name=name,
         SAMLMetadataDocument=metadata)['SAMLProviderArn']
-    log.info(f'Created SAML IdP with ARN: {created_arn}')
-    return created_arn
+    return outcome, created_arn
+
+
+def find_saml_providers(account_id, name='AAD'):
+    '''Returns ARNs of SAML providers matching name in the account'''
+    providers = amazon.client('iam', account_id).list_saml_providers()['SAMLProviderList']
+    return [p['Arn'] for p in providers if name in p['Arn']]
 
 
 def ls(options):
     '''List identity providers across organizational accounts.'''
     master_id = validate_master_account()
-    orgs = boto3.client('organizations')
-    accounts = amazon.list_accounts(orgs)
+    orgs = amazon.client('organizations')
+    accounts = {no: name for name, no in amazon.list_accounts(orgs).items() if no != master_id}
     log.info(f'Listing identity providers in {len(accounts)} accounts of the organization.')
-    for account_name, account_id in accounts.items():
-        if account_id == master_id:
-            continue
-        try:
-            account_resources = amazon.resource('iam', account_id)
-            found = False
-            for saml_provider in account_resources.saml_providers.all():
-                if 'AAD' in saml_provider.arn:
-                    log.info(f'Found SAML provider [{saml_provider.arn}] in {account_name} ({account_id})')
-                    found = True
-                    break
-            if not found:
-                log.info(f'No SAML rovider found in account {account_name} ({account_id})')
-        except Exception as ex:
-            log.warning(f'Failed to assume role in {account_id}')
+
+    started = time.monotonic()
+    results = []
+    for result in fanout.run(find_saml_providers, accounts, options.concurrency, options.timeout):
+        account_name = accounts[result.key]
+        results.append(result)
+        if not result.ok:
+            log.warning(f'Failed to list SAML providers in {account_name} ({result.key}) '
+                        f'- {result.error.__class__.__name__}: {result.error}')
+        elif not result.value:
+            log.info(f'No SAML provider found in account {account_name} ({result.key})')
+        for arn in result.value or []:
+            log.info(f'Found SAML provider [{arn}] in {account_name} ({result.key})')
+
+    fanout.report(results, time.monotonic() - started, log)
+    if any(not r.ok for r in results):
+        return 1
+
+
+def select_accounts(accounts, include=None, exclude=None):
+    '''Filter map of account id to name by glob patterns matched against both id and name'''
+    def matches(patterns, no, name):
+        return any(fnmatch.fnmatch(no, p) or fnmatch.fnmatch(name, p) for p in patterns)
+
+    return {no: name for no, name in accounts.items()
+            if (not include or matches(include, no, name)) and not (exclude and matches(exclude, no, name))}
 
 
 def configure(options):
-    '''Create or Update identity provider of specific account.'''
-    validate_master_account()
+    '''Create or Update identity provider of specific account or all accounts.'''
+    master_id = validate_master_account()
+    if not options.all:
+        if not options.account_id:
+            raise Exception('Either account id or --all must be specified')
+        metadata = get_federation_metadata()
+        outcome, arn = setup_saml_provider(amazon.client('iam', options.account_id), metadata,
+                                           options.recreate_saml_idp)
+        log.info(f'SAML IdP {outcome} with ARN: {arn}')
+        return
+
+    orgs = amazon.client('organizations')
+    accounts = {no: name for name, no in amazon.list_accounts(orgs).items() if no != master_id}
+    accounts = select_accounts(accounts, options.include, options.exclude)
+    log.info(f'Configuring SAML IdP in {len(accounts)} accounts of the organization.')
+    # metadata is fetched once and shared by all workers
+    metadata = get_federation_metadata()
+
+    def configure_account(account_id):
+        return setup_saml_provider(amazon.client('iam', account_id), metadata, options.recreate_saml_idp)
+
+    started = time.monotonic()
+    results = []
+    outcomes = collections.Counter()
+    for result in fanout.run(configure_account, accounts, options.concurrency, options.timeout):
+        account_name = accounts[result.key]
+        results.append(result)
+        if not result.ok:
+            outcomes['failed'] += 1
+            log.warning(f'Failed to configure SAML IdP in {account_name} ({result.key}) in {result.elapsed:.2f}s '
+                        f'- {result.error.__class__.__name__}: {result.error}')
+            continue
+        outcome, arn = result.value
+        outcomes[outcome] += 1
+        log.info(f'SAML IdP {outcome} in {account_name} ({result.key}) in {result.elapsed:.2f}s: {arn}')
 
-    iam_client = amazon.client('iam', options.account_id)
-    iam_resource = amazon.resource('iam', options.account_id)
-    setup_saml_provider(iam_resource, iam_client, options)
+    log.info('Outcomes: ' + ', '.join(f'{k}: {outcomes[k]}' for k in ('created', 'present', 'recreated', 'failed')))
+    fanout.report(results, time.monotonic() - started, log)
+    if outcomes['failed']:
+        return 1
 
 
 def arguments(parser):
@@ -89,11 +154,25 @@ def arguments(parser):
     subparsers.dest = 'IDP subcommand missing'
 
     list_cmd = subparsers.add_parser('ls', help=ls.__doc__)
+    list_cmd.add_argument('-c', '--concurrency', type=int, default=fanout.DEFAULT_CONCURRENCY,
+                          help='Number of accounts to query in parallel.')
+    list_cmd.add_argument('-t', '--timeout', type=float, default=120,
+                          help='Seconds to wait for a single account.')
     list_cmd.set_defaults(cmd=ls)
 
     cfg_cmd = subparsers.add_parser('configure', help=configure.__doc__)
-    cfg_cmd.add_argument('account_id', help='Account ID within organization to setup SAML IdP')
+    cfg_cmd.add_argument('account_id', nargs='?', help='Account ID within organization to setup SAML IdP')
     cfg_cmd.add_argument('--recreate-saml-idp',
                          action='store_true',
                          help='Re-create SAML IdP if already exists in the account')
+    cfg_cmd.add_argument('--all', action='store_true',
+                         help='Configure SAML IdP in all accounts of the organization')
+    cfg_cmd.add_argument('-i', '--include', action='append',
+                         help='With --all, only accounts with id or name matching the glob pattern. Can be repeated.')
+    cfg_cmd.add_argument('-x', '--exclude', action='append',
+                         help='With --all, skip accounts with id or name matching the glob pattern. Can be repeated.')
+    cfg_cmd.add_argument('-c', '--concurrency', type=int, default=fanout.DEFAULT_CONCURRENCY,
+                         help='Number of accounts to configure in parallel.')
+    cfg_cmd.add_argument('-t', '--timeout', type=float, default=120,
+                         help='Seconds to wait for a single account.')
     cfg_cmd.set_defaults(cmd=configure)
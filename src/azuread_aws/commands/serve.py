@@ -0,0 +1,35 @@
+''' Resident daemon running subcommands for local clients over a Unix domain socket.
+    While it is running, "aad-aws" with AAD_AWS_DAEMON=1 forwards subcommands to it to reuse warm tokens,
+    sessions and caches.
+'''
+import json
+import logging
+
+from azuread_aws import daemon
+
+log = logging.getLogger('serve')
+
+
+def serve(options):
+    '''Run the daemon in foreground, or report status or stop the running one.'''
+    if options.status or options.stop:
+        response = daemon.control('stop' if options.stop else 'status', options.socket)
+        if response is None:
+            log.info(f'Daemon is not running on {options.socket}')
+            return 1
+        if options.status:
+            print(json.dumps(response))
+        else:
+            log.info(f'Daemon on {options.socket} is stopping')
+        return 0
+    daemon.serve(options.socket, options.idle_timeout)
+
+
+def arguments(parser):
+    parser.add_argument('--socket', default=daemon.SOCKET_PATH,
+                        help='Path of the Unix domain socket, AAD_AWS_SOCKET by default.')
+    parser.add_argument('--idle-timeout', type=int, default=0,
+                        help='Stop after this many seconds without requests, never by default.')
+    parser.add_argument('--status', action='store_true', help='Print status of the running daemon.')
+    parser.add_argument('--stop', action='store_true', help='Stop the running daemon.')
+    parser.set_defaults(cmd=serve)
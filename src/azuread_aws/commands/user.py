@@ -1,66 +1,200 @@
 ''' List assigned and assign new Azure AD Application Roles, representing AWS IAM Roles
     in the organization accounts. AWS IAM Roles must be created and SAML IDP configured before.
 '''
-import os
+import sys
+import csv
 import json
-import uuid
+import time
 import logging
+import threading
+import collections
+import concurrent.futures
 
-from azuread_aws import amazon
-from azuread_aws import http
-
-from azuread_aws.commands.app_role import find_app_role_by_name
+from azuread_aws import fanout
 
 from azuread_aws.azure import auth
 from azuread_aws.azure import graph_api
+from azuread_aws.azure.catalog import AppRoleCatalog, APPLICATION_FIELDS
 
 log = logging.getLogger('app_role')
 
+USER_FIELDS = ('id', 'displayName')
+ASSIGNMENT_FIELDS = ('id', 'appRoleId')
+
 
 def assign_user(options):
     '''Assign specified AWS App Role to a user.'''
     graph_token = auth.get_bearer_token('https://graph.microsoft.com')
-    user = graph_api.find_user_by_email(graph_token, options.user_email)
+    user = graph_api.find_user_by_email(graph_token, options.user_email, select=USER_FIELDS)
     if not user:
         raise Exception(f'User with email [{options.user_email}] was not found.')
     user = user[0]
     log.info('Assigning user id: %s, name: %s', user['id'], user['displayName'])
 
-    application = graph_api.get_application(graph_token)
-    app_role = find_app_role_by_name(options.role_name, application['appRoles'])
-    if not app_role:
+    catalog = AppRoleCatalog.from_application(graph_api.get_application(graph_token, select=APPLICATION_FIELDS))
+    info = catalog.find_by_name(options.role_name)
+    if not info:
         raise Exception(f'AWS App role with name {options.role_name} was not found')
-    log.info('To app role id: %s, name: %s', app_role['id'], app_role['displayName'])
-    aws_role_name, aws_account = app_role['description'].split('@')
-    log.info('To AWS role name: %s, account id: %s', aws_role_name, aws_account)
+    log.info('To app role id: %s, name: %s', info.id, info.name)
+    log.info('To AWS role name: %s, account id: %s', info.aws_role_name, info.account_id)
 
-    assignments = graph_api.get_user_app_roles(graph_token, user['id'])
-    existing_role_ids = [a['appRoleId'] for a in assignments]
-    if app_role['id'] in existing_role_ids:
+    assignments = graph_api.get_user_app_roles(graph_token, user['id'], select=ASSIGNMENT_FIELDS)
+    if any(a['appRoleId'] == info.id for a in assignments):
         raise Exception(f'AWS App role {options.role_name} is already assigned to {options.user_email}')
 
-    graph_api.assign_user_to_app_role(graph_token, user['id'], app_role['id'])
+    graph_api.assign_user_to_app_role(graph_token, user['id'], info.id)
+
+
+class UserResolver:
+    ''' Looks up users by email together with their app role assignments.
+        Concurrent lookups of the same email share a single request, at most maxsize
+        resolved users are remembered.
+    '''
+
+    def __init__(self, graph_token, maxsize=10000):
+        self.graph_token = graph_token
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, email):
+        users = graph_api.find_user_by_email(self.graph_token, email, select=USER_FIELDS)
+        if not users:
+            raise Exception(f'User with email [{email}] was not found.')
+        user = users[0]
+        assignments = graph_api.get_user_app_roles(self.graph_token, user['id'], select=ASSIGNMENT_FIELDS)
+        return {
+            'user': user,
+            'assigned': set(a['appRoleId'] for a in assignments),
+            'lock': threading.Lock(),
+        }
+
+    def resolve(self, email):
+        key = email.lower()
+        with self._lock:
+            future = self._entries.get(key)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._entries[key] = future
+                if len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(key)
+        if owner:
+            try:
+                future.set_result(self._lookup(email))
+            except Exception as ex:
+                future.set_exception(ex)
+        return future.result()
+
+
+def read_assignments(stream, fmt):
+    ''' Yields tuples of (line number, email, role name) from CSV or NDJSON stream.
+        Malformed lines are yielded with email set to None.
+    '''
+    if fmt == 'ndjson':
+        for line_no, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+                yield line_no, row['email'], row['role']
+            except (ValueError, KeyError, TypeError):
+                yield line_no, None, line
+        return
+
+    for line_no, row in enumerate(csv.reader(stream), 1):
+        if not row or row[0].startswith('#'):
+            continue
+        if len(row) < 2:
+            yield line_no, None, ','.join(row)
+            continue
+        email, role_name = row[0].strip(), row[1].strip()
+        if line_no == 1 and (email.lower(), role_name.lower()) == ('email', 'role'):
+            continue
+        yield line_no, email, role_name
+
+
+def assign_users_bulk(options):
+    '''Assign AWS App Roles to users from a CSV or NDJSON stream of email and role pairs.'''
+    graph_token = auth.get_bearer_token('https://graph.microsoft.com')
+    catalog = AppRoleCatalog.from_application(graph_api.get_application(graph_token, select=APPLICATION_FIELDS))
+    resolver = UserResolver(graph_token)
+    log.info('Loaded application manifest with %d app roles', len(catalog))
+
+    def assign(row):
+        _, email, role_name = row
+        if email is None:
+            raise Exception(f'Malformed input: {role_name}')
+        info = catalog.find_by_name(role_name)
+        if not info:
+            raise Exception(f'AWS App role with name {role_name} was not found')
+        entry = resolver.resolve(email)
+        user = entry['user']
+        with entry['lock']:
+            if info.id in entry['assigned']:
+                return 'already-assigned', user['id'], None
+            entry['assigned'].add(info.id)
+        try:
+            assignment = graph_api.assign_user_to_app_role(graph_token, user['id'], info.id)
+        except Exception:
+            with entry['lock']:
+                entry['assigned'].discard(info.id)
+            raise
+        return 'assigned', user['id'], assignment.get('id')
+
+    fmt = options.format
+    if not fmt:
+        fmt = 'ndjson' if options.input.endswith(('.ndjson', '.jsonl')) else 'csv'
+    source = sys.stdin if options.input == '-' else open(options.input, 'r', newline='')
+    output = sys.stdout if options.output == '-' else open(options.output, 'w')
+    started = time.monotonic()
+    counts = collections.Counter()
+    try:
+        for result in fanout.run(assign, read_assignments(source, fmt), options.concurrency):
+            line_no, email, role_name = result.key
+            record = {'line': line_no, 'email': email, 'role': role_name, 'elapsed': round(result.elapsed, 3)}
+            if result.ok:
+                record['status'], record['user_id'], record['assignment_id'] = result.value
+            else:
+                record['status'] = 'failed'
+                record['error'] = f'{result.error.__class__.__name__} - {result.error}'
+            counts[record['status']] += 1
+            output.write(json.dumps(record) + '\n')
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+        else:
+            output.flush()
+
+    log.info('Processed %d assignments in %.2fs: %s', sum(counts.values()), time.monotonic() - started,
+             ', '.join(f'{k}: {v}' for k, v in sorted(counts.items())))
+    if counts['failed']:
+        return 1
 
 
 def unassign_user(options):
     '''Remove assignment of AWS App Role from a user.'''
     graph_token = auth.get_bearer_token('https://graph.microsoft.com')
-    user = graph_api.find_user_by_email(graph_token, options.user_email)
+    user = graph_api.find_user_by_email(graph_token, options.user_email, select=USER_FIELDS)
     if not user:
         raise Exception(f'User with email [{options.user_email}] was not found.')
     user = user[0]
     log.info('Unassigning user id: %s, name: %s', user['id'], user['displayName'])
 
-    application = graph_api.get_application(graph_token)
-    app_role = find_app_role_by_name(options.role_name, application['appRoles'])
-    if not app_role:
+    catalog = AppRoleCatalog.from_application(graph_api.get_application(graph_token, select=APPLICATION_FIELDS))
+    info = catalog.find_by_name(options.role_name)
+    if not info:
         raise Exception(f'AWS App role with name {options.role_name} was not found')
-    log.info('From app role id: %s, name: %s', app_role['id'], app_role['displayName'])
-    aws_role_name, aws_account = app_role['description'].split('@')
-    log.info('From AWS role name: %s, account id: %s', aws_role_name, aws_account)
+    log.info('From app role id: %s, name: %s', info.id, info.name)
+    log.info('From AWS role name: %s, account id: %s', info.aws_role_name, info.account_id)
 
-    assignments = graph_api.get_user_app_roles(graph_token, user['id'])
-    assignment = [a for a in assignments if a['appRoleId'] == app_role['id']]
+    assignments = graph_api.get_user_app_roles(graph_token, user['id'], select=ASSIGNMENT_FIELDS)
+    assignment = [a for a in assignments if a['appRoleId'] == info.id]
     if not assignment:
         raise Exception(f'AWS App role {options.role_name} is not assigned to {options.user_email}')
 
@@ -72,27 +206,23 @@ def unassign_user(options):
 def show_user_info(options):
     '''Lookup user by email and show app role assignments.'''
     graph_token = auth.get_bearer_token('https://graph.microsoft.com')
-    user = graph_api.find_user_by_email(graph_token, options.user_email)
+    user = graph_api.find_user_by_email(graph_token, options.user_email, select=USER_FIELDS)
     if not user:
         raise Exception(f'User with email [{options.user_email}] was not found.')
     user = user[0]
-    application = graph_api.get_application(graph_token)
-    assignments = graph_api.get_user_app_roles(graph_token, user['id'])
-    app_role_ids = [a['appRoleId'] for a in assignments]
-    app_roles = []
-    app_roles = [app_role for app_role in application['appRoles'] if app_role['id'] in app_role_ids]
+    catalog = AppRoleCatalog.from_application(graph_api.get_application(graph_token, select=APPLICATION_FIELDS))
+    assignments = graph_api.get_user_app_roles(graph_token, user['id'], select=ASSIGNMENT_FIELDS)
+    app_roles = [catalog.get(a['appRoleId']) for a in assignments if a['appRoleId'] in catalog]
     if not app_roles:
         log.info(f'No AWS App Roles assigned to {options.user_email}')
         return 0
     log.info('User id: %s, name: %s', user['id'], user['displayName'])
     log.info('Assignments:')
-    for app_role in app_roles:
-        app_role_name = app_role['displayName']
-        if app_role['value']:
-            role_arn, idp_arn = app_role['value'].split(',')
-            log.info('Role id: %s, name: %s, AWS Role Arn: %s', app_role['id'], app_role_name, role_arn)
+    for info in app_roles:
+        if info.role_arn:
+            log.info('Role id: %s, name: %s, AWS Role Arn: %s', info.id, info.name, info.role_arn)
         else:
-            log.info('Role id: %s, name: %s, ---', app_role['id'], app_role_name)
+            log.info('Role id: %s, name: %s, ---', info.id, info.name)
 
 
 def arguments(parser):
@@ -109,6 +239,15 @@ def arguments(parser):
     assign_cmd.add_argument('role_name', help='AzureAD App Role name to assign.')
     assign_cmd.set_defaults(cmd=assign_user)
 
+    bulk_cmd = subparsers.add_parser('assign-bulk', help=assign_users_bulk.__doc__)
+    bulk_cmd.add_argument('input', help='CSV (email,role) or NDJSON ({"email", "role"}) file, "-" for stdin.')
+    bulk_cmd.add_argument('-f', '--format', choices=['csv', 'ndjson'],
+                          help='Input format. Defaults to NDJSON for .ndjson/.jsonl files and CSV otherwise.')
+    bulk_cmd.add_argument('-o', '--output', default='-', help='File to write NDJSON results to, stdout by default.')
+    bulk_cmd.add_argument('-c', '--concurrency', type=int, default=fanout.DEFAULT_CONCURRENCY,
+                          help='Number of assignments to process in parallel.')
+    bulk_cmd.set_defaults(cmd=assign_users_bulk)
+
     remove_cmd = subparsers.add_parser('unassign', help=unassign_user.__doc__)
     remove_cmd.add_argument('user_email', help='Email name of the user')
     remove_cmd.add_argument('role_name', help='AzureAD App Role name to remove.')
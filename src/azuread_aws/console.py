@@ -0,0 +1,77 @@
+''' Per thread routing of standard output, standard error and log level. The daemon runs requests
+    of several clients at once, output of each request is sent to its own client.
+    fanout.run passes the routing of the caller to its workers, other thread pools wrap their work with bind().
+'''
+import sys
+import logging
+import contextlib
+import threading
+
+_local = threading.local()
+
+
+class Router:
+    ''' File object writing to the stream set for the current thread, or to the default one'''
+
+    def __init__(self, name, default):
+        self.name = name
+        self.default = default
+
+    def target(self):
+        return getattr(_local, self.name, None) or self.default
+
+    def write(self, data):
+        return self.target().write(data)
+
+    def writelines(self, lines):
+        return self.target().writelines(lines)
+
+    def flush(self):
+        return self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.target(), name)
+
+
+class LevelFilter(logging.Filter):
+    ''' Drops records below the log level set for the current thread'''
+
+    def filter(self, record):
+        level = getattr(_local, 'level', None)
+        return level is None or record.levelno >= level
+
+
+def install():
+    ''' Replace sys.stdout and sys.stderr with routers, must be called before logging is configured'''
+    if not isinstance(sys.stdout, Router):
+        sys.stdout = Router('stdout', sys.stdout)
+    if not isinstance(sys.stderr, Router):
+        sys.stderr = Router('stderr', sys.stderr)
+
+
+def current():
+    ''' Returns tuple of (stdout, stderr, log level) of the current thread, None if not set'''
+    return getattr(_local, 'stdout', None), getattr(_local, 'stderr', None), getattr(_local, 'level', None)
+
+
+@contextlib.contextmanager
+def redirect(stdout=None, stderr=None, level=None):
+    ''' Route output and set log level of the current thread within the block'''
+    previous = current()
+    _local.stdout, _local.stderr, _local.level = stdout, stderr, level
+    try:
+        yield
+    finally:
+        _local.stdout, _local.stderr, _local.level = previous
+
+
+def bind(func):
+    ''' Returns func writing output where the current thread does, to be submitted to a thread pool'''
+    routing = current()
+    if routing == (None, None, None):
+        return func
+
+    def bound(*args, **kwargs):
+        with redirect(*routing):
+            return func(*args, **kwargs)
+    return bound
@@ -0,0 +1,346 @@
+''' Resident daemon running subcommands for local clients over a Unix domain socket.
+    Graph tokens, boto3 sessions and clients, assumed role credentials, connection pools and
+    parsed manifests stay warm between requests, so small subcommands answer in milliseconds.
+
+    "aad-aws serve" listens on AAD_AWS_SOCKET (default $XDG_RUNTIME_DIR/aad-aws/daemon.sock)
+    and runs requests concurrently, each in its own thread. The socket is accessible to the
+    current user only. Forwarding is opt-in: with AAD_AWS_DAEMON=1 "aad-aws" forwards subcommands
+    to the daemon while the socket exists. Requests are not forwarded if they read stdin
+    ("-" argument) or use global options with process wide state: --debug, --metrics, --trace
+    or --profile.
+
+    Requests run with credentials of the daemon, so the daemon refuses requests of clients whose
+    AZURE_*, AWS_* or AAD_AWS_* environment differs from its own and the client runs them itself.
+    Relative paths of file options are resolved against the working directory of the client.
+
+    Protocol is JSON lines. Client sends {"argv": [...], "cwd": "...", "env": {...}} or
+    {"control": "status|stop"}. Daemon responds with {"refused": "reason"}, or {"accepted": true}
+    followed by {"stdout": "..."} and {"stderr": "..."} output, {"heartbeat": seconds} while the
+    command runs and {"rc": exit code}. Client gives up after AAD_AWS_DAEMON_TIMEOUT seconds
+    (default 30) without a message.
+'''
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import struct
+import logging
+import threading
+
+log = logging.getLogger('daemon')
+
+SOCKET_PATH = os.getenv('AAD_AWS_SOCKET') or os.path.join(
+    os.getenv('XDG_RUNTIME_DIR') or os.path.expanduser('~/.cache'), 'aad-aws', 'daemon.sock')
+FORWARD = os.getenv('AAD_AWS_DAEMON', '0') == '1'
+TIMEOUT = float(os.getenv('AAD_AWS_DAEMON_TIMEOUT', '30'))
+# running requests send a heartbeat this often, so that the client can tell a busy daemon from a hung one
+HEARTBEAT = 5
+# variables configuring commands, requests are run by the daemon only if they are the same in the client
+ENVIRONMENT_PREFIXES = ('AZURE_', 'AWS_', 'AAD_AWS_')
+# variables of the client side only
+CLIENT_VARIABLES = ('AAD_AWS_DAEMON', 'AAD_AWS_DAEMON_TIMEOUT', 'AAD_AWS_SOCKET')
+# global options changing process wide state, such requests run in the client process
+LOCAL_OPTIONS = ('-d', '--debug', '--metrics', '--metrics-file', '--trace', '--trace-format', '--profile', '--profile-output')
+# options of subcommands with file paths
+PATH_OPTIONS = ('input', 'output', 'from_file', 'db')
+# output of a request is sent to the client in chunks of this size or on flush
+BUFFER_SIZE = 64 * 1024
+
+
+def forwardable(argv):
+    ''' True if the command line can be run by the daemon'''
+    if '-' in argv:
+        return False
+    for arg in argv:
+        if not arg.startswith('-'):
+            # global options end at the subcommand
+            return arg != 'serve'
+        if arg.split('=', 1)[0] in LOCAL_OPTIONS or (not arg.startswith('--') and 'd' in arg[1:]):
+            return False
+    return False
+
+
+def environment(environ=None):
+    ''' Returns variables of the environment which configure commands'''
+    environ = os.environ if environ is None else environ
+    return {name: value for name, value in environ.items()
+            if name.startswith(ENVIRONMENT_PREFIXES) and name not in CLIENT_VARIABLES}
+
+
+def connect(path=SOCKET_PATH, timeout=TIMEOUT):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def send(sock, message):
+    sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+
+def receive(sock):
+    ''' Write output of the request to stdout and stderr, returns exit code
+        or None if the daemon refused the request.
+    '''
+    try:
+        for line in sock.makefile('r', encoding='utf-8'):
+            message = json.loads(line)
+            if 'stdout' in message:
+                sys.stdout.write(message['stdout'])
+            elif 'stderr' in message:
+                sys.stderr.write(message['stderr'])
+                sys.stderr.flush()
+            elif 'rc' in message:
+                sys.stdout.flush()
+                return message['rc']
+            elif 'refused' in message:
+                log.debug('Daemon refused the request: %s', message['refused'])
+                return None
+    except socket.timeout:
+        sys.stdout.flush()
+        sys.stderr.write(f'aad-aws daemon did not respond in {sock.gettimeout():.0f} seconds\n')
+        return 1
+    sys.stderr.write('aad-aws daemon closed connection before the command completed\n')
+    return 1
+
+
+def forward(argv, path=SOCKET_PATH):
+    ''' Run the command line in the daemon, returns exit code or None if it must run in this process'''
+    if not FORWARD or not forwardable(argv) or not os.path.exists(path):
+        return None
+    try:
+        sock = connect(path)
+    except OSError:
+        # socket of a daemon which was killed
+        return None
+    with sock:
+        send(sock, {'argv': list(argv), 'cwd': os.getcwd(), 'env': environment()})
+        return receive(sock)
+
+
+def control(command, path=SOCKET_PATH):
+    ''' Send control command to the daemon, returns its response or None if it is not running'''
+    try:
+        sock = connect(path)
+    except OSError:
+        return None
+    with sock:
+        try:
+            send(sock, {'control': command})
+            line = sock.makefile('r', encoding='utf-8').readline()
+        except OSError:
+            # including timeout of a hung daemon
+            return None
+        return json.loads(line) if line else None
+
+
+class Connection:
+    ''' Client connection shared by output streams of a request'''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        data = (json.dumps(message) + '\n').encode('utf-8')
+        with self._lock:
+            if self.closed:
+                return
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                # client has gone, the command keeps running to completion
+                self.closed = True
+
+
+class ClientStream:
+    ''' Text stream of a request sending buffered output to the client'''
+    encoding = 'utf-8'
+
+    def __init__(self, name, connection):
+        self.name = name
+        self.connection = connection
+        self._buffer = []
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        with self._lock:
+            self._buffer.append(data)
+            self._size += len(data)
+            full = self._size >= BUFFER_SIZE
+        if full:
+            self.flush()
+        return len(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        with self._lock:
+            data, self._buffer, self._size = ''.join(self._buffer), [], 0
+        if data:
+            self.connection.send({self.name: data})
+
+    def isatty(self):
+        return False
+
+
+def peer_uid(sock):
+    ''' Returns user id of the connected process, or None where SO_PEERCRED is not supported'''
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+def run(argv, cwd, connection):
+    ''' Run the command line with output sent to the client connection, returns exit code'''
+    from azuread_aws import console
+    from azuread_aws.commands import cli
+
+    stdout = ClientStream('stdout', connection)
+    stderr = ClientStream('stderr', connection)
+    try:
+        with console.redirect(stdout, stderr):
+            try:
+                options = cli.parse(argv)
+            except SystemExit as ex:
+                # argparse usage errors and help
+                return ex.code if isinstance(ex.code, int) else (0 if ex.code is None else 1)
+            for name in PATH_OPTIONS:
+                value = getattr(options, name, None)
+                if isinstance(value, str) and value != '-' and cwd and not os.path.isabs(value):
+                    setattr(options, name, os.path.join(cwd, value))
+            lvl = cli.log_level(options)
+            with console.redirect(stdout, stderr, lvl):
+                return cli.execute(options, lvl)
+    finally:
+        stdout.flush()
+        stderr.flush()
+
+
+def serve(path=SOCKET_PATH, idle_timeout=0):
+    ''' Listen on the socket and run requests until stopped, SIGTERM, SIGINT or idle timeout'''
+    import socketserver
+    from azuread_aws import console
+
+    state = {'started': time.time(), 'requests': 0, 'active': 0, 'last': time.monotonic()}
+    # environment of requests is compared with the one the daemon was started with
+    environ = environment()
+    state_lock = threading.Lock()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            uid = peer_uid(self.request)
+            if uid is not None and uid != os.getuid():
+                log.warning('Rejected connection of user %d', uid)
+                return
+            line = self.rfile.readline()
+            if not line:
+                return
+            message = json.loads(line)
+            connection = Connection(self.request)
+            command = message.get('control')
+            if command == 'status':
+                with state_lock:
+                    connection.send({'pid': os.getpid(), 'socket': path, 'uptime': round(time.time() - state['started'], 3),
+                                     'requests': state['requests'], 'active': state['active'],
+                                     'idle': round(time.monotonic() - state['last'], 3)})
+                return
+            if command == 'stop':
+                connection.send({'rc': 0})
+                threading.Thread(target=server.shutdown).start()
+                return
+
+            client_environ = message.get('env') or {}
+            if client_environ != environ:
+                # names only, values may be secrets
+                changed = sorted(name for name in set(client_environ) | set(environ) if client_environ.get(name) != environ.get(name))
+                log.info('Refused %s, environment differs: %s', ' '.join(message['argv']), ', '.join(changed))
+                connection.send({'refused': f'environment differs: {", ".join(changed)}'})
+                return
+            connection.send({'accepted': True})
+
+            with state_lock:
+                state['requests'] += 1
+                state['active'] += 1
+            started = time.monotonic()
+            done = threading.Event()
+
+            def heartbeat():
+                while not done.wait(HEARTBEAT):
+                    connection.send({'heartbeat': round(time.monotonic() - started, 1)})
+            threading.Thread(target=heartbeat, name='daemon-heartbeat', daemon=True).start()
+            try:
+                rc = run(message['argv'], message.get('cwd'), connection)
+            except Exception as ex:
+                log.exception('Request %s failed', message.get('argv'))
+                connection.send({'stderr': f'{ex.__class__.__name__} - {ex}\n'})
+                rc = 1
+            finally:
+                done.set()
+                with state_lock:
+                    state['active'] -= 1
+                    state['last'] = time.monotonic()
+            connection.send({'rc': rc})
+            log.debug('Completed %s with %s in %.3fs', ' '.join(message['argv']), rc, time.monotonic() - started)
+
+    class Server(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    if os.path.exists(path):
+        if control('status', path) is not None:
+            raise Exception(f'Daemon is already running on {path}')
+        os.unlink(path)
+    # socket is accessible to the current user only
+    umask = os.umask(0o177)
+    try:
+        server = Server(path, Handler)
+    finally:
+        os.umask(umask)
+    os.chmod(path, 0o600)
+
+    # output and log records of every request go to its client
+    stderr = sys.stderr
+    console.install()
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.StreamHandler) and handler.stream is stderr:
+            handler.stream = sys.stderr
+        handler.addFilter(console.LevelFilter())
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    if idle_timeout:
+        def watch():
+            while True:
+                time.sleep(min(idle_timeout, 10))
+                with state_lock:
+                    idle = state['active'] == 0 and time.monotonic() - state['last'] > idle_timeout
+                if idle:
+                    log.info('Idle for %d seconds, stopping', idle_timeout)
+                    server.shutdown()
+                    return
+        threading.Thread(target=watch, name='daemon-idle', daemon=True).start()
+
+    log.info('Serving on %s, pid %d', path, os.getpid())
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+    log.info('Stopped after %d requests', state['requests'])
@@ -0,0 +1,107 @@
+''' Bounded thread pool fan-out of independent units of work, such as per account
+    calls across the AWS Organization. Results are streamed in completion order.
+'''
+import time
+import logging
+import concurrent.futures
+
+from azuread_aws import console
+from azuread_aws import tracing
+
+log = logging.getLogger('fanout')
+
+DEFAULT_CONCURRENCY = 16
+
+
+class WorkTimeout(Exception):
+    pass
+
+
+class Result:
+    '''Outcome of a single unit of work'''
+    __slots__ = ('key', 'value', 'error', 'elapsed')
+
+    def __init__(self, key, value=None, error=None, elapsed=0.0):
+        self.key = key
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def _timed(func, key, started, parent=None, streams=(None, None, None)):
+    started.append(time.monotonic())
+    with console.redirect(*streams), tracing.span(getattr(func, '__name__', 'work'), 'work', parent, key=key) as span:
+        try:
+            return func(key), None, time.monotonic() - started[0]
+        except Exception as ex:
+            if span is not None:
+                span.error = f'{ex.__class__.__name__}: {ex}'
+            return None, ex, time.monotonic() - started[0]
+
+
+def run(func, keys, concurrency=DEFAULT_CONCURRENCY, timeout=None):
+    ''' Call func(key) for every key using at most concurrency threads and
+        yield Result for each key in completion order.
+        Keys are consumed lazily, at most 2 * concurrency of them are queued at once.
+        A call running longer than timeout seconds is reported as failed with WorkTimeout.
+        Python threads can not be interrupted, so a timed out call keeps its worker until it returns.
+    '''
+    keys = iter(keys)
+    pending = {}
+    poll = min(1.0, timeout) if timeout else None
+    # units of work are traced as children of the caller span and write output where the caller does
+    parent = tracing.current()
+    streams = console.current()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < 2 * concurrency:
+                try:
+                    key = next(keys)
+                except StopIteration:
+                    exhausted = True
+                    break
+                started = []
+                pending[executor.submit(_timed, func, key, started, parent, streams)] = (key, started)
+
+            if not pending:
+                break
+
+            done, _ = concurrent.futures.wait(pending, timeout=poll,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                key, _ = pending.pop(future)
+                value, error, elapsed = future.result()
+                yield Result(key, value, error, elapsed)
+
+            if timeout:
+                now = time.monotonic()
+                for future, (key, started) in list(pending.items()):
+                    if started and now - started[0] > timeout:
+                        del pending[future]
+                        yield Result(key, error=WorkTimeout(f'Timed out after {timeout} seconds'),
+                                     elapsed=now - started[0])
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def report(results, elapsed, logger=log):
+    ''' Log summary of failures, total and per unit of work latency'''
+    failed = [r for r in results if not r.ok]
+    latencies = sorted(r.elapsed for r in results)
+    logger.info(f'Completed {len(results)} units of work in {elapsed:.2f}s, {len(failed)} failed.')
+    if latencies:
+        p50 = latencies[len(latencies) // 2]
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        avg = sum(latencies) / len(latencies)
+        logger.info(f'Latency min: {latencies[0]:.2f}s, avg: {avg:.2f}s, p50: {p50:.2f}s, '
+                    f'p95: {p95:.2f}s, max: {latencies[-1]:.2f}s')
+    for result in failed:
+        logger.warning(f'Failed {result.key}: {result.error.__class__.__name__} - {result.error}')
@@ -10,16 +10,67 @@ Available response properties
 * resp.status_code      HTTP status code
 * resp.reason           HTTP status reason
 * resp.headers          Dictionary of HTTP headers
+
+Connections are kept alive and reused from a per-host pool, see ConnectionPool.
+Pool limits are read from the environment
+* HTTP_POOL_MAXSIZE       Idle connections kept per host (default 10)
+* HTTP_POOL_IDLE_TIMEOUT  Seconds an idle connection may be reused (default 60)
+* HTTP_TIMEOUT            Socket timeout in seconds (default 60)
+
+Throttled (429, 503) and failed requests are retried with jittered exponential backoff or after
+Retry-After delay, see request. Requests to each host are limited by an AdaptiveLimiter.
+* HTTP_RETRIES            Number of retries (default 4)
+* HTTP_BACKOFF_BASE       First backoff delay in seconds (default 0.5)
+* HTTP_BACKOFF_MAX        Longest backoff delay in seconds (default 30)
+* HTTP_LIMIT_INITIAL      Initial concurrent requests limit per host (default 16)
+* HTTP_LIMIT_MAX          Largest concurrent requests limit per host (default 64)
+
+Responses are requested with gzip or deflate compression and decompressed while being read,
+set HTTP_COMPRESSION=0 to disable it. Received bytes before and after decoding are counted in stats.
+
+Each attempt of a request is recorded in azuread_aws.metrics and as a tracing span when enabled.
 '''
-import http
+import os
+import http.client
 import urllib.parse
+import email.utils
 import json
+import zlib
+import time
+import random
+import socket
 import logging
 import base64
+import threading
+import collections
 
+from azuread_aws import metrics
+from azuread_aws import tracing
 
 log = logging.getLogger('http')
 
+POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '10'))
+POOL_IDLE_TIMEOUT = float(os.getenv('HTTP_POOL_IDLE_TIMEOUT', '60'))
+TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '60'))
+
+RETRIES = int(os.getenv('HTTP_RETRIES', '4'))
+BACKOFF_BASE = float(os.getenv('HTTP_BACKOFF_BASE', '0.5'))
+BACKOFF_MAX = float(os.getenv('HTTP_BACKOFF_MAX', '30'))
+LIMIT_INITIAL = int(os.getenv('HTTP_LIMIT_INITIAL', '16'))
+LIMIT_MAX = int(os.getenv('HTTP_LIMIT_MAX', '64'))
+COMPRESSION = os.getenv('HTTP_COMPRESSION', '1') != '0'
+ACCEPT_ENCODING = 'gzip, deflate'
+READ_CHUNK_SIZE = 64 * 1024
+
+# errors raised when server has closed a kept alive connection
+RECONNECT_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+# transient errors which are retried for idempotent methods
+RETRY_ERRORS = (ConnectionError, socket.timeout, http.client.HTTPException)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+# server asks to slow down, 429 is retried for any method as the request was not processed
+THROTTLE_STATUS = (429, 503)
+RETRY_STATUS = (429, 502, 503, 504)
+
 
 def get(url, auth=None, headers=None, params=None):
     return call(url, method='GET', auth=auth, headers=headers, params=params)
@@ -56,7 +107,7 @@ def encode_data(data, headers):
             headers['Content-Type'] = 'application/json'
             encoded = json.dumps(data)
 
-    elif isinstance(data, str):
+    elif isinstance(data, (str, bytes)):
         encoded = data
     else:
         raise Exception(f'Unsupported data type {type(data)} for http calls')
@@ -64,10 +115,366 @@ def encode_data(data, headers):
     if 'Content-Type' not in headers:
         headers['Content-Type'] = 'text/plain'
 
+    # length and sent bytes are counted in bytes, not characters
+    if isinstance(encoded, str):
+        encoded = encoded.encode('utf-8')
     headers['Content-Length'] = len(encoded)
     return encoded
 
 
+class Decompressor:
+    ''' Streaming decoder of gzip or deflate Content-Encoding.
+        Deflate is accepted both with zlib header and raw, as servers send either.
+    '''
+
+    def __init__(self):
+        # wbits + 32 detects gzip or zlib header automatically
+        self._obj = zlib.decompressobj(zlib.MAX_WBITS | 32)
+        self._first = True
+
+    def decompress(self, chunk):
+        if self._first and chunk:
+            self._first = False
+            try:
+                return self._obj.decompress(chunk)
+            except zlib.error:
+                self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._obj.decompress(chunk)
+
+    def flush(self):
+        return self._obj.flush()
+
+
+def compressed(headers):
+    '''True if response body has gzip or deflate Content-Encoding'''
+    return (headers.get('Content-Encoding') or '').strip().lower() in ('gzip', 'deflate')
+
+
+def read_body(resp):
+    ''' Read whole response body, decompressing it while reading.
+        Returns tuple of (data, bytes received).
+    '''
+    if not compressed(resp.headers):
+        data = resp.read()
+        return data, len(data)
+
+    decompressor = Decompressor()
+    received = 0
+    chunks = []
+    while True:
+        chunk = resp.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        received += len(chunk)
+        chunks.append(decompressor.decompress(chunk))
+    chunks.append(decompressor.flush())
+    return b''.join(chunks), received
+
+
+def decode_body(resp):
+    '''Set text and json properties of the response from its data'''
+    try:
+        resp.text = resp.data.decode('utf-8')
+    except UnicodeDecodeError:
+        pass
+
+    if resp.headers.get('Content-Type') is not None \
+            and 'application/json' in resp.headers.get('Content-Type'):
+        try:
+            resp.json = json.loads(resp.text)
+        except json.JSONDecodeError:
+            pass
+
+
+class ConnectionPool:
+    ''' Thread-safe pool of persistent connections keyed by (scheme, host).
+        Up to maxsize idle connections are kept per host, idle connections older
+        than idle_timeout seconds are closed instead of being reused.
+    '''
+
+    def __init__(self, maxsize=POOL_MAXSIZE, idle_timeout=POOL_IDLE_TIMEOUT, timeout=TIMEOUT):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.counters = {
+            'created': 0,
+            'reused': 0,
+            'reconnected': 0,
+            'expired': 0,
+            'discarded': 0,
+        }
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def connect(self, scheme, netloc):
+        '''Open a new connection, not tracked by the pool until released'''
+        with self._lock:
+            self.counters['created'] += 1
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def acquire(self, scheme, netloc):
+        '''Returns tuple of (connection, reused) for exclusive use by the caller'''
+        now = time.monotonic()
+        expired = []
+        con = None
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            while idle:
+                candidate, released = idle.pop()
+                if now - released < self.idle_timeout:
+                    con = candidate
+                    self.counters['reused'] += 1
+                    break
+                expired.append(candidate)
+            self.counters['expired'] += len(expired)
+        for stale in expired:
+            stale.close()
+        if con is not None:
+            return con, True
+        return self.connect(scheme, netloc), False
+
+    def release(self, scheme, netloc, con):
+        '''Return connection to the pool once the response was fully read'''
+        now = time.monotonic()
+        closing = []
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), collections.deque())
+            # idle connections are ordered by release time, oldest first
+            while idle and now - idle[0][1] >= self.idle_timeout:
+                closing.append(idle.popleft()[0])
+                self.counters['expired'] += 1
+            if len(idle) < self.maxsize:
+                idle.append((con, now))
+            else:
+                closing.append(con)
+                self.counters['discarded'] += 1
+        for stale in closing:
+            stale.close()
+
+    def discard(self, con):
+        '''Close connection which can not be reused'''
+        with self._lock:
+            self.counters['discarded'] += 1
+        con.close()
+
+    def reconnected(self):
+        with self._lock:
+            self.counters['reconnected'] += 1
+
+    def clear(self):
+        '''Close all idle connections'''
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for con, _ in connections:
+                con.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['idle'] = sum(len(connections) for connections in self._idle.values())
+        return stats
+
+
+class AdaptiveLimiter:
+    ''' AIMD limit of concurrent requests to a host. Limit grows by one after each `limit`
+        successful requests and is halved when the host throttles, at most once per cooldown.
+        Retry-After of a throttled response pauses all requests to the host.
+    '''
+
+    def __init__(self, initial=LIMIT_INITIAL, minimum=1, maximum=LIMIT_MAX, cooldown=1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.cooldown = cooldown
+        self.inflight = 0
+        self._paused_until = 0
+        self._decreased_at = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        '''Wait for a free slot, returns seconds spent waiting'''
+        started = time.monotonic()
+        with self._cond:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    self._cond.wait(pause)
+                elif self.inflight >= int(self.limit):
+                    self._cond.wait()
+                else:
+                    break
+            self.inflight += 1
+        return time.monotonic() - started
+
+    def try_acquire(self):
+        ''' Take a free slot without waiting, for callers which can not block like asyncio.
+            Returns None if the slot was taken, otherwise seconds until the host is not paused,
+            0 if all slots are in use.
+        '''
+        with self._cond:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                return pause
+            if self.inflight >= int(self.limit):
+                return 0
+            self.inflight += 1
+            return None
+
+    def release(self, throttled=False):
+        with self._cond:
+            self.inflight -= 1
+            now = time.monotonic()
+            if throttled:
+                if now - self._decreased_at > self.cooldown:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._decreased_at = now
+                    log.debug('Throttled, concurrency limit decreased to %d', self.limit)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def pause(self, seconds):
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+pool = ConnectionPool()
+limiters = collections.defaultdict(AdaptiveLimiter)
+counters = {
+    'retries': 0,
+    'throttled': 0,
+    'retry_wait': 0.0,
+    'limiter_wait': 0.0,
+    'bytes_sent': 0,
+    'bytes_wire': 0,
+    'bytes_decoded': 0,
+}
+_counters_lock = threading.Lock()
+
+
+def _count(name, value=1):
+    with _counters_lock:
+        counters[name] += value
+
+
+def stats():
+    '''Returns connection pool, retry, concurrency limit and transferred bytes counters'''
+    result = pool.stats()
+    with _counters_lock:
+        result.update(counters)
+        result['limits'] = {host: int(limiter.limit) for host, limiter in limiters.items()}
+    return result
+
+
+def retry_after(resp):
+    '''Returns delay in seconds requested by Retry-After header, or None'''
+    value = resp.headers.get('Retry-After') if resp is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt):
+    '''Exponential backoff delay with full jitter'''
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def retryable(method, resp):
+    if resp is None:
+        return method in IDEMPOTENT_METHODS
+    return resp.status == 429 or (resp.status in RETRY_STATUS and method in IDEMPOTENT_METHODS)
+
+
+def send(scheme, netloc, method, target, body, headers):
+    ''' Send request over a pooled connection and read the response body.
+        A reused connection closed by the server is transparently replaced with a new one.
+    '''
+    while True:
+        con, reused = pool.acquire(scheme, netloc)
+        try:
+            con.request(method, target, body=body, headers=headers)
+            resp = con.getresponse()
+            resp.data, resp.received = read_body(resp)
+
+        except RECONNECT_ERRORS as ex:
+            pool.discard(con)
+            if not reused:
+                raise
+            log.debug('Connection to %s was closed by server (%s), reconnecting', netloc, ex.__class__.__name__)
+            pool.reconnected()
+            continue
+
+        except Exception:
+            pool.discard(con)
+            raise
+
+        if resp.will_close:
+            pool.discard(con)
+        else:
+            pool.release(scheme, netloc, con)
+        _count('bytes_sent', len(body) if body else 0)
+        _count('bytes_wire', resp.received)
+        _count('bytes_decoded', len(resp.data))
+        return resp
+
+
+def trace(method, netloc, target, resp, error, started, attempt, category):
+    ''' Record an attempt of the request as a span of the current trace span'''
+    status = resp.status if resp is not None else None
+    failure = f'{error.__class__.__name__}: {error}' if error is not None else None
+    tracing.record(metrics.http_endpoint(method, netloc, target), category, started, time.monotonic() - started, failure,
+                   url=f'{netloc}{target}', status=status, attempt=attempt)
+
+
+def request(scheme, netloc, method, target, body, headers, retries=RETRIES):
+    ''' Send request within host concurrency limit, retrying throttled and failed requests'''
+    with _counters_lock:
+        limiter = limiters[netloc]
+    attempt = 0
+    while True:
+        _count('limiter_wait', limiter.acquire())
+        resp = error = None
+        started = time.monotonic()
+        try:
+            resp = send(scheme, netloc, method, target, body, headers)
+        except RETRY_ERRORS as ex:
+            error = ex
+        finally:
+            limiter.release(throttled=resp is not None and resp.status in THROTTLE_STATUS)
+        if metrics.enabled:
+            metrics.record_http(method, netloc, target, resp, error, time.monotonic() - started, body, attempt > 0)
+        if tracing.enabled:
+            trace(method, netloc, target, resp, error, started, attempt, 'http')
+
+        if attempt >= retries or not retryable(method, resp):
+            if error is not None:
+                raise error
+            return resp
+
+        delay = retry_after(resp)
+        if delay is not None:
+            _count('throttled')
+            limiter.pause(delay)
+        else:
+            delay = backoff(attempt)
+        reason = f'{resp.status} {resp.reason}' if resp is not None else f'{error.__class__.__name__} {error}'
+        log.debug('Retrying %s %s%s in %.2fs after %s', method, netloc, target, delay, reason)
+        _count('retries')
+        _count('retry_wait', delay)
+        time.sleep(delay)
+        attempt += 1
+
+
 def call(url, method='GET', auth=None, headers=None, data=None, params=None, redirect_limit=3):
     ''' Wrapper for HTTP(s) API calls
         * The URL to make a call to
@@ -85,17 +492,15 @@ def call(url, method='GET', auth=None, headers=None, data=None, params=None, red
         encoded = base64.b64encode(bytes(auth, 'utf-8')).decode('utf-8')
         hdrs['Authorization'] = f'Basic {encoded}'
 
+    if COMPRESSION and not any(h.lower() == 'accept-encoding' for h in hdrs):
+        hdrs['Accept-Encoding'] = ACCEPT_ENCODING
+
     # serialize data and set length
     if data:
         data = encode_data(data, hdrs)
 
     url_o = urllib.parse.urlparse(url)
-
-    if url_o.scheme == 'https':
-        con = http.client.HTTPSConnection(url_o.netloc)
-    elif url_o.scheme == 'http':
-        con = http.client.HTTPConnection(url_o.netloc)
-    else:
+    if url_o.scheme not in ('https', 'http'):
         raise Exception('unsupported scheme (' + url_o.scheme + ')')
 
     query = '?' + url_o.query if url_o.query else ''
@@ -106,20 +511,15 @@ def call(url, method='GET', auth=None, headers=None, data=None, params=None, red
         else:
             query = '?' + urllib.parse.urlencode(params)
 
-    headers = '; '.join(['%s: %s' % (h, hdrs[h]) for h in hdrs])
-    log.debug('%s headers: %s %s%s', method, headers, url_o.path, query)
+    header_line = '; '.join(['%s: %s' % (h, hdrs[h]) for h in hdrs])
+    log.debug('%s headers: %s %s%s', method, header_line, url_o.path, query)
     if data:
         log.debug('<- %s', data)
 
-    con.request(method, url_o.path + query, body=data, headers=hdrs)
-    resp = con.getresponse()
-
-    resp.data = resp.read()
+    resp = request(url_o.scheme, url_o.netloc, method, url_o.path + query, data, hdrs)
     resp.json = None
     resp.text = None
 
-    con.close()
-
     log.debug('%s response %s -> %d %s', method, url, resp.status, resp.reason)
 
     resp.status_code = resp.status
@@ -130,16 +530,5 @@ def call(url, method='GET', auth=None, headers=None, data=None, params=None, red
         if redirect_limit > 0:
             return call(resp.headers['Location'], method, auth, headers, data, params, redirect_limit - 1)
 
-    try:
-        resp.text = resp.data.decode('utf-8')
-    except UnicodeDecodeError:
-        pass
-
-    if resp.headers.get('Content-Type') is not None \
-            and 'application/json' in resp.headers.get('Content-Type'):
-        try:
-            resp.json = json.loads(resp.text)
-        except json.JSONDecodeError:
-            pass
-
+    decode_body(resp)
     return resp
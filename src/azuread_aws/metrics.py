@@ -0,0 +1,210 @@
+''' Per endpoint telemetry of Graph and AWS API requests.
+
+Metrics are collected only after enable() is called, "aad-aws --metrics" does it for a run
+and prints the summary at exit. For each endpoint it keeps count of requests, retries and
+errors, response status codes, bytes sent and received and a histogram of latencies.
+
+* HTTP requests of azuread_aws.http and azure.aio are recorded per attempt, an endpoint is
+  the method, host and path with object ids replaced by {id}, e.g. "GET graph.microsoft.com/v1.0/users/{id}".
+  Latency is the time to send the request and read the response, without waits for retries.
+* boto3 calls of amazon.client and amazon.resource are recorded with botocore event hooks,
+  an endpoint is "aws:<service>.<operation>" and latency includes botocore retries.
+'''
+import re
+import sys
+import json
+import time
+import bisect
+import logging
+import functools
+import threading
+
+log = logging.getLogger('metrics')
+
+# upper bounds of latency histogram buckets in milliseconds
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'))
+# path segments with object ids, account ids, emails or opaque tokens
+ID_SEGMENT = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$|^\d+$|@|^[\w-]{20,}$', re.I)
+
+enabled = False
+started = None
+_lock = threading.Lock()
+# endpoint -> Endpoint
+_endpoints = {}
+
+
+class Endpoint:
+    ''' Counters and latency histogram of requests to an endpoint'''
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.statuses = {}
+        self.sent = 0
+        self.received = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, status, elapsed, sent, received, retries):
+        self.requests += 1
+        self.retries += retries
+        if not isinstance(status, int) or status >= 400:
+            self.errors += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.sent += sent
+        self.received += received
+        self.total += elapsed
+        self.min = elapsed if self.min is None else min(self.min, elapsed)
+        self.max = max(self.max, elapsed)
+        self.buckets[bisect.bisect_left(BUCKETS, elapsed * 1000)] += 1
+
+    def percentile(self, p):
+        ''' Upper bound of the bucket with p-th percentile latency in milliseconds'''
+        rank = self.requests * p / 100
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return bound if bound != float('inf') else round(self.max * 1000, 1)
+        return None
+
+    def summary(self):
+        return {
+            'requests': self.requests,
+            'retries': self.retries,
+            'errors': self.errors,
+            'statuses': {str(status): count for status, count in sorted(self.statuses.items(), key=str)},
+            'bytes_sent': self.sent,
+            'bytes_received': self.received,
+            'latency_ms': {
+                'total': round(self.total * 1000, 1),
+                'mean': round(self.total * 1000 / self.requests, 1) if self.requests else None,
+                'min': round(self.min * 1000, 1) if self.min is not None else None,
+                'max': round(self.max * 1000, 1),
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': {('+inf' if bound == float('inf') else str(bound)): count
+                            for bound, count in zip(BUCKETS, self.buckets) if count},
+            },
+        }
+
+
+def enable():
+    ''' Start collecting metrics'''
+    global enabled, started
+    with _lock:
+        _endpoints.clear()
+        started = time.time()
+        enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def record(endpoint, status, elapsed, sent=0, received=0, retries=0):
+    ''' Record a request to the endpoint with response status code or error class name,
+        elapsed seconds and number of bytes sent and received.
+    '''
+    with _lock:
+        stats = _endpoints.get(endpoint)
+        if stats is None:
+            stats = _endpoints[endpoint] = Endpoint()
+        stats.add(status, elapsed, sent, received, retries)
+
+
+@functools.lru_cache(maxsize=1024)
+def http_endpoint(method, netloc, path):
+    ''' Endpoint name of HTTP request, ids in the path are replaced with {id}'''
+    path = path.split('?', 1)[0]
+    segments = ['{id}' if ID_SEGMENT.search(segment) else segment for segment in path.split('/')]
+    return f'{method} {netloc}{"/".join(segments)}'
+
+
+def record_http(method, netloc, target, resp, error, elapsed, body, retry):
+    ''' Record an attempt of HTTP request with response resp or error'''
+    status = resp.status if resp is not None else error.__class__.__name__
+    received = getattr(resp, 'received', 0) if resp is not None else 0
+    record(http_endpoint(method, netloc, target), status, elapsed, len(body) if body else 0, received, 1 if retry else 0)
+
+
+def _before_call(context=None, **kwargs):
+    if enabled and context is not None:
+        context['metrics_started'] = time.monotonic()
+
+
+def _request_created(request=None, **kwargs):
+    context = getattr(request, 'context', None)
+    if enabled and context is not None and 'metrics_started' in context:
+        body = request.body
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        size = len(body) if isinstance(body, bytes) else 0
+        context['metrics_sent'] = context.get('metrics_sent', 0) + size
+
+
+def _endpoint(event_name):
+    # event name is "after-call.<service>.<operation>"
+    _, service, operation = event_name.split('.', 2)
+    return f'aws:{service}.{operation}'
+
+
+def _after_call(event_name=None, http_response=None, parsed=None, context=None, **kwargs):
+    if not enabled or context is None or 'metrics_started' not in context:
+        return
+    elapsed = time.monotonic() - context.pop('metrics_started')
+    metadata = parsed.get('ResponseMetadata', {}) if isinstance(parsed, dict) else {}
+    content = getattr(http_response, 'content', None) or b''
+    record(_endpoint(event_name), getattr(http_response, 'status_code', 0), elapsed,
+           context.pop('metrics_sent', 0), len(content), metadata.get('RetryAttempts', 0))
+
+
+def _after_call_error(event_name=None, exception=None, context=None, **kwargs):
+    if not enabled or context is None or 'metrics_started' not in context:
+        return
+    elapsed = time.monotonic() - context.pop('metrics_started')
+    record(_endpoint(event_name), exception.__class__.__name__, elapsed, context.pop('metrics_sent', 0))
+
+
+def instrument(session):
+    ''' Register botocore event handlers recording calls of clients created by the boto3 session.
+        Handlers return immediately while metrics are disabled.
+    '''
+    events = session.events
+    events.register('before-call', _before_call, unique_id='aad-aws-metrics-before-call')
+    events.register('request-created', _request_created, unique_id='aad-aws-metrics-request-created')
+    events.register('after-call', _after_call, unique_id='aad-aws-metrics-after-call')
+    events.register('after-call-error', _after_call_error, unique_id='aad-aws-metrics-after-call-error')
+    return session
+
+
+def summary():
+    ''' Returns dict with collected metrics of all endpoints and totals'''
+    with _lock:
+        endpoints = {name: stats.summary() for name, stats in sorted(_endpoints.items())}
+    totals = {}
+    for name in ('requests', 'retries', 'errors', 'bytes_sent', 'bytes_received'):
+        totals[name] = sum(stats[name] for stats in endpoints.values())
+    totals['latency_ms'] = round(sum(stats['latency_ms']['total'] for stats in endpoints.values()), 1)
+    return {
+        'started': started,
+        'elapsed': round(time.time() - started, 3) if started else None,
+        'totals': totals,
+        'endpoints': endpoints,
+    }
+
+
+def report(path='-'):
+    ''' Write JSON summary to the file, or to stderr if path is "-" '''
+    data = json.dumps(summary(), indent=2)
+    if path == '-':
+        sys.stderr.write(data + '\n')
+    else:
+        with open(path, 'w') as f:
+            f.write(data + '\n')
+        log.info('Metrics of %d endpoints written to %s', len(_endpoints), path)
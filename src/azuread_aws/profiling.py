@@ -0,0 +1,168 @@
+''' CPU and memory allocation profiles of a subcommand, enabled with "aad-aws --profile cpu|alloc".
+
+* cpu - The subcommand runs under cProfile and its stats are written to PREFIX.pstats. Stacks of
+  all threads, including fanout workers, are sampled every PROFILE_SAMPLE_INTERVAL seconds
+  (default 0.005) and written to PREFIX.collapsed.
+* alloc - Allocations are traced with tracemalloc and a snapshot is taken whenever traced memory
+  reaches a new peak. The largest snapshot is written to PREFIX.tracemalloc and its sizes by
+  allocation stack to PREFIX.collapsed.
+
+Collapsed stack files have a "frame;frame;frame count" line per stack and can be rendered with
+flamegraph.pl or speedscope. Top functions or allocation sites are printed to stderr.
+'''
+import os
+import sys
+import time
+import logging
+import threading
+import tracemalloc
+import collections
+
+log = logging.getLogger('profiling')
+
+SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))
+TRACEMALLOC_FRAMES = int(os.getenv('PROFILE_TRACEMALLOC_FRAMES', '32'))
+TOP = 25
+
+
+def _short(filename):
+    ''' Path of the file relative to the longest matching sys.path entry'''
+    best = ''
+    for entry in sys.path:
+        if entry and filename.startswith(entry) and len(entry) > len(best):
+            best = entry
+    return filename[len(best):].lstrip(os.sep) if best else filename
+
+
+def _label(frame):
+    return f'{frame.f_globals.get("__name__", "?")}:{frame.f_code.co_name}'
+
+
+class Sampler(threading.Thread):
+    ''' Counts stacks of all threads sampled at regular intervals'''
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super().__init__(name='profiling-sampler', daemon=True)
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._done = threading.Event()
+
+    def run(self):
+        me = threading.get_ident()
+        while not self._done.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_label(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def write_collapsed(path, stacks):
+    with open(path, 'w') as f:
+        for stack, count in sorted(stacks.items()):
+            if count:
+                f.write(f'{stack} {count}\n')
+
+
+def cpu(func, args, prefix, top=TOP):
+    ''' Run func(*args) under cProfile and the stack sampler, returns its result'''
+    # pstats takes longer to import than some subcommands run
+    import pstats
+    import cProfile
+    profiler = cProfile.Profile()
+    sampler = Sampler()
+    sampler.start()
+    started = time.monotonic()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        elapsed = time.monotonic() - started
+        sampler.stop()
+        profiler.dump_stats(prefix + '.pstats')
+        write_collapsed(prefix + '.collapsed', sampler.stacks)
+        sys.stderr.write(f'\nCPU profile of {elapsed:.2f}s, {sampler.samples} samples. '
+                         f'Written {prefix}.pstats and {prefix}.collapsed\n')
+        stats = pstats.Stats(profiler, stream=sys.stderr)
+        stats.sort_stats('tottime').print_stats(top)
+
+
+class PeakTracker(threading.Thread):
+    ''' Takes tracemalloc snapshot whenever traced memory grows by 10% over the last snapshot,
+        so that allocations at the peak are known even if they were released before the end.
+    '''
+
+    def __init__(self, interval=0.05):
+        super().__init__(name='profiling-peak', daemon=True)
+        self.interval = interval
+        self.snapshot = None
+        self.size = 0
+        self._done = threading.Event()
+
+    def check(self):
+        current, _ = tracemalloc.get_traced_memory()
+        if current > self.size * 1.1:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.size = current
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.check()
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.check()
+
+
+def alloc(func, args, prefix, top=TOP):
+    ''' Run func(*args) with tracemalloc, returns its result'''
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    tracker = PeakTracker()
+    tracker.start()
+    try:
+        return func(*args)
+    finally:
+        tracker.stop()
+        current, peak = tracemalloc.get_traced_memory()
+        if started_tracing:
+            tracemalloc.stop()
+        snapshot = tracker.snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        ])
+        snapshot.dump(prefix + '.tracemalloc')
+
+        stacks = collections.Counter()
+        for stat in snapshot.statistics('traceback'):
+            frames = [f'{_short(frame.filename)}:{frame.lineno}' for frame in stat.traceback]
+            stacks[';'.join(frames)] += stat.size
+        write_collapsed(prefix + '.collapsed', stacks)
+
+        sys.stderr.write(f'\nTraced memory peak {peak / 1024:.0f} KiB, snapshot at {tracker.size / 1024:.0f} KiB, '
+                         f'at exit {current / 1024:.0f} KiB. Written {prefix}.tracemalloc and {prefix}.collapsed\n')
+        sys.stderr.write(f'Top {top} allocation sites of the snapshot:\n')
+        for stat in snapshot.statistics('lineno')[:top]:
+            frame = stat.traceback[0]
+            sys.stderr.write(f'{stat.size / 1024:10.1f} KiB {stat.count:8d} blocks  {_short(frame.filename)}:{frame.lineno}\n')
+
+
+def run(mode, func, args, prefix):
+    ''' Run func(*args) with cpu or alloc profile written to files starting with prefix'''
+    log.info('Profiling %s (%s), writing %s.*', func.__name__, mode, prefix)
+    if mode == 'alloc':
+        return alloc(func, args, prefix)
+    return cpu(func, args, prefix)
@@ -0,0 +1,246 @@
+''' Trace spans of a run exported to a local file, enabled with "aad-aws --trace FILE".
+
+Spans are nested: the subcommand, units of work of fanout.run (e.g. an account or a user) and
+individual Graph, login and AWS API calls. The current span is kept per thread and passed to
+workers of fanout.run explicitly, other thread pools wrap their work with bind().
+
+The trace is written in Chrome trace event format, which can be opened with chrome://tracing or
+https://ui.perfetto.dev, or as OTLP JSON for OpenTelemetry tools.
+'''
+import os
+import json
+import time
+import random
+import logging
+import threading
+import itertools
+import contextlib
+
+log = logging.getLogger('tracing')
+
+FORMATS = ('chrome', 'otlp')
+
+enabled = False
+_lock = threading.Lock()
+_local = threading.local()
+_ids = itertools.count(1)
+_spans = []
+_threads = {}
+# perf_counter and wall clock time at enable() to convert span times
+_epoch = (0.0, 0)
+_trace_id = None
+
+
+class Span:
+    __slots__ = ('id', 'parent', 'name', 'category', 'attrs', 'thread', 'start', 'end', 'error')
+
+    def __init__(self, name, category, parent, attrs, start=None):
+        self.id = next(_ids)
+        self.parent = parent.id if parent is not None else None
+        self.name = name
+        self.category = category
+        self.attrs = attrs
+        self.thread = threading.get_ident()
+        self.start = time.perf_counter() if start is None else start
+        self.end = None
+        self.error = None
+
+
+class _Disabled:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_DISABLED = _Disabled()
+
+
+def enable():
+    ''' Start recording spans'''
+    global enabled, _epoch, _trace_id
+    with _lock:
+        _spans.clear()
+        _threads.clear()
+        _epoch = (time.perf_counter(), int(time.time() * 1e9))
+        _trace_id = '%032x' % random.getrandbits(128)
+        enabled = True
+
+
+def current():
+    ''' Returns the current span of the calling thread or None'''
+    return getattr(_local, 'span', None)
+
+
+def _finish(span):
+    if span.end is None:
+        span.end = time.perf_counter()
+    thread = threading.current_thread()
+    with _lock:
+        _spans.append(span)
+        _threads.setdefault(span.thread, thread.name)
+
+
+@contextlib.contextmanager
+def _active(name, category, parent, attrs):
+    previous = current()
+    span = Span(name, category, previous if parent is None else parent, attrs)
+    _local.span = span
+    try:
+        yield span
+    except BaseException as ex:
+        span.error = f'{ex.__class__.__name__}: {ex}'
+        raise
+    finally:
+        _local.span = previous
+        _finish(span)
+
+
+def span(name, category='function', parent=None, **attrs):
+    ''' Context manager of a span nested in the parent or the current span of the thread.
+        Yields the Span, or None if tracing is disabled. Exceptions are recorded on the span.
+    '''
+    if not enabled:
+        return _DISABLED
+    return _active(name, category, parent, attrs)
+
+
+def record(name, category, started, elapsed, error=None, **attrs):
+    ''' Record a finished leaf span of the current span, started is time.monotonic() value'''
+    span = Span(name, category, current(), attrs,
+                start=started - time.monotonic() + time.perf_counter())
+    span.end = span.start + elapsed
+    span.error = error
+    _finish(span)
+
+
+def bind(func):
+    ''' Returns func running in the span current at the time of bind, to be submitted to a thread pool'''
+    if not enabled:
+        return func
+    parent = current()
+
+    def bound(*args, **kwargs):
+        previous = current()
+        _local.span = parent
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.span = previous
+    return bound
+
+
+def _before_call(context=None, **kwargs):
+    if enabled and context is not None:
+        context['trace_started'] = time.monotonic()
+
+
+def _after_call(event_name=None, http_response=None, context=None, exception=None, **kwargs):
+    if not enabled or context is None or 'trace_started' not in context:
+        return
+    started = context.pop('trace_started')
+    _, service, operation = event_name.split('.', 2)
+    attrs = {'service': service, 'operation': operation}
+    if http_response is not None:
+        attrs['status'] = http_response.status_code
+    error = f'{exception.__class__.__name__}: {exception}' if exception is not None else None
+    record(f'aws:{service}.{operation}', 'aws', started, time.monotonic() - started, error, **attrs)
+
+
+def instrument(session):
+    ''' Register botocore event handlers recording calls of the boto3 session clients as spans'''
+    events = session.events
+    events.register('before-call', _before_call, unique_id='aad-aws-tracing-before-call')
+    events.register('after-call', _after_call, unique_id='aad-aws-tracing-after-call')
+    events.register('after-call-error', _after_call, unique_id='aad-aws-tracing-after-call-error')
+    return session
+
+
+def _args(span):
+    args = {key: value if isinstance(value, (int, float, bool)) else str(value) for key, value in span.attrs.items()}
+    args['span_id'] = span.id
+    if span.parent is not None:
+        args['parent_id'] = span.parent
+    if span.error:
+        args['error'] = span.error
+    return args
+
+
+def chrome_trace(spans, threads):
+    ''' Returns trace in Chrome trace event format, spans are complete events on their threads
+        and asyncio requests are async events.
+    '''
+    pid = os.getpid()
+    events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+              for tid, name in threads.items()]
+    for span in spans:
+        if span.category == 'aio':
+            # concurrent requests of asyncio tasks overlap on the same thread
+            common = {'name': span.name, 'cat': span.category, 'id': span.id, 'pid': pid, 'tid': span.thread}
+            events.append(dict(common, ph='b', ts=round((span.start - _epoch[0]) * 1e6, 3), args=_args(span)))
+            events.append(dict(common, ph='e', ts=round((span.end - _epoch[0]) * 1e6, 3)))
+            continue
+        events.append({
+            'name': span.name,
+            'cat': span.category,
+            'ph': 'X',
+            'ts': round((span.start - _epoch[0]) * 1e6, 3),
+            'dur': round((span.end - span.start) * 1e6, 3),
+            'pid': pid,
+            'tid': span.thread,
+            'args': _args(span),
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def _nanos(seconds):
+    return str(_epoch[1] + int((seconds - _epoch[0]) * 1e9))
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+def otlp_trace(spans, threads):
+    ''' Returns trace as OTLP JSON ExportTraceServiceRequest'''
+    def span_id(value):
+        return '%016x' % value
+
+    result = []
+    for span in spans:
+        attrs = dict(span.attrs, category=span.category, **{'thread.id': span.thread, 'thread.name': threads.get(span.thread)})
+        otlp = {
+            'traceId': _trace_id,
+            'spanId': span_id(span.id),
+            'name': span.name,
+            'kind': 3 if span.category in ('http', 'aio', 'aws') else 1,
+            'startTimeUnixNano': _nanos(span.start),
+            'endTimeUnixNano': _nanos(span.end),
+            'attributes': [_attribute(key, value) for key, value in attrs.items()],
+            'status': {'code': 2, 'message': span.error} if span.error else {},
+        }
+        if span.parent is not None:
+            otlp['parentSpanId'] = span_id(span.parent)
+        result.append(otlp)
+    return {'resourceSpans': [{
+        'resource': {'attributes': [_attribute('service.name', 'aad-aws'), _attribute('process.pid', os.getpid())]},
+        'scopeSpans': [{'scope': {'name': 'azuread_aws.tracing'}, 'spans': result}],
+    }]}
+
+
+def export(path, fmt='chrome'):
+    ''' Write recorded spans to the file in chrome or otlp format'''
+    with _lock:
+        spans = sorted(_spans, key=lambda s: s.start)
+        threads = dict(_threads)
+    trace = otlp_trace(spans, threads) if fmt == 'otlp' else chrome_trace(spans, threads)
+    with open(path, 'w') as f:
+        json.dump(trace, f)
+    log.info('Trace of %d spans written to %s', len(spans), path)
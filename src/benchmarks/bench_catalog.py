@@ -0,0 +1,83 @@
+''' Micro-benchmark of app role lookups, linear manifest scans against AppRoleCatalog.
+
+    python benchmarks/bench_catalog.py [--roles 10000] [--lookups 1000]
+'''
+import os
+import sys
+import uuid
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from azuread_aws.azure.catalog import AppRoleCatalog  # noqa: E402
+
+
+def make_app_roles(count):
+    app_roles = []
+    for n in range(count):
+        account_id = f'{100000000000 + n // 10}'
+        aws_role_name = f'role-{n % 10}'
+        app_roles.append({
+            'allowedMemberTypes': ['User'],
+            'description': f'{aws_role_name}@{account_id}',
+            'displayName': f'{aws_role_name}/{account_id}',
+            'id': str(uuid.uuid4()),
+            'isEnabled': True,
+            'origin': 'Application',
+            'value': f'arn:aws:iam::{account_id}:role/aad/{aws_role_name},arn:aws:iam::{account_id}:saml-provider/AAD'
+        })
+    return app_roles
+
+
+def scan_by_name(name, app_roles):
+    for app_role in app_roles:
+        if app_role['displayName'] == name:
+            return app_role
+    return None
+
+
+def scan_by_aws(aws_role_name, account_id, app_roles):
+    for app_role in app_roles:
+        if '@' not in app_role['description']:
+            continue
+        role_name, account = app_role['description'].split('@')
+        if role_name == aws_role_name and account == account_id:
+            return app_role
+    return None
+
+
+def measure(label, func, keys):
+    started = time.perf_counter()
+    for key in keys:
+        func(key)
+    elapsed = time.perf_counter() - started
+    print(f'{label:<40} {elapsed * 1000:10.2f} ms total {elapsed / len(keys) * 1e6:12.2f} us/lookup')
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--roles', type=int, default=10000)
+    parser.add_argument('--lookups', type=int, default=1000)
+    options = parser.parse_args()
+
+    app_roles = make_app_roles(options.roles)
+    samples = random.Random(42).choices(app_roles, k=options.lookups)
+    names = [r['displayName'] for r in samples]
+    aws_keys = [tuple(r['description'].split('@')) for r in samples]
+
+    print(f'{options.roles} app roles, {options.lookups} lookups')
+    started = time.perf_counter()
+    catalog = AppRoleCatalog(app_roles)
+    print(f'{"catalog build":<40} {(time.perf_counter() - started) * 1000:10.2f} ms')
+
+    measure('linear scan by display name', lambda n: scan_by_name(n, app_roles), names)
+    measure('catalog by display name', catalog.find_by_name, names)
+    measure('linear scan by (aws role, account)', lambda k: scan_by_aws(k[0], k[1], app_roles), aws_keys)
+    measure('catalog by (aws role, account)', lambda k: catalog.find_by_aws(*k), aws_keys)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,339 @@
+''' Offline benchmarks of the CLI subcommands against stub Graph API and moto AWS servers.
+    Every scenario runs the real "aad-aws" entry point in a separate process, the same way
+    it is used by automation, and reports wall time, command time, Graph and AWS request counts,
+    bytes received and peak memory. Directory content is generated from the size parameters, so
+    request counts are reproducible and only timings vary between runs.
+
+    pip install -e . -r dev-requirements.txt
+    python benchmarks/bench_cli.py run -o base.json
+    python benchmarks/bench_cli.py run --latency 0.05 --throttle-every 20 -s role-sync -s user-assign-bulk
+    python benchmarks/bench_cli.py compare base.json new.json
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import collections
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.dirname(BENCH_DIR)
+
+# (scenario name, function of Context returning CLI arguments)
+SCENARIOS = collections.OrderedDict([
+    ('idp-ls', lambda ctx: ['idp', 'ls']),
+    ('idp-configure-all', lambda ctx: ['idp', 'configure', '--all', '--recreate-saml-idp']),
+    ('role-ls', lambda ctx: ['role', 'ls']),
+    ('role-info', lambda ctx: ['role', 'info', ctx.role_name(0)]),
+    ('role-new', lambda ctx: ['role', 'new', '-f', ctx.role_definitions()]),
+    ('role-rm-match', lambda ctx: ['role', 'rm', '-m', 'role-4/*']),
+    ('role-sync', lambda ctx: ['role', 'sync']),
+    ('user-info', lambda ctx: ['user', 'info', ctx.email(0)]),
+    ('user-assign', lambda ctx: ['user', 'assign', ctx.email(0), ctx.role_name(ctx.assignments_per_user)]),
+    ('user-unassign', lambda ctx: ['user', 'unassign', ctx.email(0), ctx.role_name(0)]),
+    ('user-assign-bulk', lambda ctx: ['user', 'assign-bulk', ctx.bulk_assignments(), '-o', os.devnull]),
+    ('directory-sync', lambda ctx: ['directory', 'sync', '--db', ctx.temp_path('directory.db')]),
+    ('access-report', lambda ctx: ['access', 'report', '--live', '-o', os.devnull]),
+])
+
+# metrics compared between runs, lower is better
+TIMINGS = ('wall', 'command')
+# reproducible counts, any increase is a regression
+COUNTS = ('graph_requests', 'aws_requests')
+# vary slightly between runs, compared with threshold as timings
+SIZES = ('graph_bytes_out', 'maxrss_kb')
+
+
+class Context:
+    '''Inputs of the scenarios, generated for the directory of the stub Graph server'''
+
+    def __init__(self, state, workdir, assignments_per_user, bulk_size):
+        self.state = state
+        self.workdir = workdir
+        self.assignments_per_user = assignments_per_user
+        self.bulk_size = bulk_size
+        self.runs = 0
+
+    def role_name(self, n):
+        return self.state.app_roles[n % len(self.state.app_roles)]['displayName']
+
+    def email(self, n):
+        return f'user{n % len(self.state.users)}@example.com'
+
+    def temp_path(self, name):
+        self.runs += 1
+        path = os.path.join(self.workdir, f'{self.runs}-{name}')
+        return path
+
+    def role_definitions(self):
+        path = os.path.join(self.workdir, 'roles.csv')
+        with open(path, 'w') as f:
+            f.write('aws_role_name,account_id,app_role_name\n')
+            for n in range(100):
+                f.write(f'bench-{n},{100000000000 + n},\n')
+        return path
+
+    def bulk_assignments(self):
+        path = os.path.join(self.workdir, 'assignments.csv')
+        with open(path, 'w') as f:
+            f.write('email,role\n')
+            for n in range(self.bulk_size):
+                f.write(f'{self.email(n)},{self.role_name(n + self.assignments_per_user)}\n')
+        return path
+
+
+def peak_memory_kb():
+    ''' Returns peak resident memory of the process in KB. VmHWM of Linux is preferred
+        since ru_maxrss of a child process starts at the value of its parent.
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def child(result_path, argv):
+    ''' Run the CLI in this process and write measurements to result_path'''
+    sys.path.insert(0, SRC_DIR)
+    from azuread_aws import http
+    from azuread_aws import amazon
+    from azuread_aws.commands import cli
+
+    aws_requests = collections.Counter()
+
+    def count_aws(event_name, **kwargs):
+        aws_requests[event_name.split('.', 1)[1]] += 1
+
+    amazon.session().events.register('before-send', count_aws)
+    sys.argv = ['aad-aws'] + argv
+    started = time.perf_counter()
+    rc = cli.main()
+    elapsed = time.perf_counter() - started
+    with open(result_path, 'w') as f:
+        json.dump({
+            'rc': rc,
+            'command': elapsed,
+            'aws_requests': sum(aws_requests.values()),
+            'aws_by_operation': dict(aws_requests),
+            'http': http.stats(),
+            'maxrss_kb': peak_memory_kb(),
+        }, f)
+    return rc
+
+
+def run_scenario(name, argv, env, graph, make_state, verbose=False):
+    ''' Run scenario once in a new process with fresh stub Graph directory, returns measurements'''
+    graph.state = make_state()
+    graph.counters.reset()
+    fd, result_path = tempfile.mkstemp(prefix='bench-', suffix='.json')
+    os.close(fd)
+    try:
+        started = time.perf_counter()
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), 'child', result_path, '--'] + argv,
+                                 env=env, stdin=subprocess.DEVNULL,
+                                 stdout=None if verbose else subprocess.DEVNULL,
+                                 stderr=None if verbose else subprocess.DEVNULL)
+        wall = time.perf_counter() - started
+        with open(result_path) as f:
+            result = json.load(f) if os.path.getsize(result_path) else {'rc': process.returncode}
+    finally:
+        os.unlink(result_path)
+    served = graph.counters.snapshot()
+    result.update({
+        'wall': wall,
+        'graph_requests': served['requests'],
+        'graph_by_route': served['by_route'],
+        'graph_statuses': served['statuses'],
+        'graph_throttled': served['throttled'],
+        'graph_bytes_out': served['bytes_out'],
+        'graph_bytes_in': served['bytes_in'],
+    })
+    if process.returncode and result.get('rc') is None:
+        result['rc'] = process.returncode
+    return result
+
+
+def summarize(runs):
+    '''Median timings over repeated runs, other measurements of the last run'''
+    summary = dict(runs[-1])
+    for metric in TIMINGS:
+        values = [r[metric] for r in runs if r.get(metric) is not None]
+        if values:
+            summary[metric] = statistics.median(values)
+            summary[f'{metric}_min'] = min(values)
+    summary['runs'] = len(runs)
+    return summary
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=SRC_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(scenarios):
+    print(f'{"scenario":<20} {"rc":>3} {"wall s":>8} {"cmd s":>8} {"graph":>7} {"aws":>6} {"MB out":>8} {"MB wire":>8} {"rss MB":>7}')
+    for name, r in scenarios.items():
+        http_stats = r.get('http') or {}
+        print(f'{name:<20} {r.get("rc") if r.get("rc") is not None else "-":>3} {r["wall"]:>8.3f} '
+              f'{r.get("command") or 0:>8.3f} {r["graph_requests"]:>7} {r.get("aws_requests", 0):>6} '
+              f'{r["graph_bytes_out"] / 1e6:>8.2f} {http_stats.get("bytes_wire", 0) / 1e6:>8.2f} '
+              f'{r.get("maxrss_kb", 0) / 1024:>7.1f}')
+
+
+def run(options):
+    sys.path.insert(0, BENCH_DIR)
+    import stub_graph
+    from stub_aws import StubAWS
+
+    names = options.scenario or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f'Unknown scenarios: {", ".join(unknown)}. Known: {", ".join(SCENARIOS)}')
+
+    print(f'Starting moto with {options.accounts} accounts and {options.roles} /aad roles in each')
+    aws = StubAWS().start()
+    accounts = aws.create_organization(options.accounts, options.roles)
+
+    def make_state():
+        return stub_graph.GraphState(accounts, options.roles, options.users, options.groups,
+                                     options.members, options.assignments)
+
+    graph = stub_graph.StubGraphServer(state=make_state(), latency=options.latency, page_size=options.page_size,
+                                       throttle_every=options.throttle_every).start()
+    env = {k: v for k, v in os.environ.items() if not k.startswith(('AZURE_', 'AWS_', 'AAD_AWS_'))}
+    env.update(aws.environ())
+    env.update({
+        'PYTHONPATH': os.pathsep.join(p for p in (SRC_DIR, os.environ.get('PYTHONPATH')) if p),
+        'AZURE_GRAPH_URL': f'{graph.base_url}/v1.0',
+        'AZURE_LOGIN_URL': graph.base_url,
+        'AZURE_TENANT_ID': stub_graph.TENANT_ID,
+        'AZURE_APP_CLIENT_ID': stub_graph.CLIENT_ID,
+        'AZURE_APP_CLIENT_SECRET': 'benchmark',
+        'AZURE_APP_ID': stub_graph.APP_ID,
+        'AZURE_SERVICE_ID': stub_graph.SERVICE_ID,
+        'AAD_AWS_DAEMON': '0',
+    })
+
+    results = {
+        'meta': {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': {k: v for k, v in vars(options).items() if k not in ('func', 'output', 'baseline', 'scenario')},
+        },
+        'scenarios': collections.OrderedDict(),
+    }
+    try:
+        with tempfile.TemporaryDirectory(prefix='aad-aws-bench-') as workdir:
+            ctx = Context(graph.state, workdir, options.assignments, options.bulk)
+            for name in names:
+                runs = []
+                for _ in range(options.repeat):
+                    runs.append(run_scenario(name, SCENARIOS[name](ctx), env, graph, make_state, options.verbose))
+                results['scenarios'][name] = summarize(runs)
+                print(f'{name}: {results["scenarios"][name]["wall"]:.3f}s', file=sys.stderr)
+    finally:
+        graph.shutdown()
+        aws.stop()
+
+    print_table(results['scenarios'])
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Results written to {options.output}')
+    failed = [name for name, r in results['scenarios'].items() if r.get('rc')]
+    if failed:
+        print(f'Failed scenarios: {", ".join(failed)}')
+    if options.baseline:
+        with open(options.baseline) as f:
+            return compare_results(json.load(f), results, options.threshold) or (1 if failed else 0)
+    return 1 if failed else 0
+
+
+def compare_results(base, new, threshold):
+    ''' Print differences between two result files, returns 1 if new one has regressions'''
+    regressions = []
+    if base['meta'].get('parameters') != new['meta'].get('parameters'):
+        print('Warning: results were produced with different parameters')
+    print(f'{"scenario":<20} {"metric":<16} {"base":>12} {"new":>12} {"change":>8}')
+    for name, current in new['scenarios'].items():
+        previous = base['scenarios'].get(name)
+        if previous is None:
+            print(f'{name:<20} {"(new scenario)":<16}')
+            continue
+        for metric in TIMINGS + COUNTS + SIZES:
+            before, after = previous.get(metric), current.get(metric)
+            if before is None or after is None:
+                continue
+            change = (after - before) / before * 100 if before else 0.0
+            regressed = after > before if metric in COUNTS else after > before * (1 + threshold / 100)
+            if regressed:
+                regressions.append((name, metric))
+            print(f'{name:<20} {metric:<16} {before:>12.3f} {after:>12.3f} {change:>+7.1f}%{" !" if regressed else ""}')
+    if regressions:
+        print(f'Regressions: {", ".join(f"{n} {m}" for n, m in regressions)}')
+        return 1
+    return 0
+
+
+def compare(options):
+    with open(options.base) as f:
+        base = json.load(f)
+    with open(options.new) as f:
+        new = json.load(f)
+    return compare_results(base, new, options.threshold)
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == 'child':
+        return child(sys.argv[2], sys.argv[4:])
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers()
+    subparsers.required = True
+    subparsers.dest = 'command'
+
+    run_cmd = subparsers.add_parser('run', help='Run scenarios and report measurements.')
+    run_cmd.add_argument('-s', '--scenario', action='append', help=f'Scenario to run, all by default: {", ".join(SCENARIOS)}.')
+    run_cmd.add_argument('-o', '--output', help='Write results to the JSON file.')
+    run_cmd.add_argument('-b', '--baseline', help='Compare results with the JSON file of a previous run.')
+    run_cmd.add_argument('-n', '--repeat', type=int, default=3, help='Runs of every scenario, median time is reported.')
+    run_cmd.add_argument('--threshold', type=float, default=10.0, help='Percent of slow down reported as regression.')
+    run_cmd.add_argument('--accounts', type=int, default=100, help='Member accounts in the organization.')
+    run_cmd.add_argument('--roles', type=int, default=5, help='IAM roles and app roles per account.')
+    run_cmd.add_argument('--users', type=int, default=2000)
+    run_cmd.add_argument('--groups', type=int, default=20)
+    run_cmd.add_argument('--members', type=int, default=50, help='Members of every group.')
+    run_cmd.add_argument('--assignments', type=int, default=2, help='App roles assigned to every user.')
+    run_cmd.add_argument('--bulk', type=int, default=500, help='Assignments in the user assign-bulk input.')
+    run_cmd.add_argument('--latency', type=float, default=0.0, help='Seconds of Graph API latency.')
+    run_cmd.add_argument('--page-size', type=int, default=100, help='Default Graph API page size.')
+    run_cmd.add_argument('--throttle-every', type=int, default=0, help='Throttle every N-th Graph API request with 429.')
+    run_cmd.add_argument('-v', '--verbose', action='store_true', help='Show output of the CLI.')
+    run_cmd.set_defaults(func=run)
+
+    compare_cmd = subparsers.add_parser('compare', help='Compare two result files.')
+    compare_cmd.add_argument('base')
+    compare_cmd.add_argument('new')
+    compare_cmd.add_argument('--threshold', type=float, default=10.0, help='Percent of slow down reported as regression.')
+    compare_cmd.set_defaults(func=compare)
+
+    options = parser.parse_args()
+    return options.func(options)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
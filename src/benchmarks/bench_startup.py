@@ -0,0 +1,120 @@
+''' Startup time of the CLI. Every case runs "aad-aws" with arguments which exit right after
+    argument parsing in a new process and reports the median wall time over interpreter startup.
+    Modules imported by every case are checked with -X importtime: boto3, botocore and pkg_resources
+    must not be loaded before a subcommand makes AWS calls.
+
+    python benchmarks/bench_startup.py -o base.json
+    python benchmarks/bench_startup.py -b base.json
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+import collections
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.dirname(BENCH_DIR)
+
+CASES = collections.OrderedDict([
+    ('help', ['-h']),
+    ('idp', ['idp', '-h']),
+    ('role', ['role', '-h']),
+    ('user', ['user', '-h']),
+    ('directory', ['directory', '-h']),
+    ('access', ['access', '-h']),
+    ('access-report', ['access', 'report', '-h']),
+    ('serve', ['serve', '-h']),
+])
+# modules which are too slow to import on startup
+FORBIDDEN = ('boto3', 'botocore', 'pkg_resources')
+
+
+def environ():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (SRC_DIR, os.environ.get('PYTHONPATH')) if p)
+    # measure startup of the CLI itself even if a daemon is running
+    env['AAD_AWS_DAEMON'] = '0'
+    return env
+
+
+def measure(argv, repeat, env):
+    ''' Returns median wall time in seconds of the process run repeat times'''
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run(argv, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def imported(args, env):
+    ''' Returns top level packages imported by the CLI with given arguments'''
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'azuread_aws.commands.cli'] + args,
+                          env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    modules = set()
+    for line in proc.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            modules.add(line.rsplit('|', 1)[1].strip().split('.')[0])
+    return modules
+
+
+def run(options):
+    env = environ()
+    names = options.case or list(CASES)
+    interpreter = measure([sys.executable, '-c', 'pass'], options.repeat, env)
+    print(f'Interpreter startup: {interpreter * 1000:.1f}ms')
+    results = {
+        'meta': {'python': platform.python_version(), 'platform': platform.platform(), 'interpreter': interpreter},
+        'cases': {},
+    }
+    violations = []
+    print(f'{"case":<16} {"startup ms":>12} {"modules":>8}  forbidden')
+    for name in names:
+        args = CASES[name]
+        elapsed = measure([sys.executable, '-m', 'azuread_aws.commands.cli'] + args, options.repeat, env) - interpreter
+        modules = imported(args, env)
+        forbidden = sorted(m for m in FORBIDDEN if m in modules)
+        violations.extend(f'{name} imports {m}' for m in forbidden)
+        results['cases'][name] = {'startup': elapsed, 'modules': len(modules), 'forbidden': forbidden}
+        print(f'{name:<16} {elapsed * 1000:>12.1f} {len(modules):>8}  {", ".join(forbidden)}')
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Results written to {options.output}')
+
+    rc = 0
+    if violations:
+        print(f'Forbidden imports: {"; ".join(violations)}')
+        rc = 1
+    if options.baseline:
+        with open(options.baseline) as f:
+            base = json.load(f)
+        regressions = []
+        for name, current in results['cases'].items():
+            previous = base['cases'].get(name)
+            # differences of a few milliseconds are noise of process startup
+            if previous and current['startup'] > previous['startup'] * (1 + options.threshold / 100) + 0.005:
+                regressions.append(f'{name} {previous["startup"] * 1000:.1f}ms -> {current["startup"] * 1000:.1f}ms')
+        if regressions:
+            print(f'Regressions: {"; ".join(regressions)}')
+            rc = 1
+    return rc
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--case', action='append', choices=list(CASES), help='Case to run, all by default.')
+    parser.add_argument('-n', '--repeat', type=int, default=10, help='Runs of every case, median time is reported.')
+    parser.add_argument('-o', '--output', help='Write results to the JSON file.')
+    parser.add_argument('-b', '--baseline', help='Compare results with the JSON file of a previous run.')
+    parser.add_argument('--threshold', type=float, default=20.0, help='Percent of slow down reported as regression.')
+    return run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
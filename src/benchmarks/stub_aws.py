@@ -0,0 +1,78 @@
+''' AWS Organizations, IAM and STS stubs for offline benchmarks, served by moto in server mode
+    so that CLI processes can reach it with AWS_ENDPOINT_URL. Requires moto[server] from dev-requirements.txt.
+'''
+import json
+import socket
+import logging
+
+import boto3
+from moto.server import ThreadedMotoServer
+
+REGION = 'us-east-1'
+CREDENTIALS = {
+    'aws_access_key_id': 'testing',
+    'aws_secret_access_key': 'testing',
+}
+TRUST_POLICY = json.dumps({
+    'Version': '2012-10-17',
+    'Statement': [{'Effect': 'Allow', 'Principal': {'Federated': 'arn:aws:iam::123456789012:saml-provider/AAD'},
+                   'Action': 'sts:AssumeRoleWithSAML'}],
+})
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class StubAWS:
+    ''' moto server with an organization of member accounts, each with IAM roles in /aad/ path'''
+
+    def __init__(self):
+        self.port = free_port()
+        self.server = ThreadedMotoServer(ip_address='127.0.0.1', port=self.port, verbose=False)
+        self.endpoint_url = f'http://127.0.0.1:{self.port}'
+        self.master_id = None
+        self.accounts = []
+
+    def start(self):
+        # request log of the server
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        self.server.start()
+        return self
+
+    def stop(self):
+        self.server.stop()
+
+    def environ(self):
+        '''Environment of a CLI process using the stub'''
+        return {
+            'AWS_ENDPOINT_URL': self.endpoint_url,
+            'AWS_ACCESS_KEY_ID': CREDENTIALS['aws_access_key_id'],
+            'AWS_SECRET_ACCESS_KEY': CREDENTIALS['aws_secret_access_key'],
+            'AWS_DEFAULT_REGION': REGION,
+        }
+
+    def client(self, name, **credentials):
+        return boto3.session.Session(region_name=REGION, **(credentials or CREDENTIALS)).client(
+            name, endpoint_url=self.endpoint_url)
+
+    def create_organization(self, accounts=100, roles_per_account=5):
+        ''' Create organization with member accounts, returns list of member account ids'''
+        orgs = self.client('organizations')
+        self.master_id = orgs.create_organization(FeatureSet='ALL')['Organization']['MasterAccountId']
+        for n in range(accounts):
+            status = orgs.create_account(Email=f'aws+{n}@example.com', AccountName=f'account-{n}')['CreateAccountStatus']
+            self.accounts.append(status['AccountId'])
+
+        sts = self.client('sts')
+        for account_id in self.accounts:
+            assumed = sts.assume_role(RoleArn=f'arn:aws:iam::{account_id}:role/OrganizationAccountAccessRole',
+                                      RoleSessionName='benchmark')['Credentials']
+            iam = self.client('iam', aws_access_key_id=assumed['AccessKeyId'],
+                              aws_secret_access_key=assumed['SecretAccessKey'],
+                              aws_session_token=assumed['SessionToken'])
+            for r in range(roles_per_account):
+                iam.create_role(Path='/aad/', RoleName=f'role-{r}', AssumeRolePolicyDocument=TRUST_POLICY)
+        return self.accounts
@@ -0,0 +1,468 @@
+''' Local stub of Microsoft Graph and AzureAD login endpoints used by the CLI, for offline benchmarks.
+    Directory content is generated deterministically from the size parameters, so request counts
+    and payload sizes are the same between runs. Latency, page size and throttling are configurable.
+
+    python benchmarks/stub_graph.py --port 8000 --users 1000 --roles 500 --latency 0.02
+
+    Point the CLI to the stub with AZURE_GRAPH_URL=http://127.0.0.1:8000/v1.0 and
+    AZURE_LOGIN_URL=http://127.0.0.1:8000.
+'''
+import re
+import gzip
+import json
+import time
+import uuid
+import argparse
+import threading
+import collections
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+APP_ID = '00000000-0000-4000-8000-00000000a001'
+SERVICE_ID = '00000000-0000-4000-8000-00000000a002'
+TENANT_ID = '00000000-0000-4000-8000-00000000a003'
+CLIENT_ID = '00000000-0000-4000-8000-00000000a004'
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 999
+
+FEDERATION_METADATA = f'''<?xml version="1.0" encoding="utf-8"?>
+<EntityDescriptor xmlns="urn:oasis:names:tc:SAML:2.0:metadata" entityID="https://sts.windows.net/{TENANT_ID}/">
+  <IDPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+    <KeyDescriptor use="signing">
+      <KeyInfo xmlns="http://www.w3.org/2000/09/xmldsig#">
+        <X509Data><X509Certificate>{'A' * 1024}</X509Certificate></X509Data>
+      </KeyInfo>
+    </KeyDescriptor>
+  </IDPSSODescriptor>
+</EntityDescriptor>
+'''
+
+FILTER_EQ = re.compile(r"^(\w+) eq '(.*)'$")
+FILTER_STARTS_WITH = re.compile(r"^startsWith\((\w+),'(.*)'\)$")
+
+
+def object_id(kind, n):
+    return str(uuid.UUID(int=(kind << 64) | n))
+
+
+class GraphState:
+    ''' Generated directory: users, groups with members, app roles of the AWS application
+        for (aws role name, account id) pairs and their assignments to users and groups.
+    '''
+
+    def __init__(self, accounts=('123456789012',), roles_per_account=5, users=1000, groups=20,
+                 members_per_group=50, assignments_per_user=2):
+        self.lock = threading.Lock()
+        self.version = 1
+        self.app_roles = []
+        for account_id in accounts:
+            for r in range(roles_per_account):
+                self.app_roles.append(self.app_role(f'role-{r}', account_id))
+        self.users = {}
+        for n in range(users):
+            user = {
+                'id': object_id(1, n),
+                'displayName': f'User {n}',
+                'givenName': 'User',
+                'surname': str(n),
+                'mail': f'user{n}@example.com',
+                'userPrincipalName': f'user{n}@example.com',
+                'accountEnabled': True,
+                'jobTitle': 'Engineer',
+                'officeLocation': 'Remote',
+                'businessPhones': ['+1 555 0100'],
+            }
+            self.users[user['id']] = user
+        self.by_mail = {u['mail'].lower(): u for u in self.users.values()}
+        user_ids = list(self.users)
+        self.groups = {}
+        self.members = {}
+        for n in range(groups):
+            group = {
+                'id': object_id(2, n),
+                'displayName': f'AWS-group-{n}',
+                'description': f'Group {n}',
+                'mail': None,
+                'mailEnabled': False,
+                'securityEnabled': True,
+            }
+            self.groups[group['id']] = group
+            start = n * members_per_group
+            self.members[group['id']] = [user_ids[(start + m) % len(user_ids)] for m in range(members_per_group)] \
+                if user_ids else []
+
+        self.assignments = collections.OrderedDict()
+        self.assignment_no = 0
+        if self.app_roles:
+            for n, user_id in enumerate(user_ids):
+                for a in range(assignments_per_user):
+                    self.assign(user_id, 'User', self.app_roles[(n + a) % len(self.app_roles)]['id'])
+            for n, group_id in enumerate(self.groups):
+                self.assign(group_id, 'Group', self.app_roles[(n * 7) % len(self.app_roles)]['id'])
+
+    @staticmethod
+    def app_role(aws_role_name, account_id):
+        return {
+            'allowedMemberTypes': ['User'],
+            'description': f'{aws_role_name}@{account_id}',
+            'displayName': f'{aws_role_name}/{account_id}',
+            'id': str(uuid.uuid5(uuid.NAMESPACE_URL, f'{aws_role_name}@{account_id}')),
+            'isEnabled': True,
+            'origin': 'Application',
+            'value': f'arn:aws:iam::{account_id}:role/aad/{aws_role_name},arn:aws:iam::{account_id}:saml-provider/AAD'
+        }
+
+    def principal_name(self, principal_id):
+        principal = self.users.get(principal_id) or self.groups.get(principal_id)
+        return principal['displayName'] if principal else None
+
+    def assign(self, principal_id, principal_type, app_role_id):
+        self.assignment_no += 1
+        assignment = {
+            'id': object_id(3, self.assignment_no),
+            'appRoleId': app_role_id,
+            'createdDateTime': '2026-01-01T00:00:00Z',
+            'deletedDateTime': None,
+            'principalDisplayName': self.principal_name(principal_id),
+            'principalId': principal_id,
+            'principalType': principal_type,
+            'resourceDisplayName': 'AWS',
+            'resourceId': SERVICE_ID,
+        }
+        self.assignments[assignment['id']] = assignment
+        return assignment
+
+    def application(self):
+        return {
+            'id': APP_ID,
+            'appId': CLIENT_ID,
+            'displayName': 'AWS',
+            'signInAudience': 'AzureADMyOrg',
+            'identifierUris': ['https://signin.aws.amazon.com/saml'],
+            'appRoles': self.app_roles,
+            'web': {'redirectUris': ['https://signin.aws.amazon.com/saml']},
+            'spa': {'redirectUris': []},
+        }
+
+    def etag(self):
+        return f'W/"{self.version}"'
+
+
+class Counters:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = collections.Counter()
+        self.statuses = collections.Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.throttled = 0
+        self.total = 0
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'requests': self.total,
+                'by_route': dict(self.requests),
+                'statuses': {str(k): v for k, v in self.statuses.items()},
+                'throttled': self.throttled,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+            }
+
+
+class StubGraphServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), state=None, latency=0.0, page_size=DEFAULT_PAGE_SIZE,
+                 throttle_every=0, retry_after=0):
+        super().__init__(address, GraphHandler)
+        self.state = state or GraphState()
+        self.latency = latency
+        self.page_size = page_size
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.counters = Counters()
+
+    @property
+    def base_url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+def project(item, query):
+    select = query.get('$select')
+    if not select:
+        return item
+    return {field: item.get(field) for field in select.split(',')}
+
+
+class GraphHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, with Nagle every response waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PATCH(self):
+        self.dispatch('PATCH')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        parts = [urllib.parse.unquote(p) for p in url.path.strip('/').split('/')]
+        route = self.route(method, parts)
+
+        with server.counters.lock:
+            server.counters.total += 1
+            server.counters.requests[f'{method} {route[0]}'] += 1
+            server.counters.bytes_in += len(body)
+            throttled = server.throttle_every and server.counters.total % server.throttle_every == 0
+            if throttled:
+                server.counters.throttled += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if throttled:
+            return self.send(429, {'error': {'code': 'TooManyRequests', 'message': 'Throttled'}},
+                             headers={'Retry-After': str(server.retry_after)})
+
+        handler = route[1]
+        if handler is None:
+            return self.send(404, {'error': {'code': 'Request_ResourceNotFound', 'message': self.path}})
+        try:
+            payload = json.loads(body) if body and 'json' in (self.headers.get('Content-Type') or '') else body
+            handler(query, payload, *route[2])
+        except KeyError as ex:
+            self.send(404, {'error': {'code': 'Request_ResourceNotFound', 'message': str(ex)}})
+
+    def route(self, method, parts):
+        ''' Returns tuple of (route name, handler, arguments)'''
+        if len(parts) >= 2 and parts[1] == 'oauth2':
+            return 'token', self.token if method == 'POST' else None, ()
+        if len(parts) >= 2 and parts[1] == 'federationmetadata':
+            return 'federationmetadata', self.federation_metadata, ()
+        if not parts or parts[0] != 'v1.0':
+            return 'unknown', None, ()
+        parts = parts[1:]
+        key = tuple('{id}' if n % 2 else p for n, p in enumerate(parts))
+        routes = {
+            ('POST', ('$batch',)): self.batch,
+            ('GET', ('applications', '{id}')): self.get_application,
+            ('PATCH', ('applications', '{id}')): self.patch_application,
+            ('GET', ('users',)): self.find_users,
+            ('GET', ('users', 'delta')): self.users_delta,
+            ('GET', ('users', '{id}')): self.get_user,
+            ('GET', ('users', '{id}', 'appRoleAssignments')): self.principal_assignments,
+            ('POST', ('users', '{id}', 'appRoleAssignments')): self.create_assignment,
+            ('DELETE', ('users', '{id}', 'appRoleAssignments', '{id}')): self.delete_assignment,
+            ('GET', ('groups',)): self.find_groups,
+            ('GET', ('groups', 'delta')): self.groups_delta,
+            ('GET', ('groups', '{id}')): self.get_group,
+            ('GET', ('groups', '{id}', 'members')): self.group_members,
+            ('GET', ('groups', '{id}', 'appRoleAssignments')): self.principal_assignments,
+            ('GET', ('servicePrincipals', '{id}', 'appRoleAssignedTo')): self.assigned_to,
+            ('GET', ('servicePrincipals', '{id}', 'appRoleAssignments')): self.assigned_to,
+        }
+        if parts[-1:] == ['delta']:
+            key = key[:-1] + ('delta',)
+        handler = routes.get((method, key))
+        args = tuple(p for n, p in enumerate(parts) if n % 2 and p != 'delta')
+        return '/'.join(key), handler, args
+
+    def send(self, status, payload=None, headers=None, content_type='application/json'):
+        data = b''
+        if payload is not None:
+            data = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if data:
+            self.send_header('Content-Type', content_type)
+            if len(data) > 1024 and 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+                data = gzip.compress(data, 6)
+                self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        with self.server.counters.lock:
+            self.server.counters.statuses[status] += 1
+            self.server.counters.bytes_out += len(data)
+
+    def page(self, items, query, path, delta=False):
+        ''' Respond with a page of items following the $top and $skiptoken of the query'''
+        top = min(int(query.get('$top', self.server.page_size)), MAX_PAGE_SIZE)
+        skip = int(query.get('$skiptoken', 0))
+        payload = {'value': [project(item, query) for item in items[skip:skip + top]]}
+        base = f'http://{self.headers["Host"]}/v1.0/{path}'
+        if skip + top < len(items):
+            next_query = dict(query, **{'$skiptoken': skip + top})
+            payload['@odata.nextLink'] = base + '?' + urllib.parse.urlencode(next_query)
+        elif delta:
+            payload['@odata.deltaLink'] = base + '?' + urllib.parse.urlencode({'$deltatoken': self.server.state.version})
+        self.send(200, payload)
+
+    def batch(self, query, payload):
+        ''' JSON batch, sub-requests are handled in order and are not throttled'''
+        responses = []
+        for request in payload['requests']:
+            url = urllib.parse.urlsplit(request['url'])
+            parts = ['v1.0'] + [urllib.parse.unquote(p) for p in url.path.strip('/').split('/')]
+            route = self.route(request['method'], parts)
+            response = {'id': request['id'], 'status': 404, 'body': {'error': {'code': 'Request_ResourceNotFound'}}}
+
+            def capture(status, payload=None, headers=None, content_type='application/json'):
+                response.update(status=status, body=payload, headers=headers or {})
+
+            if route[1] is not None:
+                # handlers respond with self.send
+                self.send = capture
+                try:
+                    route[1](dict(urllib.parse.parse_qsl(url.query)), request.get('body'), *route[2])
+                except KeyError as ex:
+                    capture(404, {'error': {'code': 'Request_ResourceNotFound', 'message': str(ex)}})
+                finally:
+                    del self.send
+            responses.append(response)
+        self.send(200, {'responses': responses})
+
+    def token(self, query, payload):
+        self.send(200, {'token_type': 'Bearer', 'access_token': 'stub-token', 'expires_on': str(int(time.time()) + 3600)})
+
+    def federation_metadata(self, query, payload):
+        self.send(200, FEDERATION_METADATA.encode('utf-8'), content_type='application/xml')
+
+    def get_application(self, query, payload, app_id):
+        state = self.server.state
+        if app_id != APP_ID:
+            raise KeyError(app_id)
+        with state.lock:
+            if self.headers.get('If-None-Match') == state.etag():
+                return self.send(304)
+            application = project(state.application(), query)
+            etag = state.etag()
+        self.send(200, application, headers={'ETag': etag})
+
+    def patch_application(self, query, payload, app_id):
+        state = self.server.state
+        with state.lock:
+            if 'appRoles' in payload:
+                state.app_roles = payload['appRoles']
+            state.version += 1
+        self.send(204)
+
+    def filtered(self, objects, query):
+        condition = query.get('$filter')
+        if not condition:
+            return list(objects)
+        match = FILTER_EQ.match(condition)
+        if match:
+            field, value = match.group(1), match.group(2).replace("''", "'").lower()
+            return [o for o in objects if (o.get(field) or '').lower() == value]
+        match = FILTER_STARTS_WITH.match(condition)
+        if match:
+            field, value = match.group(1), match.group(2).lower()
+            return [o for o in objects if (o.get(field) or '').lower().startswith(value)]
+        return []
+
+    def find_users(self, query, payload):
+        state = self.server.state
+        condition = FILTER_EQ.match(query.get('$filter') or '')
+        if condition and condition.group(1) == 'mail':
+            user = state.by_mail.get(condition.group(2).replace("''", "'").lower())
+            return self.send(200, {'value': [project(user, query)] if user else []})
+        self.page(self.filtered(state.users.values(), query), query, 'users')
+
+    def users_delta(self, query, payload):
+        items = [] if '$deltatoken' in query else list(self.server.state.users.values())
+        self.page(items, query, 'users/delta', delta=True)
+
+    def get_user(self, query, payload, user_id):
+        self.send(200, project(self.server.state.users[user_id], query))
+
+    def find_groups(self, query, payload):
+        self.page(self.filtered(self.server.state.groups.values(), query), query, 'groups')
+
+    def groups_delta(self, query, payload):
+        items = [] if '$deltatoken' in query else list(self.server.state.groups.values())
+        self.page(items, query, 'groups/delta', delta=True)
+
+    def get_group(self, query, payload, group_id):
+        self.send(200, project(self.server.state.groups[group_id], query))
+
+    def group_members(self, query, payload, group_id):
+        state = self.server.state
+        members = [dict(state.users[user_id], **{'@odata.type': '#microsoft.graph.user'})
+                   for user_id in state.members[group_id]]
+        self.page(members, query, f'groups/{group_id}/members')
+
+    def principal_assignments(self, query, payload, principal_id):
+        state = self.server.state
+        with state.lock:
+            assignments = [a for a in state.assignments.values() if a['principalId'] == principal_id]
+        kind = 'users' if principal_id in state.users else 'groups'
+        self.page(assignments, query, f'{kind}/{principal_id}/appRoleAssignments')
+
+    def create_assignment(self, query, payload, user_id):
+        state = self.server.state
+        with state.lock:
+            if user_id not in state.users:
+                raise KeyError(user_id)
+            assignment = state.assign(user_id, 'User', payload['appRoleId'])
+        self.send(201, assignment)
+
+    def delete_assignment(self, query, payload, user_id, assignment_id):
+        state = self.server.state
+        with state.lock:
+            del state.assignments[assignment_id]
+        self.send(204)
+
+    def assigned_to(self, query, payload, service_id):
+        with self.server.state.lock:
+            assignments = list(self.server.state.assignments.values())
+        self.page(assignments, query, f'servicePrincipals/{service_id}/appRoleAssignedTo')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--accounts', type=int, default=10)
+    parser.add_argument('--roles', type=int, default=5, help='App roles per account.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before every response.')
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE)
+    parser.add_argument('--throttle-every', type=int, default=0, help='Respond with 429 to every N-th request.')
+    options = parser.parse_args()
+
+    accounts = [f'{100000000000 + n}' for n in range(options.accounts)]
+    state = GraphState(accounts, options.roles, options.users, options.groups)
+    server = StubGraphServer(('127.0.0.1', options.port), state, options.latency, options.page_size, options.throttle_every)
+    print(f'Serving stub Graph API at {server.base_url}/v1.0 with {len(state.users)} users and {len(state.app_roles)} app roles')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()